@@ -1,4 +1,20 @@
+from QtGUI.core import pco_timestamp
+from QtGUI.core import pco_backend
+from QtGUI.core import pco_ring
+from QtGUI.core import pco_acquisition
+from QtGUI.core import pco_stack
+from QtGUI.core import pco_recorder
+from QtGUI.core import pco_container
+from QtGUI.core import pco_fits
+from QtGUI.core import pco_stats
+from QtGUI.core import pco_accumulator
+from QtGUI.core import pco_config
+from QtGUI.core import pco_buffers
+from QtGUI.core import pco_calibration
 from QtGUI.core import pco_definitions
-from QtGUI.core import pco_gui
+from QtGUI.core import pco_preview
+from QtGUI.core import pco_server
+from QtGUI.core import pco_pipeline
+from QtGUI.core import pco_service
 
 
@@ -0,0 +1,109 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import numpy as np
+from QtGUI.core.pco_acquisition import FrameSink
+
+
+class FrameAccumulator(FrameSink):
+    """
+    FrameAccumulator averages the frames of an acquisition without keeping
+    them: the running sum of the counts (uint32), of their squares (float64)
+    and the maximum (uint16) are updated in place with every frame, so the
+    memory is the same for 10 or 10^6 frames: 18 bytes per pixel with the
+    uint32 scratch image of the squares. The uint32 sum is folded into a
+    float64 sum, 8 more bytes per pixel, before it could overflow, every
+    (2**32 - 1)//max_count frames. result() gives the mean, variance and max
+    images at any time, also from another thread during the acquisition. With
+    interval, on_update(accumulator, frame) is called every interval frames
+    from the acquisition thread, e.g. to show the running mean in the live
+    view.
+    """
+
+    def __init__(self, interval=None, on_update=None, max_count=16383):
+        """
+        :param interval: number of frames between the calls of on_update, None for no updates
+        :param on_update: function called with the accumulator and the FrameLease of the last frame
+        :param max_count: highest count of the frames, sets how often the uint32 sum is folded
+        """
+        self.interval = interval
+        self.on_update = on_update
+        # frames the uint32 sum holds without overflow
+        self.fold_every = (2**32 - 1)//max_count
+        self.lock = threading.Lock()
+        self.frames = 0
+
+    def open(self, shape):
+        with self.lock:
+            self.sum = np.zeros(shape, dtype=np.uint32)
+            self.sum_sq = np.zeros(shape, dtype=np.float64)
+            self.max = np.zeros(shape, dtype=np.uint16)
+            self.square = np.empty(shape, dtype=np.uint32)
+            self.folded = None
+            self.partial = 0
+            self.frames = 0
+
+    def put(self, frame):
+        with self.lock:
+            if self.partial == self.fold_every:
+                if self.folded is None:
+                    self.folded = np.zeros(self.sum.shape, dtype=np.float64)
+                self.folded += self.sum
+                self.sum[:] = 0
+                self.partial = 0
+            np.add(self.sum, frame.array, out=self.sum)
+            np.multiply(frame.array, frame.array, out=self.square, dtype=np.uint32)
+            np.add(self.sum_sq, self.square, out=self.sum_sq)
+            np.maximum(self.max, frame.array, out=self.max)
+            self.partial += 1
+            self.frames += 1
+        if self.interval and self.on_update is not None and self.frames % self.interval == 0:
+            self.on_update(self, frame)
+
+    def _total(self):
+        total = self.sum.astype(np.float64)
+        if self.folded is not None:
+            total += self.folded
+        return total
+
+    def mean(self):
+        """
+        :return: mean image rounded to uint16, None before the first frame
+        """
+        with self.lock:
+            if self.frames == 0:
+                return None
+            total = self._total()
+            total /= self.frames
+        return np.rint(total).astype(np.uint16)
+
+    def result(self):
+        """
+        :return: dictionary with the number of frames and the float32 mean and variance and uint16 max
+        images, None before the first frame
+        """
+        with self.lock:
+            n = self.frames
+            if n == 0:
+                return None
+            mean = self._total()
+            mean /= n
+            variance = self.sum_sq/n
+            max_image = self.max.copy()
+        variance -= np.square(mean)
+        np.maximum(variance, 0, out=variance)
+        return {'frames': n,
+                'mean': mean.astype(np.float32),
+                'variance': variance.astype(np.float32),
+                'max': max_image}
+
+    def save(self, file_name):
+        """
+        Save the result as a .npz file with the arrays frames, mean, variance and max.
+        :param file_name: path of the file
+        :return: the result, see result()
+        """
+        result = self.result()
+        if result is None:
+            raise UserWarning("No frames accumulated.")
+        np.savez(file_name, **result)
+        return result
@@ -0,0 +1,403 @@
+__author__ = 'Polychronis Patapis'
+import ctypes
+import threading
+import time
+import numpy as np
+from QtGUI.core.pco_timestamp import decode_timestamp, TIMESTAMP_BINARY, TIMESTAMP_BINARY_ASCII
+
+
+class FrameLease(object):
+    """
+    A FrameLease gives access to a frame acquired by the AcquisitionEngine
+    without copying it out of the driver buffer. array is a read-only view on
+    the buffer. The buffer goes back to the driver queue only after every
+    holder of the lease released it, so consumers that keep a frame after
+    FrameSink.put() returned have to acquire() it and release() it when done.
+    Every frame carries:
+     -- seq: image counter of the camera if the binary timestamp is on, otherwise
+        the number of the buffer completed in the acquisition, so that frames
+        lost by the camera or the driver leave a gap in the sequence
+     -- timestamp: time.perf_counter() when the buffer was completed (monotonic)
+     -- time: the same instant in seconds since the epoch
+     -- camera_time: time of the binary timestamp in seconds since the epoch, or None
+    """
+
+    def __init__(self, engine, buffer, array, index, seq=None, timestamp=None, time=None, camera_time=None):
+        """
+        :param engine: AcquisitionEngine owning the buffer
+        :param buffer: index of the buffer in camera.buffer_numbers
+        :param array: read-only numpy view on the buffer
+        :param index: index of the frame in the acquisition, preframes excluded
+        :param seq: sequence number of the frame
+        :param timestamp: monotonic host time of the frame in seconds
+        :param time: host time of the frame in seconds since the epoch
+        :param camera_time: camera time of the frame in seconds since the epoch
+        """
+        self.engine = engine
+        self.buffer = buffer
+        self.array = array
+        self.index = index
+        self.seq = index if seq is None else seq
+        self.timestamp = timestamp
+        self.time = time
+        self.camera_time = camera_time
+        # statistics of the frame, if the engine computes them (see pco_stats.FrameStatistics)
+        self.stats = None
+        self.refs = 1
+
+    def acquire(self):
+        """
+        Take an additional reference on the frame.
+        :return: the lease itself
+        """
+        with self.engine.cond:
+            if self.refs <= 0:
+                raise UserWarning('Frame lease already released')
+            self.refs += 1
+        return self
+
+    def release(self):
+        """
+        Drop a reference on the frame. The array must not be used afterwards.
+        :return: None
+        """
+        self.engine._release(self)
+
+    def as_float(self, dtype=np.float32):
+        """
+        Floating point copy of the frame, for consumers that explicitly need one.
+        :param dtype: floating point data type
+        :return: new array
+        """
+        return self.array.astype(dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FrameSink(object):
+    """
+    A FrameSink receives the frames acquired by the AcquisitionEngine as
+    FrameLease. The engine holds the lease while put() runs, sinks that keep
+    the frame afterwards acquire the lease, other sinks copy what they need.
+    """
+
+    def open(self, shape):
+        """
+        Called once before the first frame.
+        :param shape: (y-resolution, x-resolution) of the frames
+        :return: None
+        """
+        return None
+
+    def put(self, frame):
+        """
+        Called for every acquired frame.
+        :param frame: FrameLease of the frame
+        :return: None
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Called once after the last frame, also if the acquisition failed.
+        :return: None
+        """
+        return None
+
+
+class FrameRingSink(FrameSink):
+    """
+    Puts the frames in a FrameRing for the live view, with their sequence
+    number and monotonic timestamp, and their statistics as info, or only
+    their max count (14 bit) if the engine does not compute statistics. The
+    ring keeps the leases of up to ring.max_leases frames instead of copies.
+    """
+
+    def __init__(self, ring, timeout=1.0):
+        """
+        :param ring: FrameRing with the frame shape
+        :param timeout: maximum time in seconds to wait for a slot if the ring blocks
+        """
+        self.ring = ring
+        self.timeout = timeout
+
+    def put(self, frame):
+        info = frame.stats if frame.stats is not None else {'max': int(np.ndarray.max(frame.array))}
+        self.ring.put(frame.array, seq=frame.seq, timestamp=frame.timestamp, info=info, timeout=self.timeout,
+                      lease=frame)
+
+    def close(self):
+        self.ring.close()
+
+
+class RingSink(FrameSink):
+    """
+    Copies the frames in a preallocated stack. The stack is used as a ring,
+    frame index i goes to out[(first_frame + i) % len(out)].
+    """
+
+    def __init__(self, out, first_frame=0):
+        """
+        :param out: numpy array of shape (num_frames, y-resolution, x-resolution)
+        :param first_frame: position in out of the first frame
+        """
+        self.out = out
+        self.first_frame = first_frame
+
+    def put(self, frame):
+        self.out[(self.first_frame + frame.index) % self.out.shape[0], :, :] = frame.array
+
+
+class CallbackSink(FrameSink):
+    """
+    Calls a function for every frame, with the FrameLease of the frame. The
+    lease is valid while the function runs, a function that keeps the frame
+    has to acquire() the lease, or copy the array.
+    """
+
+    def __init__(self, callback):
+        """
+        :param callback: function called with the FrameLease of every frame
+        """
+        self.callback = callback
+
+    def put(self, frame):
+        self.callback(frame)
+
+
+class AcquisitionEngine(object):
+    """
+    AcquisitionEngine runs the acquisition loop of a PixelFly camera. It waits
+    for the queued buffers in order, checks their status and hands the frames
+    to the frame sinks as FrameLease. A buffer is put back in the driver queue
+    when its lease is released, if all buffers are leased the loop waits for a
+    release. Frames with a buffer status error are dropped and counted, a
+    buffer timeout ends the acquisition. The 16 bit words of the camera are
+    shifted right by camera.bit_shift in place in the driver buffer, so all
+    sinks get uint16 frames with the 14 bit counts. Every frame is tagged with
+    the time its buffer was completed and a sequence number, the binary
+    timestamp of the camera is decoded when it is on (see FrameLease). A jump
+    in the sequence numbers of consecutive frames is counted as gap, the
+    frames in the jump as missed: with the camera timestamp this includes
+    frames the camera took while the driver had no buffer queued.
+    """
+
+    def __init__(self, camera):
+        """
+        :param camera: armed PixelFly instance
+        """
+        self.camera = camera
+        self.running = False
+        self.timed_out = False
+        self.frames_acquired = 0
+        self.frames_dropped = 0
+        self.dma_errors = 0
+        # number of times the loop had to wait for a lease to be released
+        self.stalls = 0
+        self.gaps = 0
+        self.frames_missed = 0
+        # (seq, timestamp, camera_time) of the first and last frame passed to the sinks
+        self.first_frame = None
+        self.last_frame = None
+        self.elapsed = 0.
+        # guards the buffer queue and the lease reference counts
+        self.cond = threading.Condition()
+        self._added_buffers = []
+        self._requeue_args = None
+
+    def stop(self):
+        """
+        Stop the acquisition loop after the current frame.
+        :return: None
+        """
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    def _release(self, lease):
+        """
+        Drop a reference of a lease and requeue its buffer after the last one.
+        """
+        with self.cond:
+            lease.refs -= 1
+            if lease.refs > 0:
+                return
+            if lease.refs < 0:
+                raise UserWarning('Frame lease already released')
+            camera = self.camera
+            if camera.armed and self._requeue_args is not None:
+                # Put the buffer back in the queue, with the arguments prepared for the buffer
+                camera.PixFlyDLL.PCO_AddBufferEx(*self._requeue_args[lease.buffer])
+                self._added_buffers.append(lease.buffer)
+            self.cond.notify_all()
+
+    def _next_buffer(self):
+        """
+        Wait until a buffer is in the driver queue.
+        :return: True if a buffer is queued, False if the engine was stopped
+        """
+        with self.cond:
+            if not self._added_buffers and self.running:
+                self.stalls += 1
+            while not self._added_buffers and self.running:
+                self.cond.wait(0.1)
+            return self.running
+
+    def frame_rate(self):
+        """
+        Average rate of acquired frames of the last run in frames per second.
+        """
+        if self.elapsed == 0:
+            return 0.
+        return self.frames_acquired/self.elapsed
+
+    def stats(self):
+        """
+        :return: dictionary with the frame counters of the last run and the frame rates measured from the host
+        timestamps of the first and last frame and from the camera timestamps, None if not available. The
+        camera frame rate counts the missed frames too.
+        """
+        host_rate, camera_rate = None, None
+        if self.first_frame is not None and self.frames_acquired > 1:
+            (seq0, t0, c0), (seq1, t1, c1) = self.first_frame, self.last_frame
+            if t1 > t0:
+                host_rate = (self.frames_acquired - 1)/(t1 - t0)
+            if c0 is not None and c1 is not None and c1 > c0:
+                camera_rate = (seq1 - seq0)/(c1 - c0)
+        return {'frames acquired': self.frames_acquired,
+                'frames dropped': self.frames_dropped,
+                'dma errors': self.dma_errors,
+                'stalls': self.stalls,
+                'gaps': self.gaps,
+                'frames missed': self.frames_missed,
+                'frame rate': host_rate,
+                'camera frame rate': camera_rate}
+
+    def _buffer_views(self, ArrayType):
+        """
+        numpy views on the driver buffers, built once per run.
+        :return: list of writable views, list of read-only views
+        """
+        camera = self.camera
+        shape = (camera.wYResAct.value, camera.wXResAct.value)
+        views, read_only = [], []
+        for pointer in camera.buffer_pointers:
+            buffer_ptr = ctypes.cast(pointer, ctypes.POINTER(ArrayType))
+            view = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape(shape)
+            views.append(view)
+            read_only.append(view.view())
+            read_only[-1].flags.writeable = False
+        return views, read_only
+
+    def run(self, sinks, num_images=None, preframes=0, verbose=False, poll_timeout=5e7, statistics=None):
+        """
+        Acquisition loop.
+        :param sinks: list of FrameSink instances receiving the frames
+        :param num_images: number of images to acquire, None to run until stop()
+        :param preframes: number of first images that are not passed to the sinks
+        :param verbose: True if the process should be printed
+        :param poll_timeout: how many tries the driver does to poll a frame in 'poll' wait mode
+        :param statistics: FrameStatistics computing FrameLease.stats before the frames go to the sinks
+        :return: True if the acquisition finished, False if a buffer timed out
+        """
+        camera = self.camera
+        if not camera.armed:
+            raise UserWarning('Cannot record to memory with disarmed camera')
+
+        if not hasattr(camera, '_prepared_to_record'):
+            camera._prepare_to_record_to_memory()
+
+        (dw1stImage, dwLastImage, wBitsPerPixel, dwStatusDll,
+         dwStatusDrv, bytes_per_pixel,
+         pixels_per_image, added_buffers, ArrayType) = camera._prepared_to_record
+        buffers, frames = self._buffer_views(ArrayType)
+        bit_shift = camera.bit_shift
+        self._added_buffers = added_buffers
+        self._requeue_args = camera._add_buffer_args
+
+        self.running = True
+        self.timed_out = False
+        self.frames_acquired, self.frames_dropped, self.dma_errors, self.stalls = 0, 0, 0, 0
+        self.gaps, self.frames_missed = 0, 0
+        self.first_frame, self.last_frame = None, None
+        decode = camera.state.get('Timestamp mode') in (TIMESTAMP_BINARY, TIMESTAMP_BINARY_ASCII)
+        # master frames of the current settings, applied in place after the timestamp is decoded
+        calibration = camera.calibrations.current() if camera.calibrate else None
+        if calibration is not None and calibration.shape != frames[0].shape:
+            raise UserWarning("Calibration of shape %s does not match the frames %s" % (calibration.shape,
+                                                                                         frames[0].shape))
+        for sink in sinks:
+            sink.open(frames[0].shape)
+        which_im = 0
+        # number of buffers completed, dropped frames and preframes included
+        num_completed = 0
+        last_seq = None
+        # lowest number of buffers left in the driver queue, 0 means the driver had no buffer to fill
+        min_queued = len(added_buffers)
+        ts = time.perf_counter()
+        epoch_offset = time.time() - ts
+        try:
+            while self.running and (num_images is None or which_im < num_images):
+                if not self._next_buffer():
+                    break
+                num_polls = camera._wait_for_buffer(added_buffers[0], dwStatusDll, dwStatusDrv,
+                                                    poll_timeout)
+                timestamp = time.perf_counter()
+                if num_polls is None:
+                    self.timed_out = True
+                    break
+                with self.cond:
+                    which_buf = added_buffers.pop(0)  # Buffer exits the queue
+                    min_queued = min(min_queued, len(added_buffers))
+                lease = FrameLease(self, which_buf, frames[which_buf], which_im - preframes, num_completed,
+                                   timestamp, timestamp + epoch_offset)
+                num_completed += 1
+                try:
+                    if verbose:
+                        print("After", num_polls, "polls, buffer")
+                        print(camera.buffer_numbers[which_buf].value)
+                        print("is ready.")
+                        print(hex(dwStatusDll.value), hex(dwStatusDrv.value))
+                    if dwStatusDrv.value != 0x00000000:
+                        self.frames_dropped += 1
+                        if dwStatusDrv.value == 0x80332028:
+                            self.dma_errors += 1
+                            print('DMA error during acquisition, frame dropped')
+                        else:
+                            print("dwStatusDrv:", dwStatusDrv.value)
+                        continue
+                    if which_im >= preframes:
+                        if bit_shift:
+                            np.right_shift(buffers[which_buf], bit_shift, out=buffers[which_buf])
+                        if decode:
+                            stamp = decode_timestamp(lease.array)
+                            if stamp is not None:
+                                lease.seq, lease.camera_time = stamp
+                        if calibration is not None:
+                            calibration.apply(buffers[which_buf], out=buffers[which_buf])
+                        if last_seq is not None and lease.seq != last_seq + 1:
+                            self.gaps += 1
+                            self.frames_missed += max(0, lease.seq - last_seq - 1)
+                        last_seq = lease.seq
+                        self.last_frame = (lease.seq, lease.timestamp, lease.camera_time)
+                        if self.first_frame is None:
+                            self.first_frame = self.last_frame
+                        if statistics is not None:
+                            lease.stats = statistics.compute(lease.array)
+                        for sink in sinks:
+                            sink.put(lease)
+                        self.frames_acquired += 1
+                    which_im += 1
+                finally:
+                    lease.release()
+        finally:
+            self.elapsed = time.perf_counter() - ts
+            self.running = False
+            camera.buffers.record_low_water(min_queued)
+            for sink in sinks:
+                sink.close()
+        return not self.timed_out
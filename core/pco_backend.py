@@ -0,0 +1,555 @@
+__author__ = 'Polychronis Patapis'
+import ctypes
+import threading
+import time
+from collections import deque
+import numpy as np
+from QtGUI.core.pco_timestamp import encode_timestamp, TIMESTAMP_BINARY, TIMESTAMP_BINARY_ASCII
+
+
+# return codes and buffer status flags of the SC2_Cam API
+PCO_NOERROR = 0
+PCO_ERROR_WRONGVALUE = ctypes.c_int32(0x80302001).value
+PCO_ERROR_NOTAVAILABLE = ctypes.c_int32(0x80302002).value
+BUFFER_ALLOCATED = 0x80000000
+BUFFER_EVENT_INTERNAL = 0x40000000
+BUFFER_EVENT_SET = 0x00008000
+BUFFER_QUEUED = BUFFER_ALLOCATED | BUFFER_EVENT_INTERNAL
+BUFFER_DONE = BUFFER_QUEUED | BUFFER_EVENT_SET  # 0xc0008000
+
+# C types of the SC2_Cam API
+HANDLE = ctypes.c_void_p
+WORD = ctypes.c_uint16
+SHORT = ctypes.c_int16
+DWORD = ctypes.c_uint32
+P = ctypes.POINTER
+# argtypes of the SC2_Cam functions, all of them return an int error code
+PROTOTYPES = {
+    'PCO_OpenCamera': (P(HANDLE), WORD),
+    'PCO_CloseCamera': (HANDLE,),
+    'PCO_ResetSettingsToDefault': (HANDLE,),
+    'PCO_RebootCamera': (HANDLE,),
+    'PCO_GetCameraSetup': (HANDLE, P(WORD), P(DWORD), P(WORD)),
+    'PCO_SetROI': (HANDLE, WORD, WORD, WORD, WORD),
+    'PCO_GetROI': (HANDLE, P(WORD), P(WORD), P(WORD), P(WORD)),
+    'PCO_SetBinning': (HANDLE, WORD, WORD),
+    'PCO_GetBinning': (HANDLE, P(WORD), P(WORD)),
+    'PCO_SetDelayExposureTime': (HANDLE, DWORD, DWORD, WORD, WORD),
+    'PCO_GetDelayExposureTime': (HANDLE, P(DWORD), P(DWORD), P(WORD), P(WORD)),
+    'PCO_ArmCamera': (HANDLE,),
+    'PCO_GetSizes': (HANDLE, P(WORD), P(WORD), P(WORD), P(WORD)),
+    'PCO_GetCOCRuntime': (HANDLE, P(DWORD), P(DWORD)),
+    'PCO_SetTimestampMode': (HANDLE, WORD),
+    'PCO_GetTimestampMode': (HANDLE, P(WORD)),
+    'PCO_SetRecordingState': (HANDLE, WORD),
+    'PCO_AllocateBuffer': (HANDLE, P(SHORT), DWORD, P(ctypes.c_void_p), P(HANDLE)),
+    'PCO_FreeBuffer': (HANDLE, SHORT),
+    'PCO_RemoveBuffer': (HANDLE,),
+    'PCO_CamLinkSetImageParameters': (HANDLE, WORD, WORD),
+    'PCO_AddBufferEx': (HANDLE, DWORD, DWORD, SHORT, WORD, WORD, WORD),
+    'PCO_GetBufferStatus': (HANDLE, SHORT, P(DWORD), P(DWORD)),
+}
+
+
+def _ref(arg):
+    """
+    Return the ctypes object behind an argument that was passed either
+    directly, through ctypes.byref() or as ctypes pointer.
+    """
+    if isinstance(arg, ctypes._Pointer):
+        return arg.contents
+    return getattr(arg, '_obj', arg)
+
+
+def _value(arg):
+    """
+    Return the python value of an argument passed by value as ctypes
+    object or plain python number.
+    """
+    arg = _ref(arg)
+    return getattr(arg, 'value', arg)
+
+
+def _set(arg, value):
+    """
+    Write value to an output argument passed by reference.
+    """
+    _ref(arg).value = value
+
+
+class SC2CamBackend(object):
+    """
+    SC2CamBackend defines the subset of the SC2_Cam API used by PixelFly.
+    Every method follows the signature of the respective DLL function, so that
+    a backend can be used in place of the loaded library. Output arguments are
+    ctypes objects passed by reference and the return value is the PCO error
+    code (0 if success).
+    """
+    # full sensor size (horizontal, vertical) of the pco.pixelfly usb
+    sensor_size = (1392, 1040)
+
+    def PCO_OpenCamera(self, hCam, board):
+        raise NotImplementedError
+
+    def PCO_CloseCamera(self, hCam):
+        raise NotImplementedError
+
+    def PCO_ResetSettingsToDefault(self, hCam):
+        raise NotImplementedError
+
+    def PCO_RebootCamera(self, hCam):
+        raise NotImplementedError
+
+    def PCO_GetCameraSetup(self, hCam, wType, dwSetup, wLen):
+        raise NotImplementedError
+
+    def PCO_SetROI(self, hCam, wRoiX0, wRoiY0, wRoiX1, wRoiY1):
+        raise NotImplementedError
+
+    def PCO_GetROI(self, hCam, wRoiX0, wRoiY0, wRoiX1, wRoiY1):
+        raise NotImplementedError
+
+    def PCO_SetBinning(self, hCam, wBinHorz, wBinVert):
+        raise NotImplementedError
+
+    def PCO_GetBinning(self, hCam, wBinHorz, wBinVert):
+        raise NotImplementedError
+
+    def PCO_SetDelayExposureTime(self, hCam, dwDelay, dwExposure,
+                                 wTimeBaseDelay, wTimeBaseExposure):
+        raise NotImplementedError
+
+    def PCO_GetDelayExposureTime(self, hCam, dwDelay, dwExposure,
+                                 wTimeBaseDelay, wTimeBaseExposure):
+        raise NotImplementedError
+
+    def PCO_ArmCamera(self, hCam):
+        raise NotImplementedError
+
+    def PCO_GetSizes(self, hCam, wXResAct, wYResAct, wXResMax, wYResMax):
+        raise NotImplementedError
+
+    def PCO_GetCOCRuntime(self, hCam, dwTime_s, dwTime_ns):
+        raise NotImplementedError
+
+    def PCO_SetTimestampMode(self, hCam, wTimeStampMode):
+        raise NotImplementedError
+
+    def PCO_GetTimestampMode(self, hCam, wTimeStampMode):
+        raise NotImplementedError
+
+    def PCO_SetRecordingState(self, hCam, wRecState):
+        raise NotImplementedError
+
+    def PCO_AllocateBuffer(self, hCam, sBufNr, dwSize, wBuf, hEvent):
+        raise NotImplementedError
+
+    def PCO_FreeBuffer(self, hCam, sBufNr):
+        raise NotImplementedError
+
+    def PCO_RemoveBuffer(self, hCam):
+        raise NotImplementedError
+
+    def PCO_CamLinkSetImageParameters(self, hCam, wXRes, wYRes):
+        raise NotImplementedError
+
+    def PCO_AddBufferEx(self, hCam, dw1stImage, dwLastImage, sBufNr,
+                        wXRes, wYRes, wBitPerPixel):
+        raise NotImplementedError
+
+    def PCO_GetBufferStatus(self, hCam, sBufNr, dwStatusDll, dwStatusDrv):
+        raise NotImplementedError
+
+    def wait_for_event(self, hEvent, timeout):
+        """
+        Block until the buffer event hEvent returned by PCO_AllocateBuffer is
+        signalled or the timeout expires.
+        :param hEvent: event handle of the buffer
+        :param timeout: timeout in seconds
+        :return: True if the event was signalled, False on timeout
+        """
+        raise NotImplementedError
+
+
+class DLLBackend(SC2CamBackend):
+    """
+    DLLBackend loads the SC2_Cam.dll of pco. Every function of PROTOTYPES is
+    bound once with its argtypes and restype and stored as attribute of the
+    backend, so wrong argument types raise ctypes.ArgumentError instead of
+    passing garbage to the driver, e.g. a handle truncated to a c_int on 64
+    bit. Only available on Windows.
+    """
+
+    def __init__(self, dllpath):
+        self.DLLpath = dllpath
+        self.dll = ctypes.windll.LoadLibrary(self.DLLpath)
+        for name, argtypes in PROTOTYPES.items():
+            function = getattr(self.dll, name)
+            function.argtypes = argtypes
+            function.restype = ctypes.c_int
+            # instance attributes shadow the methods of the interface
+            setattr(self, name, function)
+        self.kernel32 = ctypes.windll.kernel32
+        self.kernel32.WaitForSingleObject.argtypes = (ctypes.c_void_p, ctypes.c_uint32)
+        self.kernel32.WaitForSingleObject.restype = ctypes.c_uint32
+
+    def wait_for_event(self, hEvent, timeout):
+        # WAIT_OBJECT_0 = 0, WAIT_TIMEOUT = 0x102
+        ret = self.kernel32.WaitForSingleObject(_value(hEvent), int(timeout*1000))
+        return ret == 0
+
+
+class SimulatedBackend(SC2CamBackend):
+    """
+    SimulatedBackend is a pure python/numpy model of a pco.pixelfly usb. It
+    keeps the settings of the camera, allocates image buffers in host memory
+    and, while recording, fills the queued buffers from a producer thread at
+    the configured frame rate. Frames that arrive while no buffer is queued
+    are lost, as on the real hardware. The frame period follows a readout
+    model of the CCD: a fixed overhead per frame plus, for every binned row
+    of the ROI, a fixed overhead per line and the time to digitize its binned
+    pixels, scaled so that the full unbinned frame is read at frame_rate.
+    In the binary timestamp modes the image counter and the time are written
+    to the first pixels of every frame, see pco_timestamp.
+    """
+
+    def __init__(self, width=1392, height=1040, frame_rate=13.5,
+                 noise='poisson', offset=200, signal=2000, read_noise=5.,
+                 num_patterns=4, seed=None):
+        """
+        :param width: horizontal sensor size in pixels
+        :param height: vertical sensor size in pixels
+        :param frame_rate: maximum frame rate of the full unbinned frame in frames per second
+        :param noise: noise model, one of 'poisson', 'gaussian' or None
+        :param offset: dark offset in counts (14 bit)
+        :param signal: peak counts of the simulated spot (14 bit)
+        :param read_noise: rms read noise in counts
+        :param num_patterns: number of precomputed noisy frames that are cycled
+        :param seed: seed for the random generator
+        """
+        if noise not in ('poisson', 'gaussian', None):
+            raise UserWarning("Not accepted noise model " + str(noise))
+        self.sensor_size = (int(width), int(height))
+        self.frame_rate = float(frame_rate)
+        self.noise = noise
+        self.offset = offset
+        self.signal = signal
+        self.read_noise = read_noise
+        self.num_patterns = num_patterns
+        self.rng = np.random.default_rng(seed)
+
+        self.opened = False
+        self.roi = [1, 1, self.sensor_size[0], self.sensor_size[1]]
+        self.bin = [1, 1]
+        self.delay_exposure = [0, 10, 0, 2]  # delay, exposure, timebases
+        self.timestamp_mode = 0
+        self.sizes = [0, 0]
+        self.recording = False
+        self.buffers = {}
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.producer = None
+        self.patterns = []
+        self.frames_produced = 0
+        self.frames_lost = 0
+
+    def exposure_s(self):
+        """
+        Exposure time in seconds from the current exposure settings.
+        """
+        return self.delay_exposure[1] * 10.0**(-9 + 3*self.delay_exposure[3])
+
+    def readout_time(self):
+        """
+        Readout time in seconds of a frame with the armed ROI and binning.
+        """
+        x_res, y_res = self.sizes if self.sizes[0] else self.sensor_size
+        t_full = 1.0/self.frame_rate
+        # 5% frame overhead, the line time of the full frame is 25% overhead and 75% pixel clock
+        line_time = 0.95*t_full/self.sensor_size[1]
+        return 0.05*t_full + y_res*(0.25*line_time + 0.75*line_time*x_res/self.sensor_size[0])
+
+    def frame_period(self):
+        """
+        Time between two frames in seconds, exposure and readout overlap.
+        """
+        return max(self.readout_time(), self.exposure_s())
+
+    def _make_patterns(self):
+        """
+        Precompute a small bank of noisy frames for the armed resolution. The
+        producer cycles through them so that frame generation costs a single
+        copy per frame.
+        """
+        x_res, y_res = self.sizes
+        y, x = np.mgrid[0:y_res, 0:x_res]
+        sigma = max(x_res, y_res)/10.
+        spot = np.exp(-((x - x_res/2.)**2 + (y - y_res/2.)**2)/(2*sigma**2))
+        mean = self.offset + self.signal*spot
+        self.patterns = []
+        for i in range(self.num_patterns):
+            if self.noise == 'poisson':
+                frame = self.rng.poisson(mean) + self.rng.normal(0, self.read_noise, mean.shape)
+            elif self.noise == 'gaussian':
+                frame = mean + self.rng.normal(0, np.sqrt(mean + self.read_noise**2))
+            else:
+                frame = mean
+            frame = np.clip(np.rint(frame), 0, 16383).astype(np.uint16)
+            # the camera delivers the 14 bit data in the upper bits of 16 bit words
+            self.patterns.append(frame << 2)
+
+    def _produce(self):
+        """
+        Producer loop. Runs while the camera is recording and completes the
+        oldest queued buffer once per frame period.
+        """
+        next_frame = time.perf_counter()
+        while self.recording:
+            next_frame += self.frame_period()
+            delay = next_frame - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            with self.lock:
+                if not self.recording:
+                    break
+                self.frames_produced += 1
+                if not self.queue:
+                    self.frames_lost += 1
+                    continue
+                buf = self.buffers[self.queue.popleft()]
+                pattern = self.patterns[self.frames_produced % len(self.patterns)]
+                n = pattern.size
+                np.copyto(buf['data'][:n], pattern.ravel())
+                if self.timestamp_mode in (TIMESTAMP_BINARY, TIMESTAMP_BINARY_ASCII):
+                    # the image counter starts at 1 and counts the lost frames too
+                    stamp = encode_timestamp(self.frames_produced, time.time())[:n]
+                    buf['data'][:len(stamp)] = stamp << 2
+                buf['status'] = BUFFER_DONE
+                buf['event'].set()
+
+    def PCO_OpenCamera(self, hCam, board):
+        if self.opened:
+            return PCO_ERROR_NOTAVAILABLE
+        self.opened = True
+        _set(hCam, 1)
+        return PCO_NOERROR
+
+    def PCO_CloseCamera(self, hCam):
+        self.PCO_SetRecordingState(hCam, 0)
+        self.opened = False
+        return PCO_NOERROR
+
+    def PCO_ResetSettingsToDefault(self, hCam):
+        self.roi = [1, 1, self.sensor_size[0], self.sensor_size[1]]
+        self.bin = [1, 1]
+        self.delay_exposure = [0, 10, 0, 2]
+        self.timestamp_mode = 0
+        return PCO_NOERROR
+
+    def PCO_RebootCamera(self, hCam):
+        self.PCO_SetRecordingState(hCam, 0)
+        return self.PCO_ResetSettingsToDefault(hCam)
+
+    def PCO_GetCameraSetup(self, hCam, wType, dwSetup, wLen):
+        return PCO_NOERROR
+
+    def PCO_SetROI(self, hCam, wRoiX0, wRoiY0, wRoiX1, wRoiY1):
+        roi = [_value(wRoiX0), _value(wRoiY0), _value(wRoiX1), _value(wRoiY1)]
+        x_max = self.sensor_size[0]//self.bin[0]
+        y_max = self.sensor_size[1]//self.bin[1]
+        if not (1 <= roi[0] <= roi[2] <= x_max and 1 <= roi[1] <= roi[3] <= y_max):
+            return PCO_ERROR_WRONGVALUE
+        self.roi = roi
+        return PCO_NOERROR
+
+    def PCO_GetROI(self, hCam, wRoiX0, wRoiY0, wRoiX1, wRoiY1):
+        for arg, val in zip((wRoiX0, wRoiY0, wRoiX1, wRoiY1), self.roi):
+            _set(arg, val)
+        return PCO_NOERROR
+
+    def PCO_SetBinning(self, hCam, wBinHorz, wBinVert):
+        binning = [_value(wBinHorz), _value(wBinVert)]
+        if not set(binning) <= {1, 2, 4}:
+            return PCO_ERROR_WRONGVALUE
+        self.bin = binning
+        # the roi is given in binned pixels, clip it to the new format
+        x_max = self.sensor_size[0]//self.bin[0]
+        y_max = self.sensor_size[1]//self.bin[1]
+        x0, y0, x1, y1 = self.roi
+        self.roi = [min(x0, x_max), min(y0, y_max), min(x1, x_max), min(y1, y_max)]
+        return PCO_NOERROR
+
+    def PCO_GetBinning(self, hCam, wBinHorz, wBinVert):
+        _set(wBinHorz, self.bin[0])
+        _set(wBinVert, self.bin[1])
+        return PCO_NOERROR
+
+    def PCO_SetDelayExposureTime(self, hCam, dwDelay, dwExposure,
+                                 wTimeBaseDelay, wTimeBaseExposure):
+        values = [_value(dwDelay), _value(dwExposure),
+                  _value(wTimeBaseDelay), _value(wTimeBaseExposure)]
+        if values[2] not in (0, 1, 2) or values[3] not in (0, 1, 2):
+            return PCO_ERROR_WRONGVALUE
+        self.delay_exposure = values
+        return PCO_NOERROR
+
+    def PCO_GetDelayExposureTime(self, hCam, dwDelay, dwExposure,
+                                 wTimeBaseDelay, wTimeBaseExposure):
+        for arg, val in zip((dwDelay, dwExposure, wTimeBaseDelay, wTimeBaseExposure),
+                            self.delay_exposure):
+            _set(arg, val)
+        return PCO_NOERROR
+
+    def PCO_ArmCamera(self, hCam):
+        if self.recording:
+            return PCO_ERROR_NOTAVAILABLE
+        x0, y0, x1, y1 = self.roi
+        self.sizes = [x1 - x0 + 1, y1 - y0 + 1]
+        self._make_patterns()
+        return PCO_NOERROR
+
+    def PCO_GetSizes(self, hCam, wXResAct, wYResAct, wXResMax, wYResMax):
+        _set(wXResAct, self.sizes[0])
+        _set(wYResAct, self.sizes[1])
+        _set(wXResMax, self.sensor_size[0]//self.bin[0])
+        _set(wYResMax, self.sensor_size[1]//self.bin[1])
+        return PCO_NOERROR
+
+    def PCO_GetCOCRuntime(self, hCam, dwTime_s, dwTime_ns):
+        period = self.frame_period()
+        _set(dwTime_s, int(period))
+        _set(dwTime_ns, int(round((period - int(period))*1e9)))
+        return PCO_NOERROR
+
+    def PCO_SetTimestampMode(self, hCam, wTimeStampMode):
+        mode = _value(wTimeStampMode)
+        if self.recording or mode not in (0, 1, 2, 3):
+            return PCO_ERROR_WRONGVALUE
+        self.timestamp_mode = mode
+        return PCO_NOERROR
+
+    def PCO_GetTimestampMode(self, hCam, wTimeStampMode):
+        _set(wTimeStampMode, self.timestamp_mode)
+        return PCO_NOERROR
+
+    def PCO_SetRecordingState(self, hCam, wRecState):
+        state = bool(_value(wRecState))
+        if state and not self.recording:
+            if not self.patterns:
+                return PCO_ERROR_NOTAVAILABLE
+            self.recording = True
+            self.producer = threading.Thread(target=self._produce)
+            self.producer.daemon = True
+            self.producer.start()
+        elif not state and self.recording:
+            self.recording = False
+            self.producer.join()
+            self.producer = None
+        return PCO_NOERROR
+
+    def PCO_AllocateBuffer(self, hCam, sBufNr, dwSize, wBuf, hEvent):
+        with self.lock:
+            num = _value(sBufNr)
+            if num == -1:
+                num = 0
+                while num in self.buffers:
+                    num += 1
+            data = (ctypes.c_uint16*(_value(dwSize)//2))()
+            self.buffers[num] = {'data': np.frombuffer(data, dtype=np.uint16),
+                                 'array': data, 'status': BUFFER_ALLOCATED,
+                                 'event': threading.Event()}
+        _set(sBufNr, num)
+        _set(wBuf, ctypes.addressof(data))
+        _set(hEvent, num + 1)
+        return PCO_NOERROR
+
+    def PCO_FreeBuffer(self, hCam, sBufNr):
+        with self.lock:
+            num = _value(sBufNr)
+            if num not in self.buffers:
+                return PCO_ERROR_WRONGVALUE
+            if num in self.queue:
+                self.queue.remove(num)
+            del self.buffers[num]
+        return PCO_NOERROR
+
+    def PCO_RemoveBuffer(self, hCam):
+        with self.lock:
+            self.queue.clear()
+        return PCO_NOERROR
+
+    def PCO_CamLinkSetImageParameters(self, hCam, wXRes, wYRes):
+        return PCO_NOERROR
+
+    def PCO_AddBufferEx(self, hCam, dw1stImage, dwLastImage, sBufNr,
+                        wXRes, wYRes, wBitPerPixel):
+        with self.lock:
+            num = _value(sBufNr)
+            if num not in self.buffers:
+                return PCO_ERROR_WRONGVALUE
+            if _value(wXRes)*_value(wYRes) > self.buffers[num]['data'].size:
+                return PCO_ERROR_WRONGVALUE
+            buf = self.buffers[num]
+            buf['status'] = BUFFER_QUEUED
+            buf['event'].clear()
+            self.queue.append(num)
+        return PCO_NOERROR
+
+    def PCO_GetBufferStatus(self, hCam, sBufNr, dwStatusDll, dwStatusDrv):
+        num = _value(sBufNr)
+        if num not in self.buffers:
+            return PCO_ERROR_WRONGVALUE
+        _set(dwStatusDll, self.buffers[num]['status'])
+        _set(dwStatusDrv, 0)
+        return PCO_NOERROR
+
+    def wait_for_event(self, hEvent, timeout):
+        buf = self.buffers.get(_value(hEvent) - 1)
+        if buf is None:
+            return False
+        return buf['event'].wait(timeout)
+
+
+if __name__ == "__main__":
+    # benchmark of the driver calls the acquisition loop makes for every frame, PCO_GetBufferStatus and
+    # PCO_AddBufferEx, against the simulated camera: the call pattern of the original loops, lookup of the
+    # function and new byref() objects on every call, against the argument tuples that PixelFly prepares once
+    # per buffer (see PixelFly._prepare_to_record_to_memory). The simulator is called in python, so this
+    # measures the python side of the calls only, not the argument conversion of the bound DLL prototypes.
+    import timeit
+    backend = SimulatedBackend()
+    hCam = HANDLE()
+    backend.PCO_OpenCamera(ctypes.byref(hCam), 0)
+    backend.PCO_ArmCamera(hCam)
+    wXResAct, wYResAct = WORD(backend.sizes[0]), WORD(backend.sizes[1])
+    number, address, event = SHORT(-1), ctypes.c_void_p(), HANDLE()
+    backend.PCO_AllocateBuffer(hCam, ctypes.byref(number), DWORD(2*wXResAct.value*wYResAct.value),
+                               ctypes.byref(address), ctypes.byref(event))
+    dw1stImage, dwLastImage, wBitsPerPixel = DWORD(0), DWORD(0), WORD(16)
+    dwStatusDll, dwStatusDrv = DWORD(), DWORD()
+
+    class Camera(object):
+        pass
+
+    camera = Camera()
+    camera.PixFlyDLL, camera.hCam, camera.buffer_numbers = backend, hCam, [number]
+
+    def old_calls():
+        camera.PixFlyDLL.PCO_GetBufferStatus(camera.hCam, camera.buffer_numbers[0],
+                                             ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
+        camera.PixFlyDLL.PCO_AddBufferEx(camera.hCam, dw1stImage, dwLastImage, camera.buffer_numbers[0],
+                                         wXResAct, wYResAct, wBitsPerPixel)
+
+    status_args = (hCam, number, ctypes.pointer(dwStatusDll), ctypes.pointer(dwStatusDrv))
+    add_buffer_args = (hCam, dw1stImage, dwLastImage, number, wXResAct, wYResAct, wBitsPerPixel)
+    get_buffer_status, add_buffer = backend.PCO_GetBufferStatus, backend.PCO_AddBufferEx
+
+    def new_calls():
+        get_buffer_status(*status_args)
+        add_buffer(*add_buffer_args)
+
+    number_of_calls = 20000
+    for name, calls in (('lookup + new byref', old_calls), ('prepared arguments', new_calls)):
+        t = min(timeit.repeat(calls, number=number_of_calls, repeat=5,
+                              setup=lambda: backend.PCO_RemoveBuffer(hCam)))
+        print("%s: %.2f us/frame" % (name, t/number_of_calls*1e6))
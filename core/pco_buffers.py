@@ -0,0 +1,210 @@
+__author__ = 'Polychronis Patapis'
+import ctypes
+import math
+
+# maximum number of buffers the SC2_Cam driver allocates per camera
+MAX_DRIVER_BUFFERS = 16
+
+
+class BufferPool(object):
+    """
+    BufferPool manages the driver buffers of a PixelFly. The number of buffers
+    is sized so that the driver can keep acquiring for latency_budget seconds
+    while the acquisition thread does not requeue any buffer:
+
+        buffers = ceil(frame_rate * latency_budget) + 2
+
+    (one buffer being filled, one held by the acquisition thread), plus the
+    buffers consumers hold out of the queue (e.g. the frame leases of the live
+    ring). If the held buffers do not fit under the cap, they are taken from
+    the latency headroom instead, down to the 2 buffers the acquisition needs
+    queued: spare() gives the buffers consumers can hold, stats() the headroom
+    that is left, and allocate() prints when it was cut. The number, also an
+    explicit one, is at most the driver maximum of 16 and must fit in the
+    memory cap: the sized number is at least min_buffers, UserWarning is
+    raised if they do not fit. The buffers outlive the acquisitions: disarming
+    the camera only removes them from the driver queue, close_camera frees
+    them. allocate() is called again before every acquisition: buffers of the
+    right size are kept, the pool only allocates the missing ones or frees the
+    surplus, and all are reallocated if the frame size changed. The lowest
+    number of buffers that were queued in the driver while acquiring is
+    tracked per acquisition and over the life of the pool: a low-water mark of
+    0 means the driver ran out of buffers, frames may have been lost.
+    """
+
+    def __init__(self, camera, latency_budget=0.2, max_memory=256*2**20, min_buffers=2,
+                 max_buffers=MAX_DRIVER_BUFFERS):
+        """
+        :param camera: PixelFly instance
+        :param latency_budget: longest time in seconds the acquisition thread may be late
+        :param max_memory: maximum memory of the buffers in bytes
+        :param min_buffers: minimum number of buffers
+        :param max_buffers: maximum number of buffers, at most MAX_DRIVER_BUFFERS
+        """
+        self.camera = camera
+        self.latency_budget = latency_budget
+        self.max_memory = max_memory
+        self.min_buffers = min_buffers
+        self.max_buffers = min(max_buffers, MAX_DRIVER_BUFFERS)
+        self.frame_bytes = 0
+        # frame rate and held buffers of the last allocate()
+        self.frame_rate = 0.
+        self.held = 0
+        self.low_water = None
+        self.last_low_water = None
+        self.high_water = None
+        self.acquisitions = 0
+
+    def __len__(self):
+        return len(self.camera.buffer_numbers)
+
+    def memory(self):
+        """
+        :return: memory of the allocated buffers in bytes
+        """
+        return len(self)*self.frame_bytes
+
+    def size(self, frame_bytes, frame_rate, held=0):
+        """
+        Number of buffers for a frame size and rate.
+        :param frame_bytes: size of a frame in bytes
+        :param frame_rate: frame rate in frames per second
+        :param held: number of buffers consumers hold out of the driver queue, they may be cut by the caps
+        :return: number of buffers
+        """
+        fit = int(self.max_memory//frame_bytes)
+        if fit < self.min_buffers:
+            raise UserWarning("%i buffers of %i bytes do not fit in the memory cap of %i bytes" % (
+                self.min_buffers, frame_bytes, self.max_memory))
+        num_buffers = int(math.ceil(frame_rate*self.latency_budget)) + 2 + held
+        num_buffers = max(min(num_buffers, fit), self.min_buffers)
+        return min(num_buffers, self.max_buffers)
+
+    def allocate(self, num_buffers=None, held=0):
+        """
+        Allocate the driver buffers for the armed image size, keeping the buffers already allocated if they
+        have the right size.
+        :param num_buffers: number of buffers, None to size them from the frame rate of the armed camera, at
+        most max_buffers
+        :param held: number of buffers consumers hold out of the driver queue, added if num_buffers is None
+        :return: number of buffers
+        """
+        camera = self.camera
+        if not camera.armed:
+            raise UserWarning("Camera must be armed to allocate buffers.")
+        if camera.engine.running:
+            raise UserWarning("Cannot change the buffers during an acquisition.")
+        frame_bytes = camera.wXResAct.value*camera.wYResAct.value*2  # 2 bytes per pixel
+        self.frame_rate, self.held = 1./camera.coc_runtime(), held
+        if num_buffers is None:
+            num_buffers = self.size(frame_bytes, self.frame_rate, held)
+            if held and num_buffers < self.size(frame_bytes, self.frame_rate) + held:
+                print("%i held buffers do not fit under the cap of %i buffers, latency headroom cut to %.3f s"
+                      % (held, num_buffers, self._headroom(num_buffers, frame_bytes)))
+        else:
+            num_buffers = min(num_buffers, self.max_buffers)
+            if num_buffers*frame_bytes > self.max_memory:
+                raise UserWarning("%i buffers of %i bytes do not fit in the memory cap of %i bytes" % (
+                    num_buffers, frame_bytes, self.max_memory))
+        if frame_bytes != self.frame_bytes:
+            self.free()
+            self.frame_bytes = frame_bytes
+        if num_buffers == len(self):
+            return num_buffers
+        # the queue of the driver is built again by _prepare_to_record_to_memory
+        self._unprepare()
+        dll = camera.PixFlyDLL
+        while len(self) > num_buffers:
+            dll.PCO_FreeBuffer(camera.hCam, camera.buffer_numbers.pop())
+            camera.buffer_pointers.pop()
+            camera.buffer_events.pop()
+        dwSize = ctypes.c_uint32(frame_bytes)
+        while len(self) < num_buffers:
+            number, pointer, event = ctypes.c_int16(-1), ctypes.c_void_p(0), ctypes.c_void_p(0)
+            ret = dll.PCO_AllocateBuffer(camera.hCam, ctypes.byref(number), dwSize, ctypes.byref(pointer),
+                                         ctypes.byref(event))
+            if ret != 0:
+                raise UserWarning("Allocation of buffer %i failed, error %s" % (len(self),
+                                                                                 hex(ret & 0xffffffff)))
+            camera.buffer_numbers.append(number)
+            camera.buffer_pointers.append(pointer)
+            camera.buffer_events.append(event)
+        # Tell camera link what actual resolution to expect
+        dll.PCO_CamLinkSetImageParameters(camera.hCam, camera.wXResAct, camera.wYResAct)
+        return num_buffers
+
+    def spare(self, num_buffers=None, frame_bytes=None):
+        """
+        Number of buffers consumers can hold out of the driver queue: the buffers beyond the ones the driver
+        needs for the latency budget, or the held buffers of the last allocate() if they were cut by the cap,
+        as long as 2 buffers stay queued.
+        :param num_buffers: number of buffers, by default the allocated ones
+        :param frame_bytes: size of a frame in bytes, by default the one of the allocated buffers
+        :return: number of buffers
+        """
+        num_buffers = len(self) if num_buffers is None else num_buffers
+        frame_bytes = self.frame_bytes if frame_bytes is None else frame_bytes
+        if not num_buffers:
+            return 0
+        surplus = num_buffers - self.size(frame_bytes, self.frame_rate)
+        return max(0, surplus, min(self.held, num_buffers - 2))
+
+    def _headroom(self, num_buffers=None, frame_bytes=None):
+        """
+        :return: time in seconds the driver can keep acquiring from its queue while the acquisition thread is
+        late and the consumers hold the spare buffers
+        """
+        num_buffers = len(self) if num_buffers is None else num_buffers
+        if not num_buffers or not self.frame_rate:
+            return 0.
+        return max(0, num_buffers - self.spare(num_buffers, frame_bytes) - 2)/self.frame_rate
+
+    def _unprepare(self):
+        camera = self.camera
+        if hasattr(camera, '_prepared_to_record'):
+            camera.PixFlyDLL.PCO_RemoveBuffer(camera.hCam)
+            del camera._prepared_to_record
+
+    def free(self):
+        """
+        Remove the buffers from the driver queue and free them.
+        :return: None
+        """
+        camera = self.camera
+        camera.PixFlyDLL.PCO_RemoveBuffer(camera.hCam)
+        if hasattr(camera, '_prepared_to_record'):
+            del camera._prepared_to_record
+        for number in camera.buffer_numbers:
+            camera.PixFlyDLL.PCO_FreeBuffer(camera.hCam, number)
+        camera.buffer_numbers, camera.buffer_pointers, camera.buffer_events = [], [], []
+        self.frame_bytes = 0
+
+    def record_low_water(self, queued):
+        """
+        Called by the acquisition engine at the end of an acquisition.
+        :param queued: lowest number of buffers queued in the driver during the acquisition
+        :return: None
+        """
+        self.acquisitions += 1
+        self.last_low_water = queued
+        self.low_water = queued if self.low_water is None else min(self.low_water, queued)
+        in_use = len(self) - queued
+        self.high_water = in_use if self.high_water is None else max(self.high_water, in_use)
+
+    def stats(self):
+        """
+        :return: dictionary with the number and memory of the buffers, the held buffers requested and the
+        spare ones consumers can hold, the latency headroom in seconds, the low-water marks of the queued
+        buffers of the last acquisition and of all acquisitions, and the high-water mark of the buffers out of
+        the driver queue
+        """
+        return {'buffers': len(self),
+                'frame bytes': self.frame_bytes,
+                'memory': self.memory(),
+                'held': self.held,
+                'spare': self.spare(),
+                'latency headroom': self._headroom(),
+                'low water': self.low_water,
+                'last low water': self.last_low_water,
+                'high water': self.high_water,
+                'acquisitions': self.acquisitions}
@@ -0,0 +1,263 @@
+__author__ = 'Polychronis Patapis'
+import os
+import tempfile
+import numpy as np
+from QtGUI.core.pco_timestamp import TIMESTAMP_OFF
+
+# camera settings the master frames depend on: the dark on exposure, roi and binning, the flat
+# field gain only on roi and binning
+MASTER_KEYS = {'dark': ('Exposure time', 'ROI', 'binning'),
+               'flat': ('ROI', 'binning')}
+
+
+def master_frame(stack, method='mean', max_bytes=64*2**20):
+    """
+    Combine a stack of frames to a master frame with bounded memory, so the stack can be a memory-mapped
+    file larger than the memory (see pco_stack). The mean is accumulated frame by frame, the median is
+    computed exactly over bands of rows of at most max_bytes.
+    :param stack: array of shape (num_frames, y-resolution, x-resolution)
+    :param method: 'mean' or 'median'
+    :param max_bytes: maximum memory of a band of rows for the median
+    :return: float32 master frame
+    """
+    num_frames = stack.shape[0]
+    if num_frames == 0:
+        raise UserWarning("Cannot make a master frame of an empty stack")
+    if method == 'mean':
+        total = np.zeros(stack.shape[1:], dtype=np.float64)
+        for frame in stack:
+            total += frame
+        return (total/num_frames).astype(np.float32)
+    if method != 'median':
+        raise UserWarning("Not accepted method " + str(method))
+    master = np.empty(stack.shape[1:], dtype=np.float32)
+    rows = max(1, int(max_bytes//(num_frames*stack.shape[2]*stack.dtype.itemsize)))
+    for row in range(0, stack.shape[1], rows):
+        master[row:row + rows] = np.median(stack[:, row:row + rows], axis=0)
+    return master
+
+
+def flat_gain(flat, dark=None):
+    """
+    Flat field gain: the mean of the dark subtracted flat over the dark subtracted flat, so that the
+    corrected frames keep their mean level. Pixels without signal in the flat get a gain of 1.
+    :param flat: master flat frame
+    :param dark: master dark frame of the flat exposure
+    :return: float32 gain
+    """
+    signal = flat.astype(np.float32) - (0 if dark is None else dark)
+    valid = signal > 0
+    if not np.any(valid):
+        raise UserWarning("Flat field has no signal above the dark")
+    gain = np.ones(signal.shape, dtype=np.float32)
+    gain[valid] = signal[valid].mean()/signal[valid]
+    return gain
+
+
+class Calibration(object):
+    """
+    Calibration applies a master dark and/or a flat field gain to uint16
+    frames. The dark is subtracted in uint16, pixels below the dark are set
+    to 0 instead of wrapping around; the gain is applied in float32 and the
+    result is rounded and clipped to max_count. The first keep_rows rows are
+    left as they are, so the timestamp of the camera survives. apply() works
+    in place when out is the frame, as in the acquisition engine.
+    """
+
+    def __init__(self, dark=None, gain=None, max_count=16383, keep_rows=0):
+        """
+        :param dark: master dark frame, None for no dark subtraction
+        :param gain: flat field gain (see flat_gain), None for no flat field correction
+        :param max_count: highest count of the corrected frames
+        :param keep_rows: number of first rows that are not calibrated, e.g. 1 for the timestamp
+        """
+        self.dark = None if dark is None else np.rint(dark).clip(0, max_count).astype(np.uint16)
+        self.gain = None if gain is None else np.asarray(gain, dtype=np.float32)
+        self.max_count = max_count
+        self.keep_rows = keep_rows
+        self.shape = (self.dark if self.dark is not None else self.gain).shape
+        self.scaled = None
+
+    def describe(self):
+        """
+        :return: 'dark', 'flat' or 'dark+flat'
+        """
+        masters = (('dark', self.dark), ('flat', self.gain))
+        return '+'.join(name for name, master in masters if master is not None)
+
+    def apply(self, frame, out=None):
+        """
+        :param frame: uint16 frame
+        :param out: uint16 array receiving the corrected frame, may be the frame itself
+        :return: corrected uint16 frame
+        """
+        if frame.shape != self.shape:
+            raise UserWarning("Frame shape %s does not match the calibration %s" % (frame.shape, self.shape))
+        if out is None:
+            out = np.empty_like(frame)
+        keep = self.keep_rows
+        if keep and out is not frame:
+            out[:keep] = frame[:keep]
+        # views on the calibrated rows
+        data, corrected = frame[keep:], out[keep:]
+        if self.dark is not None:
+            dark = self.dark[keep:]
+            np.maximum(data, dark, out=corrected)
+            np.subtract(corrected, dark, out=corrected)
+        elif out is not frame:
+            np.copyto(corrected, data)
+        if self.gain is not None:
+            if self.scaled is None:
+                self.scaled = np.empty(corrected.shape, dtype=np.float32)
+            np.multiply(corrected, self.gain[keep:], out=self.scaled)
+            np.clip(self.scaled, 0, self.max_count, out=self.scaled)
+            np.rint(self.scaled, out=self.scaled)
+            np.copyto(corrected, self.scaled, casting='unsafe')
+        return out
+
+    def apply_float(self, frame):
+        """
+        :param frame: uint16 frame
+        :return: corrected float32 frame, without clipping
+        """
+        data = frame.astype(np.float32)
+        corrected = data[self.keep_rows:]
+        if self.dark is not None:
+            corrected -= self.dark[self.keep_rows:]
+        if self.gain is not None:
+            corrected *= self.gain[self.keep_rows:]
+        return data
+
+
+class CalibrationCache(object):
+    """
+    CalibrationCache keeps the master frames of a PixelFly, keyed by the
+    camera settings they depend on (MASTER_KEYS), as cached by camera.state,
+    and optionally saves them as .npy files in a directory, so they are made
+    once and found again by later sessions. current() gives the Calibration
+    for the current settings; it is looked up again after every change of
+    exposure time, ROI, binning or timestamp mode and after the settings
+    were invalidated (open, reset, reboot), the cache is notified by
+    camera.state. With the timestamp on, the first row is not calibrated.
+    """
+
+    def __init__(self, camera, directory=None):
+        """
+        :param camera: PixelFly instance
+        :param directory: directory of the master frame files, None to keep them only in memory
+        """
+        self.camera = camera
+        self.directory = directory
+        self.masters = {}
+        self.calibration = None
+        self.valid = False
+        camera.state.listeners.append(self._settings_changed)
+
+    def _settings_changed(self, keys):
+        if set(keys) & set(MASTER_KEYS['dark'] + ('Timestamp mode',)):
+            self.calibration = None
+            self.valid = False
+
+    def key(self, kind):
+        """
+        :param kind: 'dark' or 'flat'
+        :return: key of the master frame of the current settings
+        """
+        state = self.camera.state
+        values = {'Exposure time': 'exp%s%s' % tuple(state.get('Exposure time')),
+                  'ROI': 'roi' + '-'.join(str(v) for v in state.get('ROI')),
+                  'binning': 'bin%ix%i' % tuple(state.get('binning'))}
+        return '_'.join([kind] + [values[name] for name in MASTER_KEYS[kind]])
+
+    def _file_name(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def store(self, kind, master):
+        """
+        Store a master frame for the current settings.
+        :param kind: 'dark', or 'flat' for a flat field gain
+        :param master: master frame
+        :return: key of the master frame
+        """
+        key = self.key(kind)
+        self.masters[key] = master
+        if self.directory is not None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            np.save(self._file_name(key), master)
+        self.calibration, self.valid = None, False
+        return key
+
+    def get(self, kind):
+        """
+        :param kind: 'dark' or 'flat'
+        :return: master frame for the current settings, None if there is none
+        """
+        key = self.key(kind)
+        if key not in self.masters and self.directory is not None and os.path.isfile(self._file_name(key)):
+            self.masters[key] = np.load(self._file_name(key))
+        return self.masters.get(key)
+
+    def current(self):
+        """
+        :return: Calibration for the current settings, None if there is no master frame for them
+        """
+        if not self.valid:
+            dark, gain = self.get('dark'), self.get('flat')
+            keep_rows = 0 if self.camera.state.get('Timestamp mode') == TIMESTAMP_OFF else 1
+            self.calibration = None if dark is None and gain is None else Calibration(dark, gain,
+                                                                                      keep_rows=keep_rows)
+            self.valid = True
+        return self.calibration
+
+    def record(self, kind, num_images=50, method='mean', out=None):
+        """
+        Record a master frame for the current settings with the armed and recording camera. The frames are
+        not calibrated. The mean is accumulated frame by frame (see PixelFly.record_accumulate), the frames
+        of the median go to a memory-mapped stack, a temporary file if out is None, so the memory does not
+        grow with num_images. A flat is made a gain with the dark of the same settings, if there is one.
+        :param kind: 'dark' or 'flat'
+        :param num_images: number of frames
+        :param method: 'mean' or 'median'
+        :param out: path of the stack file of the median (see PixelFly.record_to_memory), None for a
+        temporary file in the directory of the cache or the temporary directory
+        :return: the master frame
+        """
+        if kind not in MASTER_KEYS:
+            raise UserWarning("Not accepted master frame " + str(kind))
+        if method not in ('mean', 'median'):
+            raise UserWarning("Not accepted method " + str(method))
+        camera = self.camera
+        calibrate, camera.calibrate = camera.calibrate, False
+        temporary = None
+        try:
+            if method == 'mean':
+                master = camera.record_accumulate(num_images).result()['mean']
+            else:
+                if out is None:
+                    if self.directory is not None and not os.path.isdir(self.directory):
+                        os.makedirs(self.directory)
+                    handle, temporary = tempfile.mkstemp(suffix='.npy', dir=self.directory)
+                    os.close(handle)
+                    out = temporary
+                stack = camera.record_to_memory(num_images, verbose=False, out=out)
+                if stack is None:
+                    raise UserWarning("Buffer timed out, master frame not recorded.")
+                master = master_frame(stack, method)
+                del stack  # unmap the file before it is removed
+        finally:
+            camera.calibrate = calibrate
+            if temporary is not None:
+                os.remove(temporary)
+        if kind == 'flat':
+            master = flat_gain(master, self.get('dark'))
+        self.store(kind, master)
+        return master
+
+    def clear(self):
+        """
+        Forget the master frames kept in memory, the files are kept.
+        :return: None
+        """
+        self.masters = {}
+        self.calibration, self.valid = None, False
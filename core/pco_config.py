@@ -0,0 +1,316 @@
+__author__ = 'Polychronis Patapis'
+import ctypes
+from QtGUI.core.pco_timestamp import TIMESTAMP_MODES
+
+# timebase codes of the SC2_Cam API
+TIMEBASES = {0: 'ns', 1: 'us', 2: 'ms'}
+ALLOWED_BINNING = (1, 2, 4)
+# settings that can change during an acquisition, they do not change the image size
+TIME_KEYS = ('Exposure time', 'Delay time')
+
+
+class ConfigTransaction(object):
+    """
+    ConfigTransaction collects the new ROI, binning, exposure and delay time
+    and timestamp mode of a PixelFly and applies them in one go on commit(). The requested values
+    are compared with the settings cached by camera.state (see CameraState),
+    only the changed ones are sent to the camera and the camera is armed once
+    at the end, so PCO_ArmCamera/PCO_GetSizes run once however many settings
+    change. Changes of only the exposure and delay time are also allowed
+    during an acquisition: the camera is not disarmed, it is armed again in
+    place if it is not recording, a recording camera takes the new times
+    with the next frame. If the camera rejects a setting, the settings already applied in
+    the transaction are restored and UserWarning is raised. Used as context
+    manager it commits on exit, unless an exception occurred:
+
+        with camera.configure() as config:
+            config.binning(2, 2)
+            config.roi((1, 1, 696, 520))
+            config.exposure_time(20, 2)
+    """
+
+    def __init__(self, camera, arm=None, verbose=False):
+        """
+        :param camera: PixelFly instance
+        :param arm: True to arm the camera after the changes, False to leave it disarmed, None to arm it
+        only if it was armed before
+        :param verbose: True if the process should be printed
+        """
+        self.camera = camera
+        self.arm = arm
+        self.verbose = verbose
+        self.requested = {}
+
+    def roi(self, region_of_interest):
+        """
+        :param region_of_interest: (x0, y0, x1, y1) in binned pixels, starting at 1
+        :return: the transaction
+        """
+        self.requested['ROI'] = [int(v) for v in region_of_interest]
+        return self
+
+    def binning(self, h_bin, v_bin):
+        """
+        :param h_bin: binning in horizontal direction, one of 1, 2, 4
+        :param v_bin: binning in vertical direction, one of 1, 2, 4
+        :return: the transaction
+        """
+        if h_bin not in ALLOWED_BINNING or v_bin not in ALLOWED_BINNING:
+            raise UserWarning("Not allowed binning value pair " + str(h_bin) + "x" + str(v_bin))
+        self.requested['binning'] = [int(h_bin), int(v_bin)]
+        return self
+
+    def exposure_time(self, exp_time, base_exposure):
+        """
+        :param exp_time: exposure time in units of the timebase
+        :param base_exposure: timebase, 1 for us, 2 for ms
+        :return: the transaction
+        """
+        if base_exposure not in (1, 2):
+            raise UserWarning("Not accepted time modes")
+        self.requested['Exposure time'] = [int(exp_time), TIMEBASES[base_exposure]]
+        return self
+
+    def delay_time(self, delay, base_delay):
+        """
+        :param delay: delay time in units of the timebase
+        :param base_delay: timebase, 0 for ns, 1 for us, 2 for ms
+        :return: the transaction
+        """
+        if base_delay not in TIMEBASES:
+            raise UserWarning("Not accepted time modes")
+        self.requested['Delay time'] = [int(delay), TIMEBASES[base_delay]]
+        return self
+
+    def timestamp_mode(self, mode):
+        """
+        :param mode: 0 off, 1 binary, 2 binary and ascii, 3 ascii, see pco_timestamp
+        :return: the transaction
+        """
+        if mode not in TIMESTAMP_MODES:
+            raise UserWarning("Not accepted timestamp mode " + str(mode))
+        self.requested['Timestamp mode'] = int(mode)
+        return self
+
+    def _clip_roi(self, roi, binning):
+        x_max = self.camera.h_max//binning[0]
+        y_max = self.camera.v_max//binning[1]
+        x0, x1 = sorted((min(max(roi[0], 1), x_max), min(max(roi[2], 1), x_max)))
+        y0, y1 = sorted((min(max(roi[1], 1), y_max), min(max(roi[3], 1), y_max)))
+        return [x0, y0, x1, y1]
+
+    def changes(self):
+        """
+        :return: dictionary of the requested settings that differ from the current ones
+        """
+        state = self.camera.state
+        current = dict((key, state.get(key)) for key in set(self.requested) | {'ROI', 'binning'})
+        binning = self.requested.get('binning', current['binning'])
+        requested = dict(self.requested)
+        if 'ROI' in requested or binning != current['binning']:
+            # the roi is given in binned pixels, it has to fit the new format
+            requested['ROI'] = self._clip_roi(requested.get('ROI', current['ROI']), binning)
+        return dict((key, value) for key, value in requested.items() if current.get(key) != value)
+
+    def _apply(self, key, value, settings):
+        camera = self.camera
+        dll = camera.PixFlyDLL
+        if key == 'binning':
+            ret = dll.PCO_SetBinning(camera.hCam, ctypes.c_uint16(value[0]), ctypes.c_uint16(value[1]))
+        elif key == 'ROI':
+            ret = dll.PCO_SetROI(camera.hCam, *[ctypes.c_uint16(v) for v in value])
+        elif key == 'Timestamp mode':
+            ret = dll.PCO_SetTimestampMode(camera.hCam, ctypes.c_uint16(value))
+        else:
+            bases = dict((unit, base) for base, unit in TIMEBASES.items())
+            delay, exposure = settings['Delay time'], settings['Exposure time']
+            key, value = 'delay/exposure time', (delay, exposure)
+            ret = dll.PCO_SetDelayExposureTime(camera.hCam, ctypes.c_uint32(delay[0]),
+                                               ctypes.c_uint32(exposure[0]),
+                                               ctypes.c_uint16(bases[delay[1]]),
+                                               ctypes.c_uint16(bases[exposure[1]]))
+        if ret != 0:
+            raise UserWarning("Camera rejected %s %s, error %s" % (key, value, hex(ret & 0xffffffff)))
+
+    def _apply_all(self, changes, settings):
+        """
+        Apply the changes in order: binning before the roi, that is given in binned pixels, exposure and
+        delay time in one call, then the timestamp mode.
+        :return: None
+        """
+        for key in ('binning', 'ROI'):
+            if key in changes:
+                self._apply(key, changes[key], settings)
+        if 'Exposure time' in changes or 'Delay time' in changes:
+            self._apply('times', None, settings)
+        if 'Timestamp mode' in changes:
+            self._apply('Timestamp mode', changes['Timestamp mode'], settings)
+
+    def commit(self):
+        """
+        Apply the changed settings and arm the camera once.
+        :return: dictionary of the settings that were changed
+        """
+        camera = self.camera
+        changes = self.changes()
+        was_armed = camera.armed
+        arm = was_armed if self.arm is None else self.arm
+        times_only = all(key in TIME_KEYS for key in changes)
+        if not times_only and camera.engine.running:
+            raise UserWarning("Cannot configure the camera during an acquisition.")
+        if not times_only and camera.armed:
+            camera.disarm_camera()
+        previous = dict((key, camera.state.params[key]) for key in changes)
+        settings = dict(camera.state.params)
+        settings.update(changes)
+        try:
+            self._apply_all(changes, settings)
+        except UserWarning:
+            # restore the settings the camera had before the transaction, if they are known
+            restore = dict((key, value) for key, value in previous.items()
+                           if key in ('binning', 'ROI', 'Timestamp mode') or value[1] in TIMEBASES.values())
+            try:
+                self._apply_all(restore, camera.state.params)
+            finally:
+                if was_armed and not camera.armed:
+                    camera.arm_camera()
+            raise
+        camera.state.store(changes)
+        if changes and times_only and camera.armed and not camera.state.recording:
+            camera.PixFlyDLL.PCO_ArmCamera(camera.hCam)
+        if 'ROI' in changes or 'binning' in changes:
+            # the actual image size is known after the next arm
+            camera.state.invalidate('Camera ROI dimensions')
+        if self.verbose:
+            for key, value in changes.items():
+                print(key, ':', previous[key], '->', value)
+        if changes and camera.state.verify:
+            for key, (cached, value) in camera.state.check(*changes).items():
+                print('Camera adjusted', key, ':', cached, '->', value)
+        if arm and not camera.armed:
+            camera.arm_camera()
+        elif not arm and camera.armed:
+            camera.disarm_camera()
+        return changes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+
+
+class CameraState(object):
+    """
+    CameraState mirrors the settings of the camera in the process, so that
+    reading them needs no DLL call: ROI, binning, exposure and delay time
+    with their timebases, the timestamp mode, the actual image size of the
+    last arm and the armed and recording flags. The settings are kept in params with the keys
+    of PixelFly.set_params. Invalidation rules:
+     -- open_camera, close_camera, reset_settings and reboot_camera
+        invalidate all settings; open_camera reads them back once
+     -- a committed ConfigTransaction stores the values it wrote, and
+        invalidates the image size until the next arm
+     -- arm_camera stores the image size it gets with PCO_GetSizes
+    An invalid setting is read from the camera the next time it is asked
+    for with get(). Functions in listeners are called with the keys of the
+    settings that were stored or invalidated, e.g. to drop what depends on
+    them (see pco_calibration.CalibrationCache). With verify True, the values written by a transaction are
+    read back and compared: mismatches are printed and the values of the
+    camera are kept.
+    """
+    KEYS = ('ROI', 'binning', 'Exposure time', 'Delay time', 'Timestamp mode', 'Camera ROI dimensions')
+
+    def __init__(self, camera, verify=False):
+        """
+        :param camera: PixelFly instance
+        :param verify: True to read back and compare the written settings
+        """
+        self.camera = camera
+        self.verify = verify
+        self.params = {'ROI': [1, 1, camera.h_max, camera.v_max],
+                       'binning': [1, 1],
+                       'Exposure time': [0, '0'],
+                       'Delay time': [0, 'ns'],
+                       'Timestamp mode': 0,
+                       'Camera ROI dimensions': [0, 0]}
+        self.valid = set()
+        self.armed = False
+        self.recording = False
+        self.listeners = []
+
+    def invalidate(self, *keys):
+        """
+        :param keys: settings to invalidate, all if none is given
+        :return: None
+        """
+        keys = keys if keys else self.KEYS
+        self.valid.difference_update(keys)
+        for listener in self.listeners:
+            listener(keys)
+
+    def store(self, values):
+        """
+        Store settings known to be on the camera, e.g. after they were written.
+        :param values: dictionary of settings
+        :return: None
+        """
+        self.params.update(values)
+        self.valid.update(values)
+        for listener in self.listeners:
+            listener(tuple(values))
+
+    def get(self, key):
+        """
+        :param key: one of KEYS
+        :return: the setting, read from the camera only if the cached value is invalid
+        """
+        if key not in self.valid:
+            self.read(key)
+        return self.params[key]
+
+    def read(self, *keys):
+        """
+        Read settings from the camera and store them.
+        :param keys: settings to read, all if none is given
+        :return: dictionary of the settings read
+        """
+        camera, dll = self.camera, self.camera.PixFlyDLL
+        keys = keys if keys else self.KEYS
+        values = {}
+        if 'ROI' in keys:
+            roi = [ctypes.c_uint16() for i in range(4)]
+            dll.PCO_GetROI(camera.hCam, *[ctypes.byref(v) for v in roi])
+            values['ROI'] = [v.value for v in roi]
+        if 'binning' in keys:
+            binning = [ctypes.c_uint16() for i in range(2)]
+            dll.PCO_GetBinning(camera.hCam, *[ctypes.byref(v) for v in binning])
+            values['binning'] = [v.value for v in binning]
+        if 'Exposure time' in keys or 'Delay time' in keys:
+            dwDelay, dwExposure = ctypes.c_uint32(), ctypes.c_uint32()
+            wTimeBaseDelay, wTimeBaseExposure = ctypes.c_uint16(), ctypes.c_uint16()
+            dll.PCO_GetDelayExposureTime(camera.hCam, ctypes.byref(dwDelay), ctypes.byref(dwExposure),
+                                         ctypes.byref(wTimeBaseDelay), ctypes.byref(wTimeBaseExposure))
+            values['Exposure time'] = [dwExposure.value, TIMEBASES[wTimeBaseExposure.value]]
+            values['Delay time'] = [dwDelay.value, TIMEBASES[wTimeBaseDelay.value]]
+        if 'Timestamp mode' in keys:
+            mode = ctypes.c_uint16()
+            dll.PCO_GetTimestampMode(camera.hCam, ctypes.byref(mode))
+            values['Timestamp mode'] = mode.value
+        if 'Camera ROI dimensions' in keys:
+            sizes = [ctypes.c_uint16() for i in range(4)]
+            dll.PCO_GetSizes(camera.hCam, *[ctypes.byref(v) for v in sizes])
+            values['Camera ROI dimensions'] = [sizes[0].value, sizes[1].value]
+        self.store(values)
+        return values
+
+    def check(self, *keys):
+        """
+        Compare the cached settings with the camera. The values of the camera are kept.
+        :param keys: settings to compare, all if none is given
+        :return: dictionary of the mismatches {key: (cached, camera)}
+        """
+        cached = dict((key, self.params[key]) for key in (keys if keys else self.KEYS))
+        values = self.read(*cached.keys())
+        return dict((key, (cached[key], values[key])) for key in cached if values[key] != cached[key])
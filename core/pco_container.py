@@ -0,0 +1,270 @@
+__author__ = 'Polychronis Patapis'
+import json
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from QtGUI.core.pco_acquisition import FrameSink
+
+# Container file layout (all numbers little endian):
+#  -- MAGIC, header length (uint32), JSON header (shape, dtype, compression, metadata)
+#  -- one record per frame: RECORD struct (tag, sequence number, payload length, crc32 of
+#     the payload, bit shift) followed by the compressed payload
+#  -- on close: INDEX tag, index length (uint32), JSON index (offsets, sequence numbers, host
+#     times and camera times of the records) and TRAILER struct (offset of the index, end tag)
+# The index speeds up opening and holds the frame times: a file without it (e.g. after a
+# crash) is read by scanning the records, without times, and appending to a file replaces
+# its index.
+MAGIC = b'PCOFRAMES1\n'
+RECORD = struct.Struct('<4sqIIB')
+RECORD_TAG = b'FRME'
+INDEX_TAG = b'INDX'
+TRAILER = struct.Struct('<Q4s')
+END_TAG = b'END!'
+
+
+def encode_frame(frame, level=1):
+    """
+    Lossless compression of a uint16 frame. Frames with the 14 bit data in the
+    upper bits are shifted down by 2 bits, then rows are delta encoded, the low
+    and high bytes are split in two planes and the result is deflated.
+    :param frame: 2d uint16 array
+    :param level: zlib compression level
+    :return: (payload bytes, bit shift)
+    """
+    shift = 0 if np.any(frame & 3) else 2
+    data = frame >> shift if shift else np.array(frame)
+    delta = np.empty_like(data)
+    delta[:, 0] = data[:, 0]
+    np.subtract(data[:, 1:], data[:, :-1], out=delta[:, 1:])
+    planes = delta.view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(np.ascontiguousarray(planes), level), shift
+
+
+def decode_frame(payload, shift, shape):
+    """
+    Inverse of encode_frame.
+    :param payload: compressed bytes
+    :param shift: bit shift of the frame
+    :param shape: (y-resolution, x-resolution) of the frame
+    :return: 2d uint16 array
+    """
+    planes = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(2, -1)
+    delta = np.ascontiguousarray(planes.T).view(np.uint16).reshape(shape)
+    data = np.cumsum(delta, axis=1, dtype=np.uint16)
+    if shift:
+        data <<= shift
+    return data
+
+
+class FrameContainer(FrameSink):
+    """
+    FrameContainer writes frames to a chunked container file with one
+    compressed chunk per frame and an appendable frame axis. Frames are
+    compressed by a pool of worker threads and written in order by the
+    thread that appends them, at most max_pending frames are in flight.
+    """
+
+    def __init__(self, file_name, metadata=None, level=1, num_workers=2, max_pending=8, append=False):
+        """
+        :param file_name: path of the container file
+        :param metadata: dictionary stored in the header, e.g. exposure time, ROI and binning
+        :param level: zlib compression level
+        :param num_workers: number of compression threads
+        :param max_pending: maximum number of frames waiting for compression
+        :param append: True to append frames to an existing container
+        """
+        self.file_name = file_name
+        self.metadata = metadata if metadata is not None else {}
+        self.level = level
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.append_mode = append
+        self.file = None
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    def open(self, shape):
+        self.shape = tuple(shape)
+        if self.append_mode and os.path.isfile(self.file_name):
+            reader = ContainerReader(self.file_name)
+            if reader.shape != self.shape:
+                raise UserWarning("Frame shape %s does not match container %s" % (self.shape, reader.shape))
+            self.offsets, self.seq = list(reader.offsets), list(reader.seq)
+            self.times, self.camera_times = list(reader.times), list(reader.camera_times)
+            end = reader.data_end
+            reader.close()
+            self.file = open(self.file_name, 'r+b')
+            self.file.truncate(end)  # the index is rewritten on close
+            self.file.seek(end)
+        else:
+            self.offsets, self.seq, self.times, self.camera_times = [], [], [], []
+            header = json.dumps({'shape': list(self.shape), 'dtype': '<u2', 'compression': 'zlib',
+                                 'filters': ['shift14', 'delta', 'byteshuffle'],
+                                 'metadata': self.metadata}).encode()
+            self.file = open(self.file_name, 'wb')
+            self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.pool = ThreadPoolExecutor(max_workers=self.num_workers)
+        self.pending = deque()
+
+    def _write(self, seq, timestamp, camera_time, future):
+        payload, shift = future.result()
+        self.offsets.append(self.file.tell())
+        self.seq.append(seq)
+        self.times.append(timestamp)
+        self.camera_times.append(camera_time)
+        self.file.write(RECORD.pack(RECORD_TAG, seq, len(payload), zlib.crc32(payload), shift))
+        self.file.write(payload)
+        self.compressed_bytes += len(payload)
+
+    def append(self, frame, seq=None, timestamp=None, camera_time=None):
+        """
+        Append a frame to the container.
+        :param frame: 2d uint16 array of the container frame shape
+        :param seq: sequence number of the frame, by default its position in the container
+        :param timestamp: host time of the frame in seconds since the epoch, by default the current time
+        :param camera_time: camera time of the frame in seconds since the epoch
+        :return: None
+        """
+        if seq is None:
+            seq = len(self.seq) + len(self.pending)
+        # write the frames that are compressed, in order, and bound the frames in flight
+        while self.pending and (self.pending[0][-1].done() or len(self.pending) >= self.max_pending):
+            self._write(*self.pending.popleft())
+        if timestamp is None:
+            timestamp = time.time()
+        self.pending.append((seq, timestamp, camera_time,
+                             self.pool.submit(encode_frame, np.array(frame), self.level)))
+        self.raw_bytes += frame.nbytes
+
+    def put(self, frame):
+        self.append(frame.array, frame.seq, frame.time, frame.camera_time)
+
+    def close(self):
+        if self.file is None:
+            return
+        while self.pending:
+            self._write(*self.pending.popleft())
+        self.pool.shutdown(wait=True)
+        index_offset = self.file.tell()
+        index = json.dumps({'offsets': self.offsets, 'seq': self.seq, 'times': self.times,
+                            'camera times': self.camera_times}).encode()
+        self.file.write(INDEX_TAG + struct.pack('<I', len(index)) + index)
+        self.file.write(TRAILER.pack(index_offset, END_TAG))
+        self.file.close()
+        self.file = None
+
+    def compression_ratio(self):
+        """
+        :return: raw size over compressed size of the frames written so far
+        """
+        if self.compressed_bytes == 0:
+            return 0.
+        return self.raw_bytes/self.compressed_bytes
+
+
+class ContainerReader(object):
+    """
+    Random access to the frames of a container file. Frames are decompressed
+    when they are indexed. seq, times and camera_times list the sequence
+    number, host time and camera time of every frame, the times are None if
+    they are unknown.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: path of the container file
+        """
+        self.file_name = file_name
+        self.file = open(file_name, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise UserWarning(file_name + " is not a frame container")
+        header_len, = struct.unpack('<I', self.file.read(4))
+        header = json.loads(self.file.read(header_len).decode())
+        self.shape = tuple(header['shape'])
+        self.metadata = header['metadata']
+        self.data_start = self.file.tell()
+        if not self._read_index():
+            self._scan()
+
+    def _read_index(self):
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        if size < self.data_start + TRAILER.size:
+            return False
+        self.file.seek(size - TRAILER.size)
+        index_offset, tag = TRAILER.unpack(self.file.read(TRAILER.size))
+        if tag != END_TAG:
+            return False
+        self.file.seek(index_offset)
+        if self.file.read(4) != INDEX_TAG:
+            return False
+        index_len, = struct.unpack('<I', self.file.read(4))
+        index = json.loads(self.file.read(index_len).decode())
+        self.offsets, self.seq = index['offsets'], index['seq']
+        self.times = index.get('times', [None]*len(self.offsets))
+        self.camera_times = index.get('camera times', [None]*len(self.offsets))
+        self.data_end = index_offset
+        return True
+
+    def _scan(self):
+        self.offsets, self.seq = [], []
+        offset = self.data_start
+        self.file.seek(offset)
+        while True:
+            record = self.file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                break
+            tag, seq, length, crc, shift = RECORD.unpack(record)
+            if tag != RECORD_TAG:
+                break
+            payload = self.file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break  # truncated last frame
+            self.offsets.append(offset)
+            self.seq.append(seq)
+            offset += RECORD.size + length
+        self.times = [None]*len(self.offsets)
+        self.camera_times = [None]*len(self.offsets)
+        self.data_end = offset
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        self.file.seek(self.offsets[i])
+        tag, seq, length, crc, shift = RECORD.unpack(self.file.read(RECORD.size))
+        return decode_frame(self.file.read(length), shift, self.shape)
+
+    def frames(self):
+        """
+        Iterate over the frames in order.
+        """
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self.file.close()
+
+
+def to_fits(container_name, fits_name):
+    """
+    Offline conversion of a container to a FITS file with the stack in the primary HDU.
+    The frames are streamed, so the conversion needs the memory of a single frame.
+    :param container_name: path of the container file
+    :param fits_name: path of the FITS file
+    :return: None
+    """
+    from QtGUI.core.pco_fits import FitsStreamWriter
+    reader = ContainerReader(container_name)
+    writer = FitsStreamWriter(fits_name, reader.metadata)
+    writer.open(reader.shape)
+    try:
+        for i, frame in enumerate(reader.frames()):
+            writer.append(frame, reader.seq[i], reader.times[i], reader.camera_times[i])
+    finally:
+        writer.close()
+        reader.close()
@@ -1,32 +1,42 @@
 __author__ = 'Polychronis Patapis'
 import ctypes
 import os
-import time, queue
+import time
 import numpy as np
-import threading
-
-
-libc = ctypes.cdll.msvcrt
-libc.fopen.restype = ctypes.c_void_p
+from QtGUI.core.pco_backend import DLLBackend
+from QtGUI.core.pco_acquisition import AcquisitionEngine, FrameRingSink, RingSink, CallbackSink
+from QtGUI.core.pco_ring import FrameRing
+from QtGUI.core.pco_recorder import StreamRecorder
+from QtGUI.core.pco_stack import open_stack
+from QtGUI.core.pco_container import FrameContainer
+from QtGUI.core.pco_fits import FitsStreamWriter
+from QtGUI.core.pco_stats import FrameStatistics
+from QtGUI.core.pco_accumulator import FrameAccumulator
+from QtGUI.core.pco_config import ConfigTransaction, CameraState
+from QtGUI.core.pco_buffers import BufferPool
+from QtGUI.core.pco_timestamp import TIMESTAMP_MODES
+from QtGUI.core.pco_calibration import CalibrationCache
 
 
 class PixelFly(object):
     """
     PixelFly class loads the pf_cam.dll in order to interface
     the basic functions of the pco.pixelfly ccd detector.
+    Instead of the dll any SC2CamBackend can be passed, e.g. the
+    SimulatedBackend to run without camera hardware.
     """
 
-    def __init__(self, dllpath='C:\\Users\\Admin\\Desktop\\pco_pixelfly'):
+    def __init__(self, dllpath='C:\\Users\\Admin\\Desktop\\pco_pixelfly', backend=None):
         # Load dynamic link library
         self.DLLpath = dllpath + '\\SC2_Cam.dll'
-        self.PixFlyDLL = ctypes.windll.LoadLibrary(self.DLLpath)
+        if backend is None:
+            backend = DLLBackend(self.DLLpath)
+        self.PixFlyDLL = backend
         # initialize board number, by default 0
         self.board = 0
         # initialize handles and structs
-        self.hCam = ctypes.c_int()
-        self.bin = 1
-        self.v_max = 1040
-        self.h_max = 1392
+        self.hCam = ctypes.c_void_p()  # HANDLE
+        self.h_max, self.v_max = self.PixFlyDLL.sensor_size
         self.wXResAct = ctypes.c_uint16()
         self.wYResAct = ctypes.c_uint16()
 
@@ -39,19 +49,53 @@ class PixelFly(object):
         # Set all buffer size parameters
 
         self.time_modes = {1: "us", 2: "ms"}
-        self.set_params = {'ROI': [1, 1, self.h_max, self.v_max],
-                           'binning': [1, 1],
-                           'Exposure time': [0, '0'],
-                           'Camera ROI dimensions': [0, 0]}
-        self.armed = False
+        # settings, actual image size and armed/recording flags of the camera, see pco_config.CameraState
+        self.state = CameraState(self)
+        # the 14 bit counts are in the upper bits of the 16 bit words of the camera. The acquisition
+        # shifts them down in place, so frames stay uint16 from the driver buffer to the files.
+        self.bit_shift = 2
+        # 'event' blocks on the buffer events of the driver, 'poll' polls the buffer status
+        self.wait_mode = 'event'
+        # maximum time in seconds to wait for a buffer in 'event' mode
+        self.buffer_timeout = 5.0
         self.buffer_numbers = []
         self.buffer_pointers, self.buffer_events = (
              [], [])
+        # driver buffers, sized from frame size, frame rate and latency budget
+        self.buffers = BufferPool(self)
 
         self.out = 0
-        # Queues that hold the data collected in the camera.
-        self.q = queue.Queue(maxsize=2)
-        self.q_m = queue.Queue(maxsize=2)
+        # acquisition loop shared by all recording modes
+        self.engine = AcquisitionEngine(self)
+        # Ring that holds the live frames collected in the camera, created by record_to_memory_2.
+        self.ring = None
+        self.ring_capacity = 4
+        # overflow policy of the ring: 'drop-oldest', 'drop-newest' or 'block'
+        self.ring_policy = 'drop-oldest'
+        # statistics of the live frames, rois and lines are registered by the GUI
+        self.statistics = FrameStatistics(bins=1024, stride=2)
+        # additional sinks of the live frames, e.g. a pco_server.FrameServer or a CallbackSink
+        self.live_sinks = []
+        # master dark and flat frames by settings; with calibrate True the acquisition applies the ones of
+        # the current settings to every frame
+        self.calibrations = CalibrationCache(self)
+        self.calibrate = False
+
+    @property
+    def set_params(self):
+        """
+        Settings of the camera cached by self.state, keyed by 'ROI', 'binning', 'Exposure time', 'Delay time'
+        and 'Camera ROI dimensions'.
+        """
+        return self.state.params
+
+    @property
+    def armed(self):
+        return self.state.armed
+
+    @armed.setter
+    def armed(self, value):
+        self.state.armed = value
 
     def open_camera(self):
         """
@@ -64,9 +108,6 @@ class PixelFly(object):
 
         # opencamera is the instance of OpenCamera method in DLL
         opencamera = self.PixFlyDLL.PCO_OpenCamera
-        # PCO_OpenCamera(HANDLE *hCam, int board_num), return int
-        opencamera.argtypes = (ctypes.POINTER(ctypes.c_int), ctypes.c_int)
-        opencamera.restype = ctypes.c_int
         # return 0 if success, <0 if error
         ret_code = opencamera(self.hCam, self.board)
 
@@ -78,6 +119,9 @@ class PixelFly(object):
             return False
         elif ret_code == 0:
             print('Camera Connected!')
+            # the camera may keep settings of an earlier session, read them once
+            self.state.invalidate()
+            self.state.read()
             return True
         else:
             return False
@@ -87,9 +131,16 @@ class PixelFly(object):
         close_camera tries to close the connected camera with handle hCam.
         :return: True if success and False if unaible to close the camera
         """
+        # stop recording, then free the buffers that are kept allocated between acquisitions
+        if self.armed:
+            self.disarm_camera()
+        if len(self.buffers):
+            self.buffers.free()
         # closecamera is an instance of the CloseCamera function of the DLL
         # call function and expect 0 if success, <0 if error
         ret_code = self.PixFlyDLL.PCO_CloseCamera(self.hCam)
+        self.state.invalidate()
+        self.state.armed, self.state.recording = False, False
 
         if ret_code == 0:
             return True
@@ -100,7 +151,7 @@ class PixelFly(object):
         """
         Set region of interest window. The ROI must be smaller or
         equal to the absolute image area which is defined by the
-        format h_max, v_max and the binning bin.
+        format h_max, v_max and the binning, it is adjusted otherwise.
         :param region_of_interest: tuple of (x0,y0,x1,y1)
         :param verbose: True if the process should be printed
         :return: None
@@ -108,72 +159,38 @@ class PixelFly(object):
         x0, y0, x1, y1 = tuple(region_of_interest)
         if verbose:
             print("ROI requested :",x0, y0, x1, y1)
-        # max ROI depends on the format and the binning
-        x_max = self.h_max/self.bin
-        y_max = self.v_max/self.bin
-
-        # check that ROI is within allowed borders
-        restriction = ((x0 > 1) and (y0 > 1) and (x1 < x_max) and (y1 < y_max))
-
-        if not restriction:
-            if verbose:
-                print("Adjusting ROI..")
-            if x0 < 1:
-                x0 = 1
-            if x1 > x_max:
-                x1 = x_max
-            if y0 < 1:
-                y0 = 1
-            if y1 > y_max:
-                y1 = y_max
-            if x1 < x0 :
-                x0 , x1 = x1, x0
-            if y1 < y0:
-                y0, y1 = y1, y0
-
-        # pass values to ctypes variables
-        wRoiX0 = ctypes.c_uint16(int(x0))
-        wRoiY0 = ctypes.c_uint16(int(y0))
-        wRoiX1 = ctypes.c_uint16(int(x1))
-        wRoiY1 = ctypes.c_uint16(int(y1))
-
-        if verbose:
             print("Setting ROI..")
-        self.PixFlyDLL.PCO_SetROI(self.hCam, wRoiX0, wRoiY0, wRoiX1, wRoiY1)
-        self.PixFlyDLL.PCO_GetROI(self.hCam,
-                                  ctypes.byref(wRoiX0), ctypes.byref(wRoiY0),
-                                  ctypes.byref(wRoiX1), ctypes.byref(wRoiY1))
-
+        self.configure().roi(region_of_interest).commit()
         if verbose:
+            x0, y0, x1, y1 = self.set_params['ROI']
             print("ROI :")
-            print("From pixel ", wRoiX0.value)
-            print("to pixel ", wRoiX1.value, "(left/right")
-            print("From pixel ", wRoiY0.value)
-            print("to pixel ", wRoiY1.value, "(up/down")
-
-        self.set_params['ROI']=[wRoiX0.value, wRoiY0.value, wRoiX1.value, wRoiY1.value]
-
+            print("From pixel ", x0)
+            print("to pixel ", x1, "(left/right")
+            print("From pixel ", y0)
+            print("to pixel ", y1, "(up/down")
         return None
 
     def binning(self, h_bin, v_bin):
         """
         binning allows for Binning pixels in h_bin x v_bin
-        Allowed values in {1,2,4,8,16,32}
+        Allowed values in {1,2,4}
         :param h_bin: binning in horizontal direction
-        :param v_bin:
+        :param v_bin: binning in vertical direction
         :return: None
         """
-        allowed = [1, 2, 4]
-        wBinHorz = ctypes.c_uint16(int(h_bin))
-        wBinVert = ctypes.c_uint16(int(v_bin))
-        if (h_bin in allowed) and (v_bin in allowed):
-            self.PixFlyDLL.PCO_SetBinning(self.hCam, wBinHorz, wBinVert)
-            self.PixFlyDLL.PCO_GetBinning(self.hCam, ctypes.byref(wBinHorz),
-                                          ctypes.byref(wBinVert))
-            self.set_params['binning']=[wBinHorz.value, wBinVert.value]
-        else:
-            raise UserWarning("Not allowed binning value pair " + str(h_bin)
-                              + "x" + str(v_bin))
+        self.configure().binning(h_bin, v_bin).commit()
+        return None
+
+    def timestamp_mode(self, mode):
+        """
+        Sets the timestamp the camera writes in the first pixels of every frame
+        0 off, 1 binary, 2 binary and ascii, 3 ascii
+        With a binary timestamp the acquisition tags the frames with the image counter and time of the
+        camera and detects the frames lost between camera and driver, see pco_timestamp.
+        :param mode: timestamp mode
+        :return: None
+        """
+        self.configure().timestamp_mode(mode).commit()
         return None
 
     def exposure_time(self, exp_time, base_exposure, verbose=True):
@@ -188,49 +205,103 @@ class PixelFly(object):
         :param verbose: True if process should be printed
         :return: None
         """
-        # check for allowed values
-        if not(base_exposure in [1, 2]):
-            raise UserWarning("Not accepted time modes")
-
-        # pass values to ctypes variables
-        dwDelay = ctypes.c_uint32(0)
-        dwExposure = ctypes.c_uint32(int(exp_time))
-        wTimeBaseDelay = ctypes.c_uint16(0)
-        wTimeBaseExposure = ctypes.c_uint16(int(base_exposure))
-
         if verbose:
             print('Setting exposure time/delay..')
-        # set exposure time and delay time
-        self.PixFlyDLL.PCO_SetDelayExposureTime(self.hCam,
-                                                dwDelay, dwExposure,
-                                                wTimeBaseDelay, wTimeBaseExposure)
-        self.PixFlyDLL.PCO_GetDelayExposureTime(self.hCam, ctypes.byref(dwDelay),
-                                                ctypes.byref(dwExposure),
-                                                ctypes.byref(wTimeBaseDelay),
-                                                ctypes.byref(wTimeBaseExposure))
-
-        self.set_params['Exposure time'] = [dwExposure.value, self.time_modes[wTimeBaseExposure.value]]
-
+        self.configure().exposure_time(exp_time, base_exposure).delay_time(0, 0).commit()
         return None
 
     def get_exposure_time(self):
         """
-        Get exposure time of the camera.
+        Get exposure time of the camera. The value is taken from the state cache, the camera is only
+        asked if the cached value is invalid.
         :return: exposure time, units
         """
-        # pass values to ctypes variables
-        dwDelay = ctypes.c_uint32(0)
-        dwExposure = ctypes.c_uint32(0)
-        wTimeBaseDelay = ctypes.c_uint16(0)
-        wTimeBaseExposure = ctypes.c_uint16(0)
+        return list(self.state.get('Exposure time'))
 
-        # get exposure time
-        self.PixFlyDLL.PCO_GetDelayExposureTime(self.hCam, ctypes.byref(dwDelay),
-                                                ctypes.byref(dwExposure),
-                                                ctypes.byref(wTimeBaseDelay),
-                                                ctypes.byref(wTimeBaseExposure))
+    def metadata(self):
+        """
+        Camera settings that are stored with recorded frames.
+        :return: dictionary with exposure time, ROI, binning, timestamp mode and the calibration applied
+        """
+        exp_time, unit = self.state.get('Exposure time')
+        calibration = self.calibrations.current() if self.calibrate else None
+        return {'EXPTIME': '%s %s' % (exp_time, unit),
+                'ROI': list(self.state.get('ROI')),
+                'BINNING': list(self.state.get('binning')),
+                'TSMODE': TIMESTAMP_MODES[self.state.get('Timestamp mode')],
+                'CALIB': 'none' if calibration is None else calibration.describe()}
 
-        return [dwExposure.value, self.time_modes[wTimeBaseExposure.value]]
+    def configure(self, arm=None, verbose=False):
+        """
+        Start a configuration transaction, see pco_config.ConfigTransaction. The ROI, binning, exposure and
+        delay time collected by the transaction are applied together on commit, with a single arm.
+        :param arm: True to arm the camera after the changes, False to leave it disarmed, None to arm it
+        only if it was armed before
+        :param verbose: True if the changes should be printed
+        :return: ConfigTransaction
+        """
+        return ConfigTransaction(self, arm, verbose)
+
+    def coc_runtime(self):
+        """
+        Time the camera needs for one frame with the armed settings, exposure and readout.
+        :return: frame period in seconds
+        """
+        if not self.armed:
+            raise UserWarning("Camera must be armed to get the runtime.")
+        dwTime_s, dwTime_ns = ctypes.c_uint32(), ctypes.c_uint32()
+        self.PixFlyDLL.PCO_GetCOCRuntime(self.hCam, ctypes.byref(dwTime_s), ctypes.byref(dwTime_ns))
+        return dwTime_s.value + dwTime_ns.value*1e-9
+
+    def autotune(self, target_fps, region=None, binnings=(1, 2, 4), verbose=True):
+        """
+        Find the ROI and binning with the finest binning that cover the required region and reach the
+        target frame rate. The combinations are tried from the finest to the coarsest binning (vertical
+        binning first, it shortens the readout most): each is set and the camera armed in one configuration
+        transaction, and the frame period is queried with PCO_GetCOCRuntime. The first one that reaches the
+        target is kept, if none does the fastest is kept.
+        The camera is left disarmed.
+        :param target_fps: required frame rate in frames per second
+        :param region: required region (x0, y0, x1, y1) in unbinned sensor pixels, by default the full sensor
+        :param binnings: allowed binning values in each direction
+        :param verbose: True if the process should be printed
+        :return: dictionary with the ROI, binning, frame rate, frame period, bandwidth in MB/s at the target
+        frame rate and the latency of a frame in seconds (upper bound: exposure time plus frame period)
+        """
+        if self.armed:
+            raise UserWarning("Camera must be disarmed to change ROI and binning.")
+        x0, y0, x1, y1 = region if region is not None else (1, 1, self.h_max, self.v_max)
+        candidates = sorted([(h, v) for h in binnings for v in binnings], key=lambda b: (b[0]*b[1], b[0]))
+        best = None
+        for h_bin, v_bin in candidates:
+            # smallest binned ROI that covers the region
+            roi = [(x0 - 1)//h_bin + 1, (y0 - 1)//v_bin + 1,
+                   min(-(-x1//h_bin), self.h_max//h_bin), min(-(-y1//v_bin), self.v_max//v_bin)]
+            self.configure(arm=True).binning(h_bin, v_bin).roi(roi).commit()
+            period = self.coc_runtime()
+            size = self.state.get('Camera ROI dimensions')
+            self.disarm_camera()
+            if verbose:
+                print("Binning %ix%i, ROI %s: %.1f fps" % (h_bin, v_bin, roi, 1./period))
+            if best is None or period < best[0]:
+                best = (period, (h_bin, v_bin), roi, size)
+            if 1./period >= target_fps:
+                best = (period, (h_bin, v_bin), roi, size)
+                break
+        period, (h_bin, v_bin), roi, size = best
+        if 1./period < target_fps:
+            print("Target of %.1f fps not reached, fastest setting gives %.1f fps" % (target_fps, 1./period))
+        self.configure(arm=False).binning(h_bin, v_bin).roi(roi).commit()
+        exp_time, unit = self.get_exposure_time()
+        exposure = exp_time*{'us': 1e-6, 'ms': 1e-3}[unit]
+        frame_bytes = size[0]*size[1]*2
+        result = {'ROI': roi, 'binning': [h_bin, v_bin], 'frame rate': 1./period,
+                  'frame period': period,
+                  'bandwidth MB/s': min(target_fps, 1./period)*frame_bytes/2**20,
+                  'latency': exposure + period}
+        if verbose:
+            print(result)
+        return result
 
     def arm_camera(self):
         """
@@ -251,53 +322,37 @@ class PixelFly(object):
         self.PixFlyDLL.PCO_GetSizes(self.hCam, ctypes.byref(self.wXResAct),
                                     ctypes.byref(self.wYResAct), ctypes.byref(wXResMax),
                                     ctypes.byref(wYResMax))
-        self.set_params['Camera ROI dimensions'] = [self.wXResAct.value,
-                                                    self.wYResAct.value]
+        self.state.store({'Camera ROI dimensions': [self.wXResAct.value, self.wYResAct.value]})
         self.armed = True
         return None
 
     def disarm_camera(self):
         """
-        Disarm camera, free allocated buffers and set
-        recording to 0
+        Disarm camera, remove the buffers from the driver queue and set
+        recording to 0. The buffers stay allocated for the next acquisition,
+        see pco_buffers.BufferPool, close_camera frees them.
         :return:
         """
         # set recording state to 0
         wRecState = ctypes.c_uint16(0)
         self.PixFlyDLL.PCO_SetRecordingState(self.hCam, wRecState)
-        # free all allocated buffers
-        self.PixFlyDLL.PCO_RemoveBuffer(self.hCam)
-        for buf in self.buffer_numbers:
-            self.PixFlyDLL.PCO_FreeBuffer(self.hCam, buf)
-
-        self.buffer_numbers, self.buffer_pointers, self.buffer_events = (
-            [], [], [])
+        # the queue prepared for recording is built again by the next acquisition
+        self.buffers._unprepare()
         self.armed = False
+        self.state.recording = False
         return None
 
-    def allocate_buffer(self, num_buffers=2):
+    def allocate_buffer(self, num_buffers=None, held=0):
         """
-        Allocate buffers for image grabbing
-        :param num_buffers:
-        :return:
+        Allocate buffers for image grabbing, see pco_buffers.BufferPool. Buffers that are already allocated
+        with the right size are kept.
+        :param num_buffers: number of buffers, None to size them from frame size, frame rate and the latency
+        budget of self.buffers
+        :param held: number of additional buffers for consumers that hold frames, e.g. self.ring_capacity for
+        the live view
+        :return: None
         """
-        dwSize = ctypes.c_uint32(self.wXResAct.value*self.wYResAct.value*2)  # 2 bytes per pixel
-        # set buffer variable to []
-        self.buffer_numbers, self.buffer_pointers, self.buffer_events = (
-            [], [], [])
-        # now set buffer variables to correct value and pass them to the API
-        for i in range(num_buffers):
-            self.buffer_numbers.append(ctypes.c_int16(-1))
-            self.buffer_pointers.append(ctypes.c_void_p(0))
-            self.buffer_events.append(ctypes.c_void_p(0))
-            self.PixFlyDLL.PCO_AllocateBuffer(self.hCam, ctypes.byref(self.buffer_numbers[i]),
-                                              dwSize, ctypes.byref(self.buffer_pointers[i]),
-                                              ctypes.byref(self.buffer_events[i]))
-
-        # Tell camera link what actual resolution to expect
-        self.PixFlyDLL.PCO_CamLinkSetImageParameters(
-            self.hCam, self.wXResAct, self.wYResAct)
-
+        self.buffers.allocate(num_buffers, held)
         return None
 
     def start_recording(self):
@@ -305,7 +360,8 @@ class PixelFly(object):
         Start recording
         :return: message from recording status
         """
-        message = self.PixFlyDLL.PCO_SetRecordingState(self.hCam, ctypes.c_int16(1))
+        message = self.PixFlyDLL.PCO_SetRecordingState(self.hCam, ctypes.c_uint16(1))
+        self.state.recording = message == 0
         return message
 
     def _prepare_to_record_to_memory(self):
@@ -318,12 +374,15 @@ class PixelFly(object):
         dwStatusDll, dwStatusDrv = ctypes.c_uint32(), ctypes.c_uint32()
         bytes_per_pixel = ctypes.c_uint32(2)
         pixels_per_image = ctypes.c_uint32(self.wXResAct.value * self.wYResAct.value)
+        # argument tuples of the calls of the acquisition loop, built once per buffer
+        # status outputs as pointer objects, matching the POINTER argtypes of the prototypes
+        status_refs = (ctypes.pointer(dwStatusDll), ctypes.pointer(dwStatusDrv))
+        self._status_args = [(self.hCam, number) + status_refs for number in self.buffer_numbers]
+        self._add_buffer_args = [(self.hCam, dw1stImage, dwLastImage, number, self.wXResAct, self.wYResAct,
+                                  wBitsPerPixel) for number in self.buffer_numbers]
         added_buffers = []
         for which_buf in range(len(self.buffer_numbers)):
-            self.PixFlyDLL.PCO_AddBufferEx(
-                self.hCam, dw1stImage, dwLastImage,
-                self.buffer_numbers[which_buf], self.wXResAct,
-                self.wYResAct, wBitsPerPixel)
+            self.PixFlyDLL.PCO_AddBufferEx(*self._add_buffer_args[which_buf])
             added_buffers.append(which_buf)
 
         # prepare Python data types for receiving data
@@ -337,208 +396,112 @@ class PixelFly(object):
         return None
     
     
-    def record_live(self):
-        if not self.armed:
-            raise UserWarning('Cannot record to memory with disarmed camera')
+    def _wait_for_buffer(self, which_buf, dwStatusDll, dwStatusDrv, poll_timeout=5e7):
+        """
+        Waits until the buffer which_buf leaves the driver queue. In 'event' wait mode the thread
+        sleeps on the buffer event for at most self.buffer_timeout seconds, in 'poll' mode the
+        buffer status is polled every 50 us up to poll_timeout times.
+        :param which_buf: index of the buffer in self.buffer_numbers
+        :param dwStatusDll: ctypes.c_uint32 receiving the dll status of the buffer, the one of
+        self._prepared_to_record that the status arguments are prepared with
+        :param dwStatusDrv: ctypes.c_uint32 receiving the driver status of the buffer, as dwStatusDll
+        :param poll_timeout: how many tries the driver does to poll a frame ('poll' mode)
+        :return: number of status queries, None if timed out
+        """
+        get_buffer_status = self.PixFlyDLL.PCO_GetBufferStatus
+        status_args = self._status_args[which_buf]
+        num_polls = 0
+        deadline = time.perf_counter() + self.buffer_timeout
+        while True:
+            num_polls += 1
+            get_buffer_status(*status_args)
+            if dwStatusDll.value == 0xc0008000:
+                return num_polls
+            if self.wait_mode == 'event':
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    print("After %.1f s, no buffer." % self.buffer_timeout)
+                    return None
+                self.PixFlyDLL.wait_for_event(self.buffer_events[which_buf], remaining)
+            else:
+                if num_polls > poll_timeout:
+                    print("After %i polls, no buffer." % poll_timeout)
+                    return None
+                time.sleep(0.00005)  # Wait 50 microseconds
 
-        if not hasattr(self, '_prepared_to_record'):
-            self._prepare_to_record_to_memory()
-            
-        (dw1stImage, dwLastImage, wBitsPerPixel, dwStatusDll,
-        dwStatusDrv, bytes_per_pixel, pixels_per_image, added_buffers, ArrayType) = self._prepared_to_record                   
-        poll_timeout=5e5
-        message = 0
-        verbose=False
-        self.live = True
-        out_preview = self.record_to_memory(1)[0]
-        while self.live:            
-            num_polls = 0
-            polling = True
-            
-            which_buf = added_buffers.pop(0)
-            try:
-                while polling:                    
-                    num_polls += 1
-                    message = self.PixFlyDLL.PCO_GetBufferStatus(
-                        self.hCam, self.buffer_numbers[added_buffers[0]],
-                        ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
-                    if dwStatusDll.value == 0xc0008000:
-                          # Buffer exits the queue
-                        if verbose:
-                            print("After", num_polls, "polls, buffer")
-                            print(self.buffer_numbers[which_buf].value)
-                            print("is ready.")
-                        polling = False
-                        break
-                    else:
-                        time.sleep(0.00005)  # Wait 50 microseconds
-                    if num_polls > poll_timeout:
-                        print("After %i polls, no buffer."%(poll_timeout))
-                        raise TimeoutError
-            except TimeoutError:
-                    pass
-
-            
-            try:
-                if dwStatusDrv.value == 0x00000000 and dwStatusDll.value == 0xc0008000:
-                    pass
-                elif dwStatusDrv.value == 0x80332028:
-                    raise DMAError('DMA error during record_to_memory')
-                else:
-                    print("dwStatusDrv:", dwStatusDrv.value)
-                    raise UserWarning("Buffer status error")
-
-                if verbose:
-                    print("Record to memory result:")
-                    print(hex(dwStatusDll.value), hex(dwStatusDrv.value))
-                    print(message)
-                    print('Retrieving image from buffer ', which_buf)
-                self.ts = time.clock()
-                if self.q.full():
-                    self.q.queue.clear()
-                
-                buffer_ptr = ctypes.cast(self.buffer_pointers[which_buf], ctypes.POINTER(ArrayType))
-                out = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape((self.wYResAct.value, self.wXResAct.value))
-                out /= 4  # make integer division to convert 16 bit to 14 bit
-                if self.q_m.full():
-                    self.q_m.queue.clear()
-                    
-                self.q_m.put(np.ndarray.max(out))
-                
-                self.q.put(out[::-1])
-                
-                
-                #print('Acquisition time:', time.clock()-ts)
-                
-            except UserWarning:
-                pass                
-            finally:                
-                self.PixFlyDLL.PCO_AddBufferEx(  # Put the buffer back in the queue
-                    self.hCam, dw1stImage, dwLastImage,
-                    self.buffer_numbers[which_buf], self.wXResAct, self.wYResAct,
-                    wBitsPerPixel)
-                added_buffers.append(which_buf)                
-                print('Acquisition time:', time.clock()-self.ts)
-                time.sleep(0.05)
-        return
-            
-        
-        
-    def record_to_memory_2(self):
+    @property
+    def live(self):
         """
-        Main recording loop. This function is used for the liew view of frames and starts a loop where the
-        newly aquired frames are put in a queue, as well as the max count of the frame.
+        True while a continuous acquisition is running. Setting it to False stops the acquisition.
         """
-        if not self.armed:
-            raise UserWarning('Cannot record to memory with disarmed camera')
+        return self.engine.running
 
-        if not hasattr(self, '_prepared_to_record'):
-            self._prepare_to_record_to_memory()
-            
-        (dw1stImage, dwLastImage, wBitsPerPixel, dwStatusDll,
-        dwStatusDrv, bytes_per_pixel, pixels_per_image, added_buffers, ArrayType) = self._prepared_to_record                   
-        poll_timeout=5e7
-        message = 0
-        verbose=False
-        timeout_err = False
-        self.live = True
-        which_buf = 0
-        while self.live:
-            ts=time.clock()
-            num_polls = 0
-            polling = True
-            while polling:
-                num_polls += 1
-                message = self.PixFlyDLL.PCO_GetBufferStatus(
-                    self.hCam, self.buffer_numbers[added_buffers[0]],
-                    ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
-                if dwStatusDll.value == 0xc0008000:
-                    which_buf = added_buffers.pop(0)  # Buffer exits the queue
-                    if verbose:
-                        print("After", num_polls, "polls, buffer")
-                        print(self.buffer_numbers[which_buf].value)
-                        print("is ready.")
-                    polling = False
-                    break
-                else:
-                    time.sleep(0.00005)  # Wait 50 microseconds
-                if num_polls > poll_timeout:
-                    print("After %i polls, no buffer."%(poll_timeout))
-                    timeout_err = True
-                        
-            if timeout_err:
-                print('Time out error')
-                self.live = False
-                break
-            try:
-                if dwStatusDrv.value == 0x00000000:
-                    pass
-                elif dwStatusDrv.value == 0x80332028:
-                    raise DMAError('DMA error during record_to_memory')
-                else:
-                    print("dwStatusDrv:", dwStatusDrv.value)
-                    raise UserWarning("Buffer status error")
-
-                if verbose:
-                    print("Record to memory result:")
-                    print(hex(dwStatusDll.value), hex(dwStatusDrv.value))
-                    print(message)
-
-                if self.q.full():
-                    print('Frames queue is full.')
-                    self.q.queue.clear()
-                    
-                buffer_ptr = ctypes.cast(self.buffer_pointers[which_buf], ctypes.POINTER(ArrayType))
-                out = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape((self.wYResAct.value, self.wXResAct.value))
-                out = out/4  # make integer division to convert 16 bit to 14 bit
-                
-                if self.q_m.full():
-                    self.q_m.queue.clear()
-                    
-                self.q_m.put(np.ndarray.max(out))
-                self.q.put(out)
-                    
-            finally:
-                self.PixFlyDLL.PCO_AddBufferEx(  # Put the buffer back in the queue
-                    self.hCam, dw1stImage, dwLastImage,
-                    self.buffer_numbers[which_buf], self.wXResAct, self.wYResAct,
-                    wBitsPerPixel)
-                added_buffers.append(which_buf)
-                #print('Acquisition time:', time.clock()-ts)
-
-        if timeout_err:
-            self.disarm_camera()
+    @live.setter
+    def live(self, value):
+        if not value:
+            self.engine.stop()
 
+    def _report_gaps(self):
+        """
+        Print the gaps in the sequence numbers of the last acquisition, see AcquisitionEngine.
+        :return: number of frames missed
+        """
+        if self.engine.gaps:
+            print("%i gaps in the recording, %i frames missed" % (self.engine.gaps,
+                                                                  self.engine.frames_missed))
+        return self.engine.frames_missed
 
-        
-    def record_to_memory(self, num_images, preframes=0, verbose=True,out=None,first_frame=0,poll_timeout=5e7):
+    def record_live(self):
+        """
+        Live view loop, same as record_to_memory_2.
+        """
+        self.record_to_memory_2()
+
+    def record_to_memory_2(self):
+        """
+        Main recording loop. This function is used for the liew view of frames and starts a loop where
+        the newly aquired frames are put in the frame ring self.ring, with their statistics
+        (self.statistics) as info, and passed to the sinks in self.live_sinks. The ring holds the leases
+        of the frames instead of copies, as many as there are spare buffers (see allocate_buffer), so the
+        frames are copied once, when they are read.
+        """
+        self.ring = FrameRing(self.ring_capacity, (self.wYResAct.value, self.wXResAct.value),
+                              policy=self.ring_policy,
+                              max_leases=min(self.ring_capacity, self.buffers.spare()))
+        sink = FrameRingSink(self.ring)
+        if not self.engine.run([sink] + self.live_sinks, statistics=self.statistics):
+            print('Time out error')
+            self.disarm_camera()
+
+    def record_to_memory(self, num_images, preframes=0, verbose=True,out=None,first_frame=0,poll_timeout=5e7,
+                         sinks=()):
         """
         Records a number of images to a buffer in memory. This is used for recording stacks of data
         :param num_images: number of images to record
         :param preframes: preframes are not saved
         :param verbose:
-        :param out:
+        :param out: numpy array receiving the frames, or path of a memory-mapped stack file that is
+        created for the recording (.npy or raw with sidecar header, see pco_stack.open_stack)
         :param first_frame:
-        :param poll_timeout: how many tries the driver does to poll a frame
+        :param poll_timeout: how many tries the driver does to poll a frame in 'poll' wait mode,
+        in 'event' mode the wait is bounded by self.buffer_timeout seconds
+        :param sinks: additional FrameSink instances receiving the frames, e.g. a
+        pco_pipeline.ProcessingPipeline
         :return:
         """
         if not self.armed:
             raise UserWarning('Cannot record to memory with disarmed camera')
 
-        if not hasattr(self, '_prepared_to_record'):
-            self._prepare_to_record_to_memory()
-
-        message = 0
-        (dw1stImage, dwLastImage, wBitsPerPixel, dwStatusDll,
-         dwStatusDrv, bytes_per_pixel,
-         pixels_per_image, added_buffers, ArrayType) = self._prepared_to_record
-
         if out is None:
             first_frame = 0
-            assert bytes_per_pixel.value == 2
-            out = np.ones(((num_images-preframes),
-                          self.wYResAct.value, self.wXResAct.value),
-                          dtype=np.uint16)
+            # np.empty does not touch the pages before the frames are written
+            out = np.empty(((num_images-preframes),
+                           self.wYResAct.value, self.wXResAct.value),
+                           dtype=np.uint16)
+        elif isinstance(out, str):
+            first_frame = 0
+            out = open_stack(out, num_images-preframes,
+                             (self.wYResAct.value, self.wXResAct.value))
         else:
             try:
                 assert out.shape[1:] == (
@@ -554,110 +517,108 @@ class PixelFly(object):
             except AttributeError:
                 raise UserWarning("Input argument 'out' must be a numpy array.")
 
-        num_acquired = 0
-        for which_im in range(num_images):
-            num_polls = 0
-            polling = True
-            while polling:
-                num_polls += 1
-                message = self.PixFlyDLL.PCO_GetBufferStatus(
-                    self.hCam, self.buffer_numbers[added_buffers[0]],
-                    ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
-                if dwStatusDll.value == 0xc0008000:
-                    which_buf = added_buffers.pop(0)  # Buffer exits the queue
-                    if verbose:
-                        print("After", num_polls, "polls, buffer")
-                        print(self.buffer_numbers[which_buf].value)
-                        print("is ready.")
-                    polling = False
-                    break
-                else:
-                    time.sleep(0.00005)  # Wait 50 microseconds
-                if num_polls > poll_timeout:
-                    print("After %i polls, no buffer."%(poll_timeout))
-                    return None
-                        
-
-            try:
-                if dwStatusDrv.value == 0x00000000:
-                    pass
-                elif dwStatusDrv.value == 0x80332028:
-                    raise DMAError('DMA error during record_to_memory')
-                else:
-                    print("dwStatusDrv:", dwStatusDrv.value)
-                    raise UserWarning("Buffer status error")
-
-                if verbose:
-                    print("Record to memory result:")
-                    print(hex(dwStatusDll.value), hex(dwStatusDrv.value))
-                    print(message)
-
-                if which_im >= preframes:
-                    buffer_ptr = ctypes.cast(self.buffer_pointers[which_buf], ctypes.POINTER(ArrayType))
-                    out[(first_frame + (which_im - preframes))%out.shape[0],
-                        :, :] = np.frombuffer(buffer_ptr.contents, dtype=np.uint16).reshape(out.shape[1:])
-                    num_acquired += 1
-            finally:
-                self.PixFlyDLL.PCO_AddBufferEx(  # Put the buffer back in the queue
-                    self.hCam, dw1stImage, dwLastImage,
-                    self.buffer_numbers[which_buf], self.wXResAct, self.wYResAct,
-                    wBitsPerPixel)
-                added_buffers.append(which_buf)
-
+        if not self.engine.run([RingSink(out, first_frame)] + list(sinks), num_images, preframes,
+                               verbose, poll_timeout):
+            return None
+        self._report_gaps()
+        if isinstance(out, np.memmap):
+            out.flush()
         return out
 
-    def record_to_file(self, num_images, preframes=0, file_name='image_raw', save_path=None, poll_timeout=5e5):
+    def record_to_file(self, num_images, preframes=0, file_name='image_raw', save_path=None, poll_timeout=5e5,
+                       **recorder_options):
         """
-        Record directly to a file. (Not tested)
-        :param num_images:
+        Record the raw frames directly to a binary file. The frames are streamed to disk by the
+        writer threads of a StreamRecorder, so runs are not limited by the memory.
+        :param num_images: number of images to record
+        :param preframes: preframes are not saved
         :param file_name:
-        :param save_path:
-        :param poll_timeout:
-        :return:
+        :param save_path: directory of the file, by default the working directory
+        :param poll_timeout: how many tries the driver does to poll a frame in 'poll' wait mode
+        :param recorder_options: keyword arguments of StreamRecorder (chunk_bytes, max_inflight_bytes,
+        num_writers, direct)
+        :return: dictionary with the recorder statistics and the frame counters of the acquisition (see
+        AcquisitionEngine.stats), the frame times are in the sidecar header
         """
         if save_path is None:
             save_path = os.getcwd()
         save_path = str(save_path)
 
-        dw1stImage, dwLastImage = ctypes.c_uint32(0), ctypes.c_uint32(0)
-        wBitsPerPixel = 16
-        dwStatusDll, dwStatusDrv = ctypes.c_uint32(), ctypes.c_uint32()
-
-        file_pointer = ctypes.c_void_p(
-            libc.fopen(os.path.join(save_path+file_name), 'wb'))
-
-        bytes_per_pixel = ctypes.c_uint32(2)
-        pixels_per_image = ctypes.c_uint32(self.wXResAct.value * self.wYResAct.value)
-
-        for which_im in range(num_images):
-            which_buf = which_im % len(self.buffer_numbers)
-            self.PixFlyDLL.PCO_AddBufferEx(
-                self.hCam, dw1stImage, dwLastImage,
-                self.buffer_numbers[which_buf], self.wXResAct, self.wYResAct,
-                wBitsPerPixel)
-
-            num_polls = 0
-            while True:
-                num_polls += 1
-                self.PixFlyDLL.PCO_GetBufferStatus(
-                    self.hCam, self.buffer_numbers[which_buf],
-                    ctypes.byref(dwStatusDll), ctypes.byref(dwStatusDrv))
-                time.sleep(0.00005)
-                if dwStatusDll.value == 0xc0008000:
-                    break
-                if num_polls > poll_timeout:
-                    libc.fclose(file_pointer)
-                    raise UserWarning("After %i polls, no buffer."%poll_timeout)
-
-            if which_im >=preframes:
-                response = libc.fwrite(self.buffer_pointers[which_buf],
-                                   bytes_per_pixel, pixels_per_image, file_pointer)
-                if response != pixels_per_image.value:
-                    raise UserWarning("Not enough data written to image file.")
+        recorder = StreamRecorder(os.path.join(save_path, file_name), **recorder_options)
+        if not self.engine.run([recorder], num_images, preframes, poll_timeout=poll_timeout):
+            raise UserWarning("Buffer timed out, recording incomplete.")
+        stats = recorder.stats()
+        stats.update(self.engine.stats())
+        print(num_images, " recorded. %.1f MB/s, max backlog %i chunks" % (stats['throughput MB/s'],
+                                                                            stats['max backlog']))
+        self._report_gaps()
+        return stats
+
+    def record_to_container(self, num_images, file_name, preframes=0, append=False, poll_timeout=5e7,
+                            **container_options):
+        """
+        Record frames to a compressed container file (see pco_container). The frames are compressed
+        and written during the acquisition, use pco_container.to_fits to export the file to FITS.
+        :param num_images: number of images to record
+        :param file_name: path of the container file
+        :param preframes: preframes are not saved
+        :param append: True to append the frames to an existing container
+        :param poll_timeout: how many tries the driver does to poll a frame in 'poll' wait mode
+        :param container_options: keyword arguments of FrameContainer (level, num_workers, max_pending)
+        :return: compression ratio of the recorded frames
+        """
+        container = FrameContainer(file_name, metadata=self.metadata(), append=append, **container_options)
+        if not self.engine.run([container], num_images, preframes, poll_timeout=poll_timeout):
+            raise UserWarning("Buffer timed out, recording incomplete.")
+        print(num_images, " recorded. Compression ratio %.2f" % container.compression_ratio())
+        self._report_gaps()
+        return container.compression_ratio()
+
+    def record_to_fits(self, num_images, file_name, preframes=0, poll_timeout=5e7):
+        """
+        Record frames to a FITS file. The frames are appended to the file during the acquisition,
+        the camera settings go in the primary header and the frame times in the FRAMES table.
+        :param num_images: number of images to record
+        :param file_name: path of the FITS file
+        :param preframes: preframes are not saved
+        :param poll_timeout: how many tries the driver does to poll a frame in 'poll' wait mode
+        :return: None
+        """
+        writer = FitsStreamWriter(file_name, metadata=self.metadata())
+        if not self.engine.run([writer], num_images, preframes, poll_timeout=poll_timeout):
+            raise UserWarning("Buffer timed out, recording incomplete.")
+        print(num_images, " recorded.")
+        self._report_gaps()
+        return None
 
-            libc.fclose(file_pointer)
-            print(num_images, " recorded.")
-            return None
+    def record_accumulate(self, num_images=None, preframes=0, interval=None, poll_timeout=5e7):
+        """
+        Average frames without keeping them, see pco_accumulator.FrameAccumulator. With interval, the
+        rounded running mean is put in the frame ring self.ring with its statistics every interval frames,
+        so the live view shows it.
+        :param num_images: number of images to average, None to run until live is set False
+        :param preframes: preframes are not averaged
+        :param interval: number of frames between the updates of the live view, None for no updates
+        :param poll_timeout: how many tries the driver does to poll a frame in 'poll' wait mode
+        :return: FrameAccumulator, its result() has the mean, variance and max images
+        """
+        def update(accumulator, frame):
+            mean = accumulator.mean()
+            self.ring.put(mean, seq=frame.seq, timestamp=frame.timestamp, info=self.statistics.compute(mean))
+
+        accumulator = FrameAccumulator(interval, update, max_count=(1 << (16 - self.bit_shift)) - 1)
+        if interval:
+            self.ring = FrameRing(self.ring_capacity, (self.wYResAct.value, self.wXResAct.value),
+                                  policy=self.ring_policy)
+        try:
+            if not self.engine.run([accumulator], num_images, preframes, poll_timeout=poll_timeout):
+                raise UserWarning("Buffer timed out, accumulation incomplete.")
+        finally:
+            if interval:
+                self.ring.close()
+        print(accumulator.frames, " frames accumulated.")
+        self._report_gaps()
+        return accumulator
 
     def reset_settings(self):
         """
@@ -665,6 +626,7 @@ class PixelFly(object):
         :return:None
         """
         ret_code = self.PixFlyDLL.PCO_ResetSettingsToDefault(self.hCam)
+        self.state.invalidate()
         if ret_code == 0:
             return True
         else:
@@ -675,20 +637,27 @@ class PixelFly(object):
         Reboot camera
         :return:
         """
-        self.PixFlyDLL.PCO_GetCameraSetup(self.hCam)
+        self.PixFlyDLL.PCO_RebootCamera(self.hCam)
+        self.state.invalidate()
         return
 
 
-class DMAError(Exception):
-    def __init__(self, value):
-        self.value = value
-
-    def __str__(self):
-        return repr(self.value)
-
 if __name__ == "__main__":
-    
-    print('Main')
+    # load test of the acquisition with the simulated camera
+    from QtGUI.core.pco_backend import SimulatedBackend
+    num_images = 100
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=200, seed=0))
+    camera.open_camera()
+    camera.arm_camera()
+    camera.allocate_buffer(4)
+    camera.start_recording()
+    ts = time.perf_counter()
+    stack = camera.record_to_memory(num_images, verbose=False)
+    dt = time.perf_counter() - ts
+    print("%i frames of %ix%i in %.2f s: %.1f fps" % (num_images, stack.shape[2], stack.shape[1],
+                                                     dt, num_images/dt))
+    camera.disarm_camera()
+    camera.close_camera()
 
     
     
@@ -0,0 +1,93 @@
+__author__ = 'Polychronis Patapis'
+import time
+import numpy as np
+from astropy.io import fits
+from QtGUI.core.pco_acquisition import FrameSink
+
+# FITS files are written in blocks of 2880 bytes
+BLOCK = 2880
+
+
+class FitsStreamWriter(FrameSink):
+    """
+    FitsStreamWriter appends frames to a FITS file while they are acquired.
+    The primary HDU header is written first with NAXIS3 = 0, every frame is
+    appended as 16 bit integers (BZERO = 32768, so readers get uint16) and on
+    close NAXIS3 is updated in place, the data is padded and a binary table
+    extension FRAMES with the sequence number, host time and, if the camera
+    timestamp is on, camera time of every frame is appended. Only one frame
+    is held in memory, whatever the length of the recording.
+    """
+
+    def __init__(self, file_name, metadata=None):
+        """
+        :param file_name: path of the FITS file
+        :param metadata: dictionary of header keywords, e.g. PixelFly.metadata()
+        """
+        self.file_name = file_name
+        self.metadata = metadata if metadata is not None else {}
+        self.file = None
+
+    def open(self, shape):
+        header = fits.Header()
+        header['SIMPLE'] = True
+        header['BITPIX'] = 16
+        header['NAXIS'] = 3
+        header['NAXIS1'] = shape[1]
+        header['NAXIS2'] = shape[0]
+        header['NAXIS3'] = (0, 'number of frames, updated on close')
+        header['EXTEND'] = True
+        header['BZERO'] = 32768
+        header['BSCALE'] = 1
+        for key, value in self.metadata.items():
+            header[key] = value if isinstance(value, (int, float, str)) else str(value)
+        header_bytes = header.tostring().encode('ascii')
+        # position of the value of the NAXIS3 card, rewritten on close
+        self.naxis3_offset = header_bytes.index(b'NAXIS3  = ') + 10
+        self.file = open(self.file_name, 'wb')
+        self.file.write(header_bytes)
+        self.data_start = len(header_bytes)
+        self.buffer = np.empty(shape, dtype=np.uint16)
+        self.num_frames = 0
+        self.seq = []
+        self.times = []
+        self.camera_times = []
+
+    def append(self, frame, seq=None, timestamp=None, camera_time=None):
+        """
+        Append a frame to the file.
+        :param frame: 2d uint16 array of the file frame shape
+        :param seq: sequence number of the frame, by default its position in the file
+        :param timestamp: host time of the frame in seconds since the epoch, by default the current time
+        :param camera_time: camera time of the frame in seconds since the epoch
+        :return: None
+        """
+        # uint16 -> int16 with BZERO = 32768 is a flip of the sign bit, FITS is big endian
+        np.bitwise_xor(frame, 0x8000, out=self.buffer)
+        self.buffer.byteswap(inplace=True)
+        self.file.write(self.buffer.data)
+        self.seq.append(self.num_frames if seq is None else seq)
+        self.times.append(time.time() if timestamp is None else timestamp)
+        self.camera_times.append(np.nan if camera_time is None else camera_time)
+        self.num_frames += 1
+
+    def put(self, frame):
+        self.append(frame.array, frame.seq, frame.time, frame.camera_time)
+
+    def close(self):
+        if self.file is None:
+            return
+        size = self.file.tell() - self.data_start
+        self.file.write(b'\0'*(-size % BLOCK))
+        self.file.seek(self.naxis3_offset)
+        self.file.write(('%20d' % self.num_frames).encode('ascii'))
+        self.file.close()
+        self.file = None
+        self.buffer = None
+        columns = [fits.Column(name='SEQ', format='K', array=np.array(self.seq, dtype=np.int64)),
+                   fits.Column(name='TIME', format='D', unit='s', array=np.array(self.times))]
+        camera_times = np.array(self.camera_times, dtype=np.float64)
+        if not np.all(np.isnan(camera_times)):
+            columns.append(fits.Column(name='CAMTIME', format='D', unit='s', array=camera_times))
+        table = fits.BinTableHDU.from_columns(columns, name='FRAMES')
+        fits.append(self.file_name, table.data, table.header)
@@ -1,19 +1,20 @@
 __author__ = 'Polychronis Patapis'
 from PyQt4 import QtCore, QtGui
 from QtGUI.core.pco_definitions import PixelFly
-from threading import Thread
-import os, time, sys, pickle
+from QtGUI.core.pco_preview import PreviewWorker
+from QtGUI.core.pco_service import AcquisitionService
+import os, sys, pickle
 import pyqtgraph as pg
-from astropy.io import fits
 import numpy as np
-from queue import Empty
 
 
 class CameraWidget(QtGui.QWidget):
     """
     The CameraWidget class provides the user interface for the PCO PixelFly camera. It bases the connection to the
-    camera through the pyPCOPixelFly.pco_definitions module. The basic framework of the class is PyQt4 an wrapper of the
-    Qt framework and the pyqtgraph (url-here) module is essential for the use of this user interface.
+    camera through the pyPCOPixelFly.pco_definitions module. The acquisitions run in the
+    pco_service.AcquisitionService, the widget only sends it commands and displays the frames. The basic
+    framework of the class is PyQt4 an wrapper of the Qt framework and the pyqtgraph (url-here) module is
+    essential for the use of this user interface.
      Dependencies:
      -- SC2_Cam.dll : the dynamic library that interfaces the camera hardware (please contain it in the same folder as
         the file).
@@ -31,9 +32,13 @@ class CameraWidget(QtGui.QWidget):
         self.path = os.path.dirname(os.path.realpath("__file__"))
         self.save_dir = self.path
         self.camera = PixelFly(self.path)
+        # arms the camera and runs the acquisitions in its own thread
+        self.service = AcquisitionService(self.camera)
         self.connected = False
         self.alive = False
         self.live_view_bool = False
+        # thread preparing the decimated live view images
+        self.preview = None
         self.u = 1
         self.time_unit_dict = dict(us=1, ms=2)
         self.save_settings = self.load_settings()
@@ -194,6 +199,10 @@ class CameraWidget(QtGui.QWidget):
         self.vb.addItem(self.image)
         # Histogram of the displayed image. User can move the histogram axis and the gray values.
         self.hist = pg.HistogramLUTItem(self.image, fillHistogram=False)
+        # the histogram of every frame is computed in the acquisition thread and set in update_image,
+        # the widget must not compute it again from the displayed image
+        self.image.sigImageChanged.disconnect(self.hist.imageChanged)
+        self.hist.sigLevelsChanged.connect(self.levels_changed)
         self.gw.addItem(self.hist)
         # initialize image container variable
         self.im = np.zeros((1392, 1040))
@@ -208,6 +217,7 @@ class CameraWidget(QtGui.QWidget):
         self.roi = pg.ROI(pos=self.save_settings['ROI position'], size=self.save_settings['ROI size'])
         self.roi.addScaleHandle([1, 1], [0, 0])
         self.roi.alive = False
+        self.roi.sigRegionChanged.connect(self.roi_changed)
         self.vb.addItem(self.roi)
         self.roi.hide()
         # User can define line and place it on the image and the values profile will be plotted on the crosscut
@@ -216,6 +226,7 @@ class CameraWidget(QtGui.QWidget):
         self.vb.addItem(self.line_roi)
         self.line_roi.hide()
         self.line_roi.alive = False
+        self.line_roi.sigRegionChanged.connect(self.line_roi_changed)
         # plot item to contain the crosscut curve
         crosscut_plot = pg.PlotItem()
         # crosscut curve that plot the data of the line
@@ -225,6 +236,8 @@ class CameraWidget(QtGui.QWidget):
         self.gw_crosscut.hide()
         self.gw_crosscut.setFixedWidth(800)
         self.gw_crosscut.setFixedHeight(200)
+        # the preview thread decimates the frames to the visible region
+        self.vb.sigRangeChanged.connect(self.view_range_changed)
         # make viewbox accept mouse hover events
         self.vb.acceptHoverEvents()
         # connect mouse moving event to callback
@@ -331,13 +344,45 @@ class CameraWidget(QtGui.QWidget):
         self.statusbar.addPermanentWidget(self.mouse_pos)
         MainWindow.setStatusBar(self.statusbar)
 
+    def view_range_changed(self):
+        """
+        Callback of zoom/pan of the view box. Passes the visible region and the size of the view box on
+        screen to the preview thread.
+        :return:
+        """
+        if self.preview is not None:
+            x_range, y_range = self.vb.viewRange()
+            self.preview.set_viewport(x_range, y_range, (self.vb.width(), self.vb.height()))
+        return
+
+    def stop_preview(self):
+        """
+        Stops the preview thread
+        :return:
+        """
+        if self.preview is not None:
+            self.preview.stop()
+            self.preview.join()
+            self.preview = None
+        return
+
     def log_scale_callback(self):
-        if self.log_scale.isChecked():
-            self.image.setLevels([np.log(200), np.log(16383)])
-            self.hist.setHistogramRange(np.log(200), np.log(16383))
-        else:
-            self.image.setLevels([200, 16383])
-            self.hist.setHistogramRange(200, 16383)
+        """
+        Toggles log scale display. The preview thread maps the gray level range logarithmically on itself
+        with a lookup table, so the levels stay in counts.
+        :return:
+        """
+        if self.preview is not None:
+            self.preview.set_log_scale(self.log_scale.isChecked())
+        return
+
+    def levels_changed(self):
+        """
+        Callback of the histogram gray levels. Rebuilds the display lookup table of the preview thread.
+        :return:
+        """
+        if self.preview is not None:
+            self.preview.set_levels(*self.hist.getLevels())
         return
 
     def refresh_image(self):
@@ -388,9 +433,11 @@ class CameraWidget(QtGui.QWidget):
             self.roi.alive = False
             self.roi_indicator.setText('-')
             self.roi.hide()
+            self.camera.statistics.remove('roi')
         else:
             self.roi.alive = True
             self.roi.show()
+            self.roi_changed()
         return
 
     def crosscut_clicked(self):
@@ -403,10 +450,12 @@ class CameraWidget(QtGui.QWidget):
             self.line_roi.alive = False
             self.gw_crosscut.hide()
             self.line_roi.hide()
+            self.camera.statistics.remove('line')
         else:
             self.line_roi.alive = True
             self.gw_crosscut.show()
             self.line_roi.show()
+            self.line_roi_changed()
         return
 
     def mouseMoved(self, event):
@@ -416,11 +465,11 @@ class CameraWidget(QtGui.QWidget):
         :param event: Mouse move event
         :return:
         """
-        point = self.image.mapFromScene(event)
+        point = self.vb.mapSceneToView(event)
         self.x = int(point.x())
         self.y = int(point.y())
         # return if position out of image bounds
-        if self.x < 0 or self.y < 0 or self.x > 1392 or self.y > 1040:
+        if self.x < 0 or self.y < 0 or self.x >= self.im.shape[0] or self.y >= self.im.shape[1]:
             return
         try:
             val = int(self.im[self.x, self.y])
@@ -429,23 +478,72 @@ class CameraWidget(QtGui.QWidget):
             pass
         return
 
-    def roi_value(self):
+    def roi_ranges(self):
+        """
+        :return: (x range, y range) of the ROI in image coordinates
+        """
+        x, y = [int(v) for v in self.roi.pos()]
+        w, h = [int(v) for v in self.roi.size()]
+        return (max(x, 0), x + w), (max(y, 0), y + h)
+
+    def line_points(self):
+        """
+        :return: (xs, ys) image coordinates of the pixels along the crosscut line
+        """
+        p0, p1 = [self.line_roi.mapToParent(p) for p in self.line_roi.listPoints()]
+        n = int(max(abs(p1.x() - p0.x()), abs(p1.y() - p0.y()))) + 1
+        xs = np.clip(np.rint(np.linspace(p0.x(), p1.x(), n)).astype(int), 0, self.im.shape[0] - 1)
+        ys = np.clip(np.rint(np.linspace(p0.y(), p1.y(), n)).astype(int), 0, self.im.shape[1] - 1)
+        return xs, ys
+
+    def roi_changed(self):
+        """
+        Registers the ROI with the statistics computed in the acquisition thread.
+        :return:
+        """
+        if self.roi.alive:
+            self.camera.statistics.set_roi('roi', *self.roi_ranges())
+        return
+
+    def line_roi_changed(self):
         """
-        Get data from ROI region and calculate average. The value will be displayed in the
-        roi indicator label.
+        Registers the crosscut line with the statistics computed in the acquisition thread.
         :return:
         """
-        data = self.roi.getArrayRegion(self.im, self.image)
-        data_a, data_m = int(np.average(data)), int(np.max(data))
-        self.roi_indicator.setText('%i, Max: %i'%(data_a, data_m))
+        if self.line_roi.alive:
+            self.camera.statistics.set_line('line', *self.line_points())
         return
 
-    def line_roi_value(self):
+    def roi_value(self, stats=None):
         """
-        Get data from line crosscut and plot them in the crosscut curve.
+        Display average and max of the ROI region in the roi indicator label. The values of the statistics
+        of the frame are used if available, else they are calculated from the displayed image.
+        :param stats: statistics of the frame computed in the acquisition thread
         :return:
         """
-        data = self.line_roi.getArrayRegion(self.im, self.image)
+        if stats is not None and 'roi' in stats.get('rois', {}):
+            value = stats['rois']['roi']
+        else:
+            (x0, x1), (y0, y1) = self.roi_ranges()
+            data = self.im[x0:x1, y0:y1]
+            value = (np.average(data), np.max(data)) if data.size else None
+        if value is None:
+            self.roi_indicator.setText('-')
+            return
+        self.roi_indicator.setText('%i, Max: %i'%(int(value[0]), int(value[1])))
+        return
+
+    def line_roi_value(self, stats=None):
+        """
+        Plot the data along the line crosscut in the crosscut curve. The profile of the statistics of the
+        frame is used if available, else it is taken from the displayed image.
+        :param stats: statistics of the frame computed in the acquisition thread
+        :return:
+        """
+        if stats is not None and 'line' in stats.get('lines', {}):
+            data = stats['lines']['line']
+        else:
+            data = self.im[self.line_points()]
         x_data = np.array(range(len(data)))
         self.crosscut_curve.setData(x_data, data)
         return
@@ -463,6 +561,8 @@ class CameraWidget(QtGui.QWidget):
                 self.gray_max_edit.setText('16383')
             self.image.setLevels([self.gray_min, self.gray_max])
             self.hist.setHistogramRange(self.gray_min, self.gray_max)
+            if self.preview is not None:
+                self.preview.set_levels(self.gray_min, self.gray_max)
         except ValueError:
             pass
         return
@@ -480,6 +580,8 @@ class CameraWidget(QtGui.QWidget):
                 self.gray_min_edit.setText('0')
             self.image.setLevels([self.gray_min, self.gray_max])
             self.hist.setHistogramRange(self.gray_min, self.gray_max)
+            if self.preview is not None:
+                self.preview.set_levels(self.gray_min, self.gray_max)
         except ValueError:
             pass
         return
@@ -523,9 +625,11 @@ class CameraWidget(QtGui.QWidget):
                 self.t = int(text)
                 t = self.t
                 u = self.u             
-            self.camera.exposure_time(t, u)
+            self.service.configure(exposure=(t, u), delay=(0, 0))
         except ValueError:
             pass
+        except UserWarning as err:
+            self.display_status.setText(str(err))
         return
 
     def connect_camera(self):
@@ -535,14 +639,13 @@ class CameraWidget(QtGui.QWidget):
         :return:
         """
         if self.connected:
-            err = self.camera.close_camera()
+            self.service.disconnect()
             self.connected = False
             self.ConnectBtn.setText('CONNECT')
             self.ConnectBtn.setStyleSheet("background-color: darkCyan")
             self.connection_status.setText('Disconnected')
         else:
-            err = self.camera.open_camera()
-            if not err:
+            if not self.service.connect():
                 self.connection_status.setText('Error with connection')
                 return
             self.connected = True
@@ -550,7 +653,8 @@ class CameraWidget(QtGui.QWidget):
             self.ConnectBtn.setStyleSheet("background-color: green")
             self.connection_status.setText('Connected')
             try:
-                t, u = self.camera.get_exposure_time()                
+                # settings are read once by open_camera, this takes them from the state cache
+                t, u = self.camera.get_exposure_time()
                 self.exp_time_in.setText(str(t))
                 index = self.time_units.findText(u)
                 if index >= 0:
@@ -577,14 +681,15 @@ class CameraWidget(QtGui.QWidget):
                 self.t = int(t)
 
             unit = self.time_unit_dict[unit]
-            self.camera.exposure_time(self.t, unit)
+            self.service.configure(exposure=(self.t, unit), delay=(0, 0))
             self.u = self.time_unit_dict[unit_initial]
             self.exp_time_in.setText(str(t))
             index = self.time_units.findText(unit_initial)
             if index >= 0:
                 self.time_units.setCurrentIndex(index)
-        except:
-            pass
+        except (ValueError, KeyError, UserWarning) as err:
+            # not a valid time, or rejected by the camera
+            self.display_status.setText(str(err))
         return
 
     def live_callback(self):
@@ -600,39 +705,29 @@ class CameraWidget(QtGui.QWidget):
             else:
                 self.alive = True
                 self.LiveBtn.setStyleSheet('background-color: darkCyan')
-                self.live_thread = Thread(target=self.live_thread_callback)
-                self.live_thread.setDaemon(True)
-                self.live_thread.start()
+                self.start_live_view()
                 QtCore.QTimer.singleShot(500, self.update_image)
         else:
             self.display_status.setText('Error with live display')
         return
 
-    def live_thread_callback(self):
+    def start_live_view(self):
         """
-        Callback for thread that read images from buffer
+        Starts the live acquisition of the service and the preview thread
         :return:
         """
         try:
-            # Arm camera
-            self.camera.arm_camera()
-            print('Camera armed')
-            # Set recording status to 1
-            self.camera.start_recording()
-            # Allocate buffers, default=2 buffers
-            self.camera.allocate_buffer(3)
-            self.camera._prepare_to_record_to_memory()
+            self.service.start_live()
             self.display_status.setText('Live view.')
-            self.record_live_thread = Thread(target=self.camera.record_to_memory_2)
-            print('record thread created')
-            self.record_live_thread.setDaemon(True)
-            self.record_live_thread.start()
-            print('record thread started')
+            # decimate and scale the frames at display rate outside of the GUI thread
+            self.preview = PreviewWorker(self.camera)
+            self.preview.set_levels(self.gray_min, self.gray_max)
+            self.preview.set_log_scale(self.log_scale.isChecked())
+            self.view_range_changed()
+            self.preview.start()
             self.live_view_bool = True
-            """
-            Remember to manage all exceptions here. Look it up in PixelFly() class
-            """
-        except:
+        except UserWarning as err:
+            print(err)
             self.stop_callback()
         return
 
@@ -643,86 +738,64 @@ class CameraWidget(QtGui.QWidget):
         that fires the function every x ms until it is interrupted.
         :return:
         """
-        if not self.alive and (not self.camera.armed):
+        if not self.alive or not self.service.busy:
+            # stopped, or the acquisition ended by itself (e.g. buffer time out)
             if self.live_view_bool:
                 self.live_view_bool = False
-                time.sleep(0.1)
-                self.record_live_thread.join()
-                self.live_thread.join()
-                del self.record_live_thread
-                del self.live_thread
-            self.display_status.setText('Idle')
+                self.stop_preview()
+            self.alive = False
+            self.display_status.setText('Idle' if self.service.error is None else str(self.service.error))
             return
-        try:
-            # get newest frame from queue. Transpose it so that is fits the coordinates convention
-            im = self.camera.q.get().T
-            # check for log scale display
-            if self.log_scale.isChecked():
-                self.im = np.log(im)
-            else:
-                self.im = im
-            try:
-                # get max value from queue
-                max_val = self.camera.q_m.get()
-                self.max_indicator.setText(str(max_val))
-            except Empty:
-                pass
+        # newest preview prepared by the preview thread, None if there is no new one
+        preview = self.preview.latest() if self.preview is not None else None
+        if preview is not None:
+            # full resolution frame, transposed so that is fits the coordinates convention
+            self.im = preview.frame.T  # uint16 with the 14 bit counts
+            # statistics computed in the acquisition thread
+            stats = preview.info
+            self.max_indicator.setText(str(stats['max']))
             # set new image data, with options autoLevels=False so that it doesn't change the grayvalues
             # autoRange=False so that it stays at the zoom level we want and autoHistogram=False so that it does
-            # not interfere with the axis of the histogram
-            self.image.setImage(self.im, autoLevels=False, autoRange=False, autoHistogramRange=False,
-                                autoDownsample=True)
+            # not interfere with the axis of the histogram. The decimated image is stretched over the region
+            # of the frame it shows.
+            self.image.setImage(preview.image, autoLevels=False, autoRange=False, autoHistogramRange=False)
+            self.image.setRect(QtCore.QRectF(*preview.rect))
+            if 'histogram' in stats:
+                # fixed bins, plotted at their centers
+                width = stats['bin_width']
+                centers = np.arange(len(stats['histogram']))*width + width/2.
+                self.hist.plot.setData(centers, stats['histogram'])
             # if roi button is clicked
             if self.roi.alive:
-                self.roi_value()
+                self.roi_value(stats)
             # if crosscut line is clicked
             if self.line_roi.alive:
-                self.line_roi_value()
+                self.line_roi_value(stats)
             # mouse position value update
-
-            if 0 <= self.x <= 1392 and 0 <= self.y <= 1040:
-                val = im[self.x, self.y]
-                self.mouse_pos.setText('%i , %i : %.1f'%(self.x, self.y, val))
+            if 0 <= self.x < self.im.shape[0] and 0 <= self.y < self.im.shape[1]:
+                val = self.im[self.x, self.y]
+                self.mouse_pos.setText('%i , %i : %i'%(self.x, self.y, val))
             
             # update image. Don't know if this is necessary..
             self.image.update()
-        except Empty:
-            pass
         # Run single shot timer again
         QtCore.QTimer.singleShot(20, self.update_image)
 
     def record_callback(self):
         """
-        Record specfied number of frames
+        Record specfied number of frames. The recording runs in the service, record_finished polls for its
+        end.
         :return:
         """
-        if not self.connected:
+        if not self.connected or self.service.mode == 'record':
             return
-        # check if camera had already been armed
-        if self.alive and self.live_view_bool:
-            try:
-                self.live_view_bool = False
-                self.camera.live = False  # stop loop that is producing frames
-                time.sleep(0.1)
-                self.record_live_thread.join()
-                self.live_thread.join()
-                del self.record_live_thread
-                del self.live_thread
-            except:
-                pass
-        elif not self.alive:
-            self.alive = True
-            self.camera.arm_camera()
-            self.camera.start_recording()
-            self.camera.allocate_buffer()
-            self.camera._prepare_to_record_to_memory()
-            self.alive = True
-        else:
-            pass
-
-        hdu = fits.HDUList()  # initialize fits object
+        # stop the live view, the recording arms the camera again
+        if self.alive:
+            self.stop_callback()
 
         filename = QtGui.QFileDialog.getSaveFileName(self, 'Save as..', self.save_dir)
+        if not filename:
+            return
         self.save_dir = os.path.dirname(filename)
         print(filename)
 
@@ -731,40 +804,44 @@ class CameraWidget(QtGui.QWidget):
             num_of_frames = int(self.FramesLab.text())
         except ValueError:
             return
-        self.measurement_status.setText('Recording %d frames..'%num_of_frames)
-        record_data = []
-        record_data = self.camera.record_to_memory(10)/4  # :4 to make it 14 bit
-
-        if record_data == []:
-            self.stop_callback()
+        # frames are written to the file during the acquisition. Unless a FITS file is asked for they
+        # go to a compressed container, pco_container.to_fits converts it to FITS offline.
+        if not filename.lower().endswith('.fits'):
+            filename += '.pcoc'
+        try:
+            self.service.record(num_of_frames, filename, wait=False)
+        except UserWarning as err:
+            self.measurement_status.setText(str(err))
             return
-
-        self.measurement_status.setText('Exporting to FITS file')
-        hdu.append(fits.PrimaryHDU(data=record_data))
-        # other header details will come in here
-        hdu[0].header['EXP TIME'] = "%i %s" % (self.t, self.time_units.currentText())
-        hdu.writeto(filename+'.fits')
-        self.measurement_status.setText('Recording finished.')
-        self.stop_callback()
+        self.measurement_status.setText('Recording %d frames..'%num_of_frames)
+        QtCore.QTimer.singleShot(100, self.record_finished)
         return None
 
+    def record_finished(self):
+        """
+        Polls the service until the recording is finished.
+        :return:
+        """
+        if self.service.busy:
+            QtCore.QTimer.singleShot(100, self.record_finished)
+        elif self.service.error is not None:
+            self.measurement_status.setText('Recording failed: ' + str(self.service.error))
+        else:
+            self.measurement_status.setText('Recording finished.')
+        return
+
     def stop_callback(self):
         """
-        Stops live preview
+        Stops live preview or recording
         :return:
         """
         self.alive = False
 
         if self.live_view_bool:
             self.live_view_bool = False
-            self.camera.live = False  # stop loop that is producing frames
-            time.sleep(0.1)
-            self.record_live_thread.join()
-            self.live_thread.join()
-            del self.record_live_thread
-            del self.live_thread
-        # disarm camera
-        self.camera.disarm_camera()
+            self.stop_preview()
+        # stops the acquisition, the service disarms the camera
+        self.service.stop()
         self.display_status.setText('Idle')
         self.measurement_status.setText('')
         return
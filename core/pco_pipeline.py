@@ -0,0 +1,189 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue, Empty
+import numpy as np
+from QtGUI.core.pco_acquisition import FrameSink
+from QtGUI.core.pco_server import SharedFrameRing
+
+# state of a worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(name, out_name, capacity, shape, out_dtype, stages):
+    _worker['ring'] = SharedFrameRing(capacity, shape, name=name)
+    _worker['out'] = SharedFrameRing(capacity, shape, out_dtype, name=out_name) if out_name else None
+    _worker['stages'] = stages
+
+
+def _process(slot):
+    """
+    Run the stages on the frame in a slot of the shared ring, in a worker process.
+    :return: (True if the result is in the output ring, result, list of the stage times in seconds)
+    """
+    data = _worker['ring'].frames[slot]
+    data.flags.writeable = False
+    times = []
+    for stage in _worker['stages']:
+        ts = time.perf_counter()
+        data = stage(data)
+        times.append(time.perf_counter() - ts)
+    out = _worker['out']
+    if out is not None and isinstance(data, np.ndarray) and data.shape == out.shape:
+        np.copyto(out.frames[slot], data, casting='unsafe')
+        return True, None, times
+    return False, data, times
+
+
+def centroid(frame):
+    """
+    Pipeline stage: intensity weighted centroid of the counts above the mean of the frame.
+    :param frame: 2d array
+    :return: (x, y, total counts above the mean), x and y are nan for a flat frame
+    """
+    weights = frame.astype(np.float32)
+    weights -= weights.mean()
+    np.maximum(weights, 0, out=weights)
+    total = float(weights.sum())
+    if total == 0:
+        return np.nan, np.nan, 0.
+    x = float(weights.sum(axis=0).dot(np.arange(frame.shape[1])))/total
+    y = float(weights.sum(axis=1).dot(np.arange(frame.shape[0])))/total
+    return x, y, total
+
+
+class ProcessingPipeline(FrameSink):
+    """
+    ProcessingPipeline runs per frame analysis in a pool of worker processes,
+    so that it scales over the cores instead of sharing the GIL with the
+    acquisition. A frame is copied once into a slot of a SharedFrameRing and
+    the workers get only the slot number; they run the stages in order, each
+    stage gets the result of the previous one, the first gets the frame as a
+    read-only array. Stages must be picklable functions, e.g. module level
+    functions or functools.partial of them. Results are delivered in the
+    order of the frames to on_result(seq, result), from a collector thread,
+    or appended to self.results. At most depth frames are in flight: when
+    all slots are taken put() waits (stall time), or skips the frame if drop
+    is True. Results that are arrays of the frame shape can be written to a
+    shared output ring instead of being pickled back, with out_dtype: the
+    array passed to on_result is then only valid during the call.
+    """
+
+    def __init__(self, stages, num_workers=2, depth=8, on_result=None, drop=False, out_dtype=None):
+        """
+        :param stages: list of functions, applied in order to every frame
+        :param num_workers: number of worker processes
+        :param depth: maximum number of frames in flight
+        :param on_result: function called with the sequence number and result of every frame, in order
+        :param drop: True to skip frames while all slots are in flight, False to wait for a slot
+        :param out_dtype: data type of the output ring, None to pickle the results back
+        """
+        self.stages = list(stages)
+        self.num_workers = num_workers
+        self.depth = depth
+        self.on_result = on_result
+        self.drop = drop
+        self.out_dtype = out_dtype
+        self.pool = None
+        self.results = []
+        self.errors = []
+
+    def open(self, shape):
+        self.ring = SharedFrameRing(self.depth, shape)
+        self.out_ring = None
+        if self.out_dtype is not None:
+            self.out_ring = SharedFrameRing(self.depth, shape, self.out_dtype)
+        out_name = self.out_ring.name if self.out_ring is not None else None
+        self.pool = ProcessPoolExecutor(self.num_workers, initializer=_init_worker,
+                                        initargs=(self.ring.name, out_name, self.depth, shape, self.out_dtype,
+                                                  self.stages))
+        self.free_slots = Queue()
+        for slot in range(self.depth):
+            self.free_slots.put(slot)
+        # (seq, slot, time of put, future) in the order of the frames, None after the last frame
+        self.pending = Queue()
+        self.results = []
+        self.errors = []
+        self.frames_processed = 0
+        self.frames_skipped = 0
+        self.stall_time = 0.
+        self.stage_times = np.zeros(len(self.stages))
+        self.stage_max = np.zeros(len(self.stages))
+        self.latency = 0.
+        self.max_latency = 0.
+        self.collector = threading.Thread(target=self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def put(self, frame):
+        if self.drop:
+            try:
+                slot = self.free_slots.get_nowait()
+            except Empty:
+                self.frames_skipped += 1
+                return
+        else:
+            ts = time.perf_counter()
+            slot = self.free_slots.get()  # waits while depth frames are in flight
+            self.stall_time += time.perf_counter() - ts
+        self.ring.write(slot, frame.array, frame.seq)
+        self.pending.put((frame.seq, slot, time.perf_counter(), self.pool.submit(_process, slot)))
+
+    def _collect(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            seq, slot, t_put, future = item
+            try:
+                in_output_ring, result, times = future.result()
+                latency = time.perf_counter() - t_put
+                self.frames_processed += 1
+                self.stage_times += times
+                np.maximum(self.stage_max, times, out=self.stage_max)
+                self.latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                if in_output_ring:
+                    result = self.out_ring.frames[slot]
+                if self.on_result is not None:
+                    self.on_result(seq, result)
+                else:
+                    # the output slot is reused once it is free
+                    self.results.append((seq, np.array(result) if in_output_ring else result))
+            except Exception as err:
+                self.errors.append((seq, err))
+            finally:
+                self.free_slots.put(slot)
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pending.put(None)
+        self.collector.join()
+        self.pool.shutdown(wait=True)
+        self.pool = None
+        self.ring.close()
+        if self.out_ring is not None:
+            self.out_ring.close()
+        if self.errors:
+            raise UserWarning("Processing of %i frames failed, first at frame %i: %s" % (
+                len(self.errors), self.errors[0][0], self.errors[0][1]))
+
+    def stats(self):
+        """
+        :return: dictionary with the frames processed and skipped, (name, mean, max) of the time of every
+        stage and the latency from put() to the delivery of the result in ms, and the time put() waited for
+        a slot
+        """
+        n = max(self.frames_processed, 1)
+        names = [getattr(getattr(stage, 'func', stage), '__name__', 'stage %i' % i)
+                 for i, stage in enumerate(self.stages)]
+        return {'frames processed': self.frames_processed,
+                'frames skipped': self.frames_skipped,
+                'stages': [(name, total/n*1e3, longest*1e3)
+                           for name, total, longest in zip(names, self.stage_times, self.stage_max)],
+                'latency ms': self.latency/n*1e3,
+                'max latency ms': self.max_latency*1e3,
+                'stall time': self.stall_time,
+                'errors': len(self.errors)}
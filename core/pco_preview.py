@@ -0,0 +1,227 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import time
+import numpy as np
+
+
+class Preview(object):
+    """
+    A display-ready image made by the PreviewWorker.
+     -- image: decimated image of the visible region, transposed to the display convention (x, y)
+     -- rect: (x, y, width, height) of the region in frame coordinates
+     -- frame: full resolution frame (y, x) the preview was made from
+     -- seq, timestamp, info: as stored in the frame ring
+    """
+
+    def __init__(self, image, rect, frame, seq, timestamp, info):
+        self.image = image
+        self.rect = rect
+        self.frame = frame
+        self.seq = seq
+        self.timestamp = timestamp
+        self.info = info
+
+
+def decimate(image, factor, mode='mean'):
+    """
+    Block reduction of a 2d image by an integer factor in both directions. The
+    image is cropped to a multiple of the factor.
+    :param image: 2d array
+    :param factor: size of the square blocks
+    :param mode: 'mean' or 'max' of the blocks
+    :return: reduced image of the image dtype
+    """
+    if factor <= 1:
+        return image
+    ny, nx = image.shape[0]//factor, image.shape[1]//factor
+    blocks = image[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor)
+    if mode == 'max':
+        return blocks.max(axis=(1, 3))
+    return (blocks.sum(axis=(1, 3), dtype=np.uint32)//(factor*factor)).astype(image.dtype)
+
+
+class DisplayLUT(object):
+    """
+    Lookup table from the 14 bit counts to display values, applied with a
+    single numpy take. The table is rebuilt only when the gray levels or the
+    log scale change, so log display costs the same as linear display.
+     -- dtype uint16: display values stay in counts, so that the gray levels of
+        the image item still apply. Linear scale is the identity and the table
+        is skipped, log scale maps [gray_min, gray_max] logarithmically on itself.
+     -- dtype uint8: the gray levels are applied, [gray_min, gray_max] maps to
+        [0, 255] linearly or logarithmically.
+    """
+    size = 16384
+
+    def __init__(self, gray_min=200, gray_max=16383, log=False, dtype=np.uint16):
+        """
+        :param gray_min: count displayed as black
+        :param gray_max: count displayed as white
+        :param log: True for log scale
+        :param dtype: display data type, np.uint16 or np.uint8
+        """
+        self.dtype = np.dtype(dtype)
+        self.levels = None
+        self.table = None
+        self.set(gray_min, gray_max, log)
+
+    def set(self, gray_min=None, gray_max=None, log=None):
+        """
+        Change the gray levels and/or the log scale, None keeps the current value.
+        :return: None
+        """
+        old = self.levels if self.levels is not None else (200, 16383, False)
+        levels = (old[0] if gray_min is None else gray_min,
+                  old[1] if gray_max is None else gray_max,
+                  old[2] if log is None else bool(log))
+        if levels != self.levels:
+            self.levels = levels
+            self.table = self._build(*levels)
+
+    def _build(self, gray_min, gray_max, log):
+        lo = max(1., float(min(gray_min, gray_max - 1)))
+        hi = max(lo + 1., float(gray_max))
+        counts = np.clip(np.arange(self.size, dtype=np.float64), lo, hi)
+        if log:
+            scaled = np.log(counts/lo)/np.log(hi/lo)
+        else:
+            scaled = (counts - lo)/(hi - lo)
+        if self.dtype == np.uint8:
+            return np.rint(scaled*255).astype(np.uint8)
+        if not log:
+            return None
+        return np.rint(lo + scaled*(hi - lo)).astype(np.uint16)
+
+    def apply(self, image, out=None):
+        """
+        :param image: uint16 image with counts
+        :param out: optional preallocated array of the display dtype
+        :return: display image
+        """
+        # set() from another thread replaces the table, it is read once
+        table = self.table
+        if table is None:
+            return image
+        return np.take(table, image, out=out, mode='clip')
+
+
+class PreviewWorker(threading.Thread):
+    """
+    PreviewWorker prepares the live view outside of the GUI thread. At the
+    display rate it takes the newest frame from the frame ring of the camera,
+    crops it to the visible region of the view box and reduces it by block
+    mean (or max) to about the size of the view box on screen. The GUI thread
+    only takes the latest Preview and displays it, so its work per frame does
+    not depend on the sensor resolution.
+    """
+
+    def __init__(self, camera, rate=30., mode='mean', num_frames=3, display_dtype=np.uint16):
+        """
+        :param camera: PixelFly instance, frames are read from camera.ring
+        :param rate: display rate in frames per second
+        :param mode: decimation mode, 'mean' or 'max'
+        :param num_frames: number of full resolution frames the worker rotates through
+        :param display_dtype: data type of the preview images, see DisplayLUT
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.camera = camera
+        self.period = 1./rate
+        self.mode = mode
+        self.num_frames = num_frames
+        self.running = False
+        self.lock = threading.Lock()
+        # visible region (x0, x1, y0, y1) in frame coordinates and view box size in screen pixels
+        self.viewport = None
+        self.screen_size = (1392, 1040)
+        self.lut = DisplayLUT(dtype=display_dtype)
+        self.frames = []
+        self.preview = None
+        self.changed = False
+
+    def set_viewport(self, x_range, y_range, screen_size):
+        """
+        :param x_range: (min, max) of the visible frame columns
+        :param y_range: (min, max) of the visible frame rows
+        :param screen_size: (width, height) of the view box in screen pixels
+        :return: None
+        """
+        with self.lock:
+            self.viewport = (x_range[0], x_range[1], y_range[0], y_range[1])
+            self.screen_size = (max(1, int(screen_size[0])), max(1, int(screen_size[1])))
+            self.changed = True
+
+    def set_log_scale(self, log):
+        """
+        :param log: True to display the logarithm of the counts
+        :return: None
+        """
+        with self.lock:
+            self.lut.set(log=log)
+            self.changed = True
+
+    def set_levels(self, gray_min, gray_max):
+        """
+        :param gray_min: count displayed as black
+        :param gray_max: count displayed as white
+        :return: None
+        """
+        with self.lock:
+            self.lut.set(gray_min, gray_max)
+            self.changed = True
+
+    def latest(self):
+        """
+        :return: the newest Preview, None if there was no new one since the last call
+        """
+        with self.lock:
+            preview, self.preview = self.preview, None
+        return preview
+
+    def stop(self):
+        self.running = False
+
+    def render(self, frame, seq, timestamp, info):
+        """
+        Make the Preview of a full resolution frame for the current viewport.
+        """
+        with self.lock:
+            viewport, screen_size = self.viewport, self.screen_size
+            self.changed = False
+        y_res, x_res = frame.shape
+        if viewport is None:
+            viewport = (0, x_res, 0, y_res)
+        x0 = min(max(int(viewport[0]), 0), x_res - 1)
+        x1 = min(max(int(np.ceil(viewport[1])), x0 + 1), x_res)
+        y0 = min(max(int(viewport[2]), 0), y_res - 1)
+        y1 = min(max(int(np.ceil(viewport[3])), y0 + 1), y_res)
+        factor = max(1, int(min((x1 - x0)/screen_size[0], (y1 - y0)/screen_size[1])))
+        image = self.lut.apply(decimate(frame[y0:y1, x0:x1], factor, self.mode))
+        rect = (x0, y0, image.shape[1]*factor, image.shape[0]*factor)
+        return Preview(image.T, rect, frame, seq, timestamp, info)
+
+    def run(self):
+        self.running = True
+        last = None
+        index = 0
+        next_frame = time.perf_counter()
+        while self.running:
+            ring = self.camera.ring
+            if ring is not None:
+                if not self.frames or self.frames[0].shape != ring.shape:
+                    self.frames = [np.empty(ring.shape, dtype=ring.dtype) for i in range(self.num_frames)]
+                frame = self.frames[index % self.num_frames]
+                result = ring.get(frame, timeout=self.period, latest=True)
+                if result is not None:
+                    index += 1
+                    last = (frame,) + result
+                    preview = self.render(*last)
+                elif last is not None and self.changed:
+                    preview = self.render(*last)
+                else:
+                    preview = None
+                if preview is not None:
+                    with self.lock:
+                        self.preview = preview
+            next_frame = max(next_frame + self.period, time.perf_counter())
+            time.sleep(max(0., next_frame - time.perf_counter()))
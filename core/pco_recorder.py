@@ -0,0 +1,183 @@
+__author__ = 'Polychronis Patapis'
+import math
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+import numpy as np
+from QtGUI.core.pco_acquisition import FrameSink
+from QtGUI.core.pco_stack import write_header
+
+# alignment of file offsets, sizes and memory for unbuffered (O_DIRECT) io
+ALIGNMENT = 4096
+
+
+class StreamRecorder(FrameSink):
+    """
+    StreamRecorder streams the frames of an acquisition to a raw binary file.
+    The acquisition thread only copies every frame in a page aligned chunk
+    buffer; full chunks are written by a pool of writer threads at aligned
+    file offsets, with O_DIRECT where the os and file system support it. The
+    number of chunk buffers bounds the memory in flight: if the disk falls
+    behind, put() waits for a free chunk and the wait is reported as stall
+    time. The file holds the raw frames one after the other, and a sidecar
+    header is written on close so that pco_stack.load_stack can open it.
+    The header also lists the sequence number, host time and camera time (if
+    the camera timestamp is on) of every frame.
+    """
+
+    def __init__(self, file_name, chunk_bytes=32*2**20, max_inflight_bytes=256*2**20,
+                 num_writers=2, direct=True):
+        """
+        :param file_name: path of the file
+        :param chunk_bytes: target size of a write in bytes
+        :param max_inflight_bytes: maximum memory of the chunk buffers in bytes
+        :param num_writers: number of writer threads
+        :param direct: True to bypass the page cache with O_DIRECT if available
+        """
+        self.file_name = file_name
+        self.chunk_bytes = chunk_bytes
+        self.max_inflight_bytes = max_inflight_bytes
+        self.num_writers = num_writers
+        self.direct = direct
+        self.fd = None
+        self.is_direct = False
+        self.pool = None
+        self.seek_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.errors = []
+
+    def _open_file(self):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        if self.direct and hasattr(os, 'O_DIRECT'):
+            try:
+                self.is_direct = True
+                return os.open(self.file_name, flags | os.O_DIRECT, 0o666)
+            except OSError:
+                pass  # e.g. tmpfs does not support O_DIRECT
+        self.is_direct = False
+        return os.open(self.file_name, flags, 0o666)
+
+    def open(self, shape):
+        self.shape = tuple(shape)
+        self.frame_bytes = int(np.prod(self.shape))*2
+        # number of frames per chunk must make chunks a multiple of the alignment
+        step = ALIGNMENT//math.gcd(self.frame_bytes, ALIGNMENT)
+        self.chunk_frames = max(step, (self.chunk_bytes//self.frame_bytes)//step*step)
+        chunk_size = self.chunk_frames*self.frame_bytes
+        num_chunks = max(2, self.max_inflight_bytes//chunk_size)
+        # anonymous mmaps are page aligned
+        self.free_chunks = Queue()
+        for i in range(num_chunks):
+            buf = mmap.mmap(-1, chunk_size)
+            view = np.frombuffer(buf, dtype=np.uint16).reshape((self.chunk_frames,) + self.shape)
+            self.free_chunks.put((buf, view))
+        self.num_chunks = num_chunks
+        self.fd = self._open_file()
+        self.pool = ThreadPoolExecutor(max_workers=self.num_writers)
+        self.chunk = None
+        self.chunk_fill = 0
+        self.chunk_offset = 0
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.backlog = 0
+        self.max_backlog = 0
+        self.stall_time = 0.
+        self.write_time = 0.
+        self.errors = []
+        self.seq, self.times, self.camera_times = [], [], []
+        self.t_open = time.perf_counter()
+        self.elapsed = 0.
+
+    def _pwrite(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            while len(data):
+                n = os.pwrite(self.fd, data, offset)
+                data, offset = data[n:], offset + n
+        else:
+            with self.seek_lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while len(data):
+                    data = data[os.write(self.fd, data):]
+
+    def _write_chunk(self, chunk, offset, num_frames):
+        buf, view = chunk
+        ts = time.perf_counter()
+        try:
+            size = num_frames*self.frame_bytes
+            if self.is_direct:
+                # unbuffered writes need an aligned length, the file is truncated on close
+                size = -(-size//ALIGNMENT)*ALIGNMENT
+            self._pwrite(memoryview(buf)[:size], offset)
+            with self.stats_lock:
+                self.frames_written += num_frames
+                self.bytes_written += num_frames*self.frame_bytes
+        except OSError as err:
+            self.errors.append(err)
+        finally:
+            with self.stats_lock:
+                self.write_time += time.perf_counter() - ts
+                self.backlog -= 1
+            self.free_chunks.put(chunk)
+
+    def _submit(self):
+        with self.stats_lock:
+            self.backlog += 1
+            self.max_backlog = max(self.max_backlog, self.backlog)
+        self.pool.submit(self._write_chunk, self.chunk, self.chunk_offset, self.chunk_fill)
+        self.chunk_offset += self.chunk_fill*self.frame_bytes
+        self.chunk = None
+        self.chunk_fill = 0
+
+    def put(self, frame):
+        if self.errors:
+            raise UserWarning("Writing to %s failed: %s" % (self.file_name, self.errors[0]))
+        if self.chunk is None:
+            ts = time.perf_counter()
+            self.chunk = self.free_chunks.get()  # waits if all chunks are in flight
+            self.stall_time += time.perf_counter() - ts
+        self.chunk[1][self.chunk_fill] = frame.array
+        self.seq.append(frame.seq)
+        self.times.append(frame.time)
+        self.camera_times.append(frame.camera_time)
+        self.chunk_fill += 1
+        if self.chunk_fill == self.chunk_frames:
+            self._submit()
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.chunk is not None and self.chunk_fill > 0:
+            self._submit()
+        self.pool.shutdown(wait=True)
+        os.ftruncate(self.fd, self.chunk_offset)
+        os.close(self.fd)
+        self.fd = None
+        num_frames = self.chunk_offset//self.frame_bytes
+        frames = {'seq': self.seq[:num_frames], 'times': self.times[:num_frames]}
+        if any(t is not None for t in self.camera_times):
+            frames['camera times'] = self.camera_times[:num_frames]
+        write_header(self.file_name, (num_frames,) + self.shape, **frames)
+        self.elapsed = time.perf_counter() - self.t_open
+        # release the chunk buffers
+        self.free_chunks = None
+        if self.errors:
+            raise UserWarning("Writing to %s failed: %s" % (self.file_name, self.errors[0]))
+
+    def stats(self):
+        """
+        :return: dictionary with the frames and bytes written, the throughput in MB/s, the current and
+        maximum number of chunks waiting to be written and the time the acquisition waited for a chunk
+        """
+        elapsed = self.elapsed if self.fd is None else time.perf_counter() - self.t_open
+        with self.stats_lock:
+            return {'frames written': self.frames_written,
+                    'bytes written': self.bytes_written,
+                    'throughput MB/s': self.bytes_written/2**20/elapsed if elapsed > 0 else 0.,
+                    'backlog': self.backlog,
+                    'max backlog': self.max_backlog,
+                    'chunks': self.num_chunks,
+                    'stall time': self.stall_time,
+                    'direct io': self.is_direct}
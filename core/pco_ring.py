@@ -0,0 +1,166 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import time
+import numpy as np
+
+
+class FrameRing(object):
+    """
+    FrameRing is a fixed capacity ring of frames backed by a preallocated
+    array. Every frame is stored with its sequence number, timestamp and an
+    optional info object. When the ring is full the overflow policy decides:
+     -- 'drop-oldest' : the oldest unread frame is overwritten
+     -- 'drop-newest' : the new frame is discarded
+     -- 'block'       : the producer waits for a free slot (up to a timeout, then
+                        the new frame is discarded)
+    The counters produced, consumed and dropped account for every frame put in
+    the ring. A frame can also be put as FrameLease of the acquisition engine:
+    the ring then keeps the lease instead of a copy, so the frame is copied
+    once, by get(), and frames that are dropped are never copied. The lease
+    is released, and the driver buffer queued again, when the frame is read
+    or dropped; at most max_leases are held, further frames are copied, so
+    the driver keeps buffers to fill. close() copies the frames of the leases
+    still held and releases them. All methods are thread safe.
+    """
+    policies = ('drop-oldest', 'drop-newest', 'block')
+
+    def __init__(self, capacity, shape, dtype=np.uint16, policy='drop-oldest', max_leases=0):
+        """
+        :param capacity: number of frames the ring holds
+        :param shape: shape of a frame
+        :param dtype: data type of the frames
+        :param policy: overflow policy, one of FrameRing.policies
+        :param max_leases: maximum number of frame leases held, 0 to copy all frames
+        """
+        if policy not in self.policies:
+            raise UserWarning("Not accepted overflow policy " + str(policy))
+        if capacity < 1:
+            raise UserWarning("Ring capacity must be at least 1")
+        self.capacity = int(capacity)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.policy = policy
+        self.frames = np.empty((self.capacity,) + self.shape, dtype=self.dtype)
+        self.seq = np.zeros(self.capacity, dtype=np.int64)
+        self.timestamps = np.zeros(self.capacity, dtype=np.float64)
+        self.info = [None]*self.capacity
+        self.leases = [None]*self.capacity
+        self.max_leases = max_leases
+        self.num_leases = 0
+        # head: number of frames written, tail: number of frames read or dropped
+        self.head = 0
+        self.tail = 0
+        self.produced = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        with self.cond:
+            return self.head - self.tail
+
+    def _release(self, slot):
+        lease = self.leases[slot]
+        if lease is not None:
+            self.leases[slot] = None
+            self.num_leases -= 1
+            lease.release()
+
+    def put(self, frame, seq=None, timestamp=None, info=None, timeout=None, lease=None):
+        """
+        Copy a frame in the ring, or keep its lease.
+        :param frame: array of the ring frame shape
+        :param seq: sequence number, by default the number of frames produced
+        :param timestamp: timestamp in seconds, by default time.perf_counter()
+        :param info: optional object stored with the frame
+        :param timeout: maximum time in seconds to wait for a slot with the 'block' policy
+        :param lease: FrameLease of the frame, kept instead of a copy if less than max_leases are held
+        :return: sequence number of the frame, None if it was dropped
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        with self.cond:
+            if seq is None:
+                seq = self.produced
+            self.produced += 1
+            if self.head - self.tail >= self.capacity:
+                if self.policy == 'drop-oldest':
+                    self.tail += 1
+                    self.dropped += 1
+                elif self.policy == 'block':
+                    if not self.cond.wait_for(
+                            lambda: self.head - self.tail < self.capacity or self.closed, timeout) \
+                            or self.closed:
+                        self.dropped += 1
+                        return None
+                else:
+                    self.dropped += 1
+                    return None
+            slot = self.head % self.capacity
+            # the frame dropped from the slot, if any
+            self._release(slot)
+            if lease is not None and self.num_leases < self.max_leases:
+                self.leases[slot] = lease.acquire()
+                self.num_leases += 1
+            else:
+                self.frames[slot] = frame
+            self.seq[slot] = seq
+            self.timestamps[slot] = timestamp
+            self.info[slot] = info
+            self.head += 1
+            self.cond.notify_all()
+        return seq
+
+    def get(self, out, timeout=None, latest=False):
+        """
+        Copy the oldest unread frame in out.
+        :param out: array of the ring frame shape receiving the frame
+        :param timeout: maximum time in seconds to wait for a frame, None to wait forever, 0 to return at once
+        :param latest: True to take the newest frame instead, older unread frames are counted as dropped
+        :return: (sequence number, timestamp, info) of the frame, None if no frame arrived in time
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.head > self.tail or self.closed, timeout):
+                return None
+            if self.head == self.tail:
+                return None
+            if latest:
+                self.dropped += self.head - 1 - self.tail
+                for index in range(self.tail, self.head - 1):
+                    self._release(index % self.capacity)
+                    self.info[index % self.capacity] = None
+                self.tail = self.head - 1
+            slot = self.tail % self.capacity
+            lease = self.leases[slot]
+            out[...] = self.frames[slot] if lease is None else lease.array
+            self._release(slot)
+            result = (int(self.seq[slot]), float(self.timestamps[slot]), self.info[slot])
+            self.info[slot] = None
+            self.tail += 1
+            self.consumed += 1
+            self.cond.notify_all()
+        return result
+
+    def close(self):
+        """
+        Wake up all waiting producers and consumers. Frames already in the ring can still be read, the
+        frames of the leases still held are copied and the leases released.
+        :return: None
+        """
+        with self.cond:
+            for slot in range(self.capacity):
+                if self.leases[slot] is not None:
+                    self.frames[slot] = self.leases[slot].array
+                    self._release(slot)
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        """
+        :return: dictionary with the frame counters and the current fill level
+        """
+        with self.cond:
+            return {'produced': self.produced, 'consumed': self.consumed,
+                    'dropped': self.dropped, 'queued': self.head - self.tail,
+                    'capacity': self.capacity, 'leases': self.num_leases}
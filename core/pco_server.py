@@ -0,0 +1,310 @@
+__author__ = 'Polychronis Patapis'
+import os
+import multiprocessing
+import threading
+from collections import deque
+from multiprocessing import shared_memory, AuthenticationError
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from QtGUI.core.pco_acquisition import FrameSink
+
+# names of the shared memory blocks created by this process and not yet removed
+_created = set()
+
+
+def _attach(name):
+    """
+    Attach to an existing shared memory block without registering it with the resource tracker of this
+    process, the server owns the block and unlinks it. Child processes of multiprocessing share the
+    resource tracker of their parent, the registration is left to it, and a block created by this process
+    keeps the registration of its owner.
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:  # track was added in python 3.13
+        shm = shared_memory.SharedMemory(name)
+        if os.name == 'posix' and multiprocessing.parent_process() is None and name not in _created:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class SharedFrameRing(object):
+    """
+    SharedFrameRing is a ring of frame slots in a shared memory block that
+    other processes map by name. The block starts with the sequence number of
+    the frame in every slot, -1 while the slot is written, followed by the
+    frames. A reader checks the sequence number of a slot to know whether its
+    frame was overwritten.
+    """
+
+    def __init__(self, capacity, shape, dtype=np.uint16, name=None):
+        """
+        :param capacity: number of slots
+        :param shape: shape of a frame
+        :param dtype: data type of the frames
+        :param name: name of an existing block to attach to, None to create a new one
+        """
+        self.capacity = int(capacity)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        header = self.capacity*8
+        size = header + self.capacity*int(np.prod(self.shape))*self.dtype.itemsize
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(create=True, size=size) if self.owner else _attach(name)
+        self.name = self.shm.name
+        if self.owner:
+            _created.add(self.name)
+        self.slot_seq = np.ndarray((self.capacity,), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((self.capacity,) + self.shape, dtype=self.dtype, buffer=self.shm.buf,
+                                 offset=header)
+        if self.owner:
+            self.slot_seq[:] = -1
+
+    def write(self, slot, frame, seq):
+        """
+        :param slot: index of the slot
+        :param frame: array of the frame shape
+        :param seq: sequence number of the frame
+        :return: None
+        """
+        self.slot_seq[slot] = -1
+        self.frames[slot] = frame
+        self.slot_seq[slot] = seq
+
+    def valid(self, slot, seq):
+        """
+        :return: True if the slot holds the frame seq
+        """
+        return self.slot_seq[slot] == seq
+
+    def close(self):
+        """
+        Unmap the block, the owner also removes it.
+        :return: None
+        """
+        # the numpy views must be gone before the block can be closed
+        self.slot_seq, self.frames = None, None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # frames of a subscriber still use the block, it is unmapped when they are gone
+        if self.owner:
+            self.shm.unlink()
+            _created.discard(self.name)
+
+
+class SharedFrame(object):
+    """
+    A frame of a FrameSubscriber. array is a read-only view on the shared
+    memory slot, that the server overwrites capacity frames later: valid()
+    tells whether the view still holds the frame, copy() returns a checked
+    copy.
+     -- seq: sequence number of the frame
+     -- timestamp: monotonic host time (time.perf_counter() of the server) in seconds
+     -- time: host time in seconds since the epoch
+    """
+
+    def __init__(self, ring, slot, seq, timestamp, time):
+        self.ring = ring
+        self.slot = slot
+        self.seq = seq
+        self.timestamp = timestamp
+        self.time = time
+        self.array = ring.frames[slot]
+        self.array.flags.writeable = False
+
+    def valid(self):
+        return self.ring.valid(self.slot, self.seq)
+
+    def copy(self):
+        """
+        :return: copy of the frame, None if the frame was overwritten
+        """
+        if not self.valid():
+            return None
+        frame = np.array(self.array)
+        return frame if self.valid() else None
+
+
+class _Publisher(threading.Thread):
+    """
+    Sends the frame descriptors to one subscriber. Descriptors wait in a
+    queue of the ring capacity, older ones are dropped, since their slots are
+    overwritten anyway; a slow subscriber does not hold up the acquisition
+    or the other subscribers.
+    """
+
+    def __init__(self, conn, capacity):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        self.queue = deque(maxlen=capacity)
+        self.cond = threading.Condition()
+        self.alive = True
+        self.dropped = 0
+
+    def send(self, descriptor):
+        with self.cond:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(descriptor)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.alive = False
+            self.cond.notify()
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    while self.alive and not self.queue:
+                        self.cond.wait()
+                    if not self.alive:
+                        break
+                    descriptor = self.queue.popleft()
+                self.conn.send(descriptor)
+        except (OSError, EOFError):
+            pass  # subscriber gone
+        finally:
+            self.alive = False
+            self.conn.close()
+
+
+class FrameServer(FrameSink):
+    """
+    FrameServer publishes the frames of an acquisition to other local
+    processes. Every frame is copied once into a SharedFrameRing and only a
+    small descriptor (ring name and capacity, slot, sequence number,
+    timestamps, shape) is sent to every subscriber over a local connection
+    (unix socket or named pipe, see multiprocessing.connection), so any
+    number of FrameSubscriber map the frames without pickling them. The
+    server outlives acquisitions: the ring is created again when the frame
+    shape changes, and subscribers follow. shutdown() closes the connections
+    and removes the ring.
+    """
+
+    def __init__(self, address=None, capacity=8, authkey=None):
+        """
+        :param address: address of the listener, None for a free one, see server.address
+        :param capacity: number of frame slots, a subscriber more than capacity frames behind loses frames
+        :param authkey: optional key the subscribers must know
+        """
+        self.capacity = int(capacity)
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.ring = None
+        self.published = 0
+        self.lock = threading.Lock()
+        self.publishers = []
+        self.closed = False
+        self.accept_thread = threading.Thread(target=self._accept)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, AuthenticationError):
+                continue  # listener closed or failed handshake
+            publisher = _Publisher(conn, self.capacity)
+            publisher.start()
+            with self.lock:
+                self.publishers.append(publisher)
+
+    def open(self, shape):
+        if self.ring is None or self.ring.shape != tuple(shape):
+            if self.ring is not None:
+                self.ring.close()
+            self.ring = SharedFrameRing(self.capacity, shape)
+
+    def put(self, frame):
+        slot = self.published % self.capacity
+        self.ring.write(slot, frame.array, frame.seq)
+        descriptor = (self.ring.name, self.capacity, slot, frame.seq, frame.timestamp, frame.time,
+                      self.ring.shape)
+        with self.lock:
+            self.publishers = [publisher for publisher in self.publishers if publisher.alive]
+            for publisher in self.publishers:
+                publisher.send(descriptor)
+        self.published += 1
+
+    def stats(self):
+        """
+        :return: dictionary with the number of frames published, the number of subscribers and the
+        descriptors dropped for slow subscribers
+        """
+        with self.lock:
+            publishers = [publisher for publisher in self.publishers if publisher.alive]
+            return {'published': self.published,
+                    'subscribers': len(publishers),
+                    'dropped': sum(publisher.dropped for publisher in publishers)}
+
+    def shutdown(self):
+        """
+        Close the connections and remove the shared memory ring.
+        :return: None
+        """
+        self.closed = True
+        self.listener.close()
+        with self.lock:
+            for publisher in self.publishers:
+                publisher.stop()
+                publisher.join()
+            self.publishers = []
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+class FrameSubscriber(object):
+    """
+    FrameSubscriber receives the frames of a FrameServer in another process.
+    The frames are SharedFrame views on the shared memory of the server.
+    """
+
+    def __init__(self, address, authkey=None):
+        """
+        :param address: address of the FrameServer
+        :param authkey: key of the server, if it has one
+        """
+        self.conn = Client(address, authkey=authkey)
+        self.ring = None
+        self.received = 0
+        self.skipped = 0
+        self.closed = False
+
+    def get(self, timeout=None, latest=False):
+        """
+        :param timeout: maximum time in seconds to wait for a frame, None to wait forever
+        :param latest: True to skip to the newest frame that arrived
+        :return: SharedFrame, None if no frame arrived in time or the server is gone
+        """
+        try:
+            if self.closed or not self.conn.poll(timeout):
+                return None
+            descriptor = self.conn.recv()
+            while latest and self.conn.poll(0):
+                descriptor = self.conn.recv()
+                self.skipped += 1
+        except (OSError, EOFError):
+            self.closed = True
+            return None
+        name, capacity, slot, seq, timestamp, time, shape = descriptor
+        if self.ring is None or self.ring.name != name:
+            # first frame, or the server made a new ring for a new frame shape
+            if self.ring is not None:
+                self.ring.close()
+            self.ring = SharedFrameRing(capacity, shape, name=name)
+        self.received += 1
+        return SharedFrame(self.ring, slot, seq, timestamp, time)
+
+    def close(self):
+        self.conn.close()
+        self.closed = True
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
@@ -0,0 +1,301 @@
+__author__ = 'Polychronis Patapis'
+import os
+import threading
+from QtGUI.core.pco_server import FrameServer
+
+
+class AcquisitionService(object):
+    """
+    AcquisitionService runs the acquisitions of a PixelFly without user
+    interface. It owns the whole sequence of an acquisition: arm, allocate
+    and queue the buffers, start recording, run the acquisition loop and
+    disarm at the end. The acquisition runs in a worker thread owned by the
+    service, so the command calls return at once and clients (the CLI, the
+    GUI, scripts) only send commands and read the frame ring or the status:
+     -- connect / disconnect
+     -- configure: ROI, binning, exposure and delay time, timestamp mode
+     -- start_live: frames go to camera.ring until stop
+     -- record: N frames to a file, the format follows the extension
+     -- accumulate: mean, variance and max of N frames, or until stop,
+        without keeping the frames, see pco_accumulator
+     -- stop: ends the live view or aborts a recording
+     -- serve: publishes the live frames to other processes, see pco_server
+     -- record_master / calibrate: master dark and flat frames of the current
+        settings and their use by the acquisition, see pco_calibration
+     -- status: connection, mode, settings and frame counters
+    One acquisition runs at a time. execute() calls a command by name, for
+    clients that pass commands as data.
+    """
+    commands = ('connect', 'disconnect', 'configure', 'start_live', 'record', 'accumulate', 'stop', 'serve',
+                'record_master', 'calibrate', 'status')
+
+    def __init__(self, camera):
+        """
+        :param camera: PixelFly instance
+        """
+        self.camera = camera
+        self.connected = False
+        # 'idle', 'live', 'record' or 'accumulate'
+        self.mode = 'idle'
+        self.thread = None
+        self.result = None
+        self.error = None
+        self.server = None
+        self.done = threading.Event()
+        self.done.set()
+
+    @property
+    def busy(self):
+        """
+        True while an acquisition runs.
+        """
+        return not self.done.is_set()
+
+    def execute(self, command, **kwargs):
+        """
+        Call a command by name.
+        :param command: one of AcquisitionService.commands
+        :param kwargs: arguments of the command
+        :return: return value of the command
+        """
+        if command not in self.commands:
+            raise UserWarning("Unknown command " + str(command))
+        return getattr(self, command)(**kwargs)
+
+    def connect(self):
+        """
+        Open the camera.
+        :return: True if the camera is connected
+        """
+        if not self.connected:
+            self.connected = self.camera.open_camera()
+        return self.connected
+
+    def disconnect(self):
+        """
+        Stop the acquisition and the frame server and close the camera.
+        :return: None
+        """
+        self.stop()
+        if self.server is not None:
+            self.camera.live_sinks.remove(self.server)
+            self.server.shutdown()
+            self.server = None
+        if self.connected:
+            self.camera.close_camera()
+            self.connected = False
+        return None
+
+    def configure(self, roi=None, binning=None, exposure=None, delay=None, timestamp_mode=None,
+                  verbose=False):
+        """
+        Change the camera settings in one transaction, see pco_config.ConfigTransaction. None keeps a setting.
+        Exposure and delay time can also be changed during an acquisition.
+        :param roi: (x0, y0, x1, y1) in binned pixels
+        :param binning: (horizontal, vertical) binning
+        :param exposure: (exposure time, timebase), timebase 1 for us, 2 for ms
+        :param delay: (delay time, timebase), timebase 0 for ns, 1 for us, 2 for ms
+        :param timestamp_mode: 0 off, 1 binary, 2 binary and ascii, 3 ascii
+        :param verbose: True if the changes should be printed
+        :return: dictionary of the settings that were changed
+        """
+        if self.busy and (roi, binning, timestamp_mode) != (None, None, None):
+            raise UserWarning("Cannot change ROI, binning or timestamp mode during an acquisition.")
+        if not self.connected:
+            raise UserWarning("Camera not connected.")
+        config = self.camera.configure(verbose=verbose)
+        if binning is not None:
+            config.binning(*binning)
+        if roi is not None:
+            config.roi(roi)
+        if exposure is not None:
+            config.exposure_time(*exposure)
+        if delay is not None:
+            config.delay_time(*delay)
+        if timestamp_mode is not None:
+            config.timestamp_mode(timestamp_mode)
+        return config.commit()
+
+    def _start(self, mode, target, *args):
+        if self.busy:
+            raise UserWarning("Acquisition already running: " + self.mode)
+        if not self.connected:
+            raise UserWarning("Camera not connected.")
+        self.mode = mode
+        self.result, self.error = None, None
+        self.done.clear()
+        self.thread = threading.Thread(target=self._run, args=(target,) + args)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, target, *args):
+        """
+        Worker thread of an acquisition.
+        """
+        camera = self.camera
+        try:
+            if not camera.armed:
+                camera.arm_camera()
+            # spare buffers for the frames the live ring holds, see PixelFly.record_to_memory_2
+            camera.allocate_buffer(held=camera.ring_capacity if self.mode == 'live' else 0)
+            # queue the buffers before the camera starts, so the first frames are not lost
+            camera._prepare_to_record_to_memory()
+            camera.start_recording()
+            self.result = target(*args)
+        except Exception as err:
+            self.error = err
+            print('Acquisition failed:', err)
+        finally:
+            camera.disarm_camera()
+            self.mode = 'idle'
+            self.done.set()
+
+    def start_live(self):
+        """
+        Start the live acquisition. The frames are put in camera.ring with their statistics, see
+        PixelFly.record_to_memory_2.
+        :return: None
+        """
+        self._start('live', self.camera.record_to_memory_2)
+        return None
+
+    def record(self, num_images, file_name, preframes=0, wait=True):
+        """
+        Record frames to a file. The extension selects the format:
+        -- .fits : FITS file, PixelFly.record_to_fits
+        -- .pcoc : compressed container, PixelFly.record_to_container
+        -- .npy  : memory-mapped numpy stack, PixelFly.record_to_memory
+        -- other : raw stack with sidecar header, PixelFly.record_to_file
+        :param num_images: number of images to record
+        :param file_name: path of the file
+        :param preframes: preframes are not saved
+        :param wait: True to return when the recording is finished, False to return at once
+        :return: the return value of the recording method if wait is True, otherwise None
+        """
+        camera = self.camera
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension == '.fits':
+            self._start('record', camera.record_to_fits, num_images, file_name, preframes)
+        elif extension == '.pcoc':
+            self._start('record', camera.record_to_container, num_images, file_name, preframes)
+        elif extension == '.npy':
+            self._start('record', camera.record_to_memory, num_images, preframes, False, file_name)
+        else:
+            save_path, name = os.path.split(os.path.abspath(file_name))
+            self._start('record', camera.record_to_file, num_images, preframes, name, save_path)
+        if not wait:
+            return None
+        self.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _accumulate(self, num_images, file_name, interval):
+        accumulator = self.camera.record_accumulate(num_images, interval=interval)
+        if file_name is not None:
+            return accumulator.save(file_name)
+        return accumulator.result()
+
+    def accumulate(self, num_images=None, file_name=None, interval=None, wait=True):
+        """
+        Average frames without keeping them, see PixelFly.record_accumulate.
+        :param num_images: number of frames, None to run until stop
+        :param file_name: path of a .npz file for the result, None to only return it
+        :param interval: number of frames between the updates of the running mean in camera.ring (live
+        view), None for no updates
+        :param wait: True to return when the accumulation is finished, False to return at once
+        :return: dictionary with the number of frames and the mean, variance and max images if wait is True,
+        otherwise None; self.result holds it at the end
+        """
+        self._start('accumulate', self._accumulate, num_images, file_name, interval)
+        if not wait:
+            return None
+        self.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def record_master(self, kind, num_images=50, method='mean', wait=True):
+        """
+        Record a master dark or flat frame for the current settings, see
+        pco_calibration.CalibrationCache.record.
+        :param kind: 'dark' or 'flat'
+        :param num_images: number of frames
+        :param method: 'mean' or 'median'
+        :param wait: True to return when the master frame is made, False to return at once
+        :return: the master frame if wait is True, otherwise None
+        """
+        self._start('record', self.camera.calibrations.record, kind, num_images, method)
+        if not wait:
+            return None
+        self.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def calibrate(self, enable=True):
+        """
+        Apply the master frames of the current settings to the frames of the next acquisitions.
+        :param enable: True to apply them, False to stop
+        :return: the calibration applied, 'dark', 'flat' or 'dark+flat', None if disabled
+        """
+        if self.busy:
+            raise UserWarning("Cannot change the calibration during an acquisition.")
+        camera = self.camera
+        calibration = camera.calibrations.current() if enable else None
+        if enable and calibration is None:
+            raise UserWarning("No master frames for the current settings.")
+        camera.calibrate = bool(enable)
+        return None if calibration is None else calibration.describe()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the end of the acquisition.
+        :param timeout: maximum time to wait in seconds, None to wait until the end
+        :return: True if no acquisition runs
+        """
+        return self.done.wait(timeout)
+
+    def stop(self):
+        """
+        Stop the live acquisition or abort the recording, and wait until the camera is disarmed.
+        :return: None
+        """
+        # repeated, in case the acquisition loop was not started yet
+        while self.busy:
+            self.camera.live = False
+            self.wait(0.1)
+        return None
+
+    def serve(self, address=None, capacity=8, authkey=None):
+        """
+        Publish the live frames to local subscriber processes through shared memory, see
+        pco_server.FrameServer. The server runs until disconnect.
+        :param address: address of the server, None for a free one
+        :param capacity: number of frames in the shared memory ring
+        :param authkey: optional key the subscribers must know
+        :return: address of the server, for pco_server.FrameSubscriber
+        """
+        if self.server is None:
+            self.server = FrameServer(address, capacity, authkey)
+            self.camera.live_sinks.append(self.server)
+        return self.server.address
+
+    def status(self):
+        """
+        :return: dictionary with the connection, the mode, the camera settings, the frame counters of the
+        acquisition engine and of the frame ring, the driver buffers with their low- and high-water marks
+        (see pco_buffers.BufferPool) and the error of the last acquisition
+        """
+        camera = self.camera
+        status = {'connected': self.connected,
+                  'mode': self.mode,
+                  'armed': camera.armed,
+                  'engine': camera.engine.stats(),
+                  'ring': camera.ring.stats() if camera.ring is not None else None,
+                  'buffers': camera.buffers.stats(),
+                  'server': self.server.stats() if self.server is not None else None,
+                  'error': None if self.error is None else str(self.error)}
+        if self.connected:
+            status['settings'] = camera.metadata()
+        return status
@@ -0,0 +1,70 @@
+__author__ = 'Polychronis Patapis'
+import json
+import os
+import numpy as np
+
+# extension of the header written next to raw stacks
+HEADER_EXTENSION = '.json'
+
+
+def write_header(file_name, shape, dtype=np.uint16, **metadata):
+    """
+    Write the sidecar header of a raw stack file.
+    :param file_name: path of the raw stack
+    :param shape: shape of the stack (num_frames, y-resolution, x-resolution)
+    :param dtype: data type of the stack
+    :param metadata: additional entries of the header
+    :return: path of the header
+    """
+    header = dict(metadata)
+    header.update({'shape': [int(n) for n in shape], 'dtype': np.dtype(dtype).str, 'order': 'C'})
+    header_name = file_name + HEADER_EXTENSION
+    with open(header_name, 'w') as f:
+        json.dump(header, f, indent=1)
+    return header_name
+
+
+def read_header(file_name):
+    """
+    Read the sidecar header of a raw stack file.
+    :param file_name: path of the raw stack
+    :return: header dictionary
+    """
+    with open(file_name + HEADER_EXTENSION, 'r') as f:
+        return json.load(f)
+
+
+def open_stack(file_name, num_frames, shape, dtype=np.uint16, **metadata):
+    """
+    Create a stack of frames as memory-mapped file. Files ending with .npy are
+    numpy files, any other name gives a raw file with a sidecar header. Pages
+    are only allocated when frames are written, so the stack can be larger
+    than the memory and is not touched before the acquisition.
+    :param file_name: path of the stack file
+    :param num_frames: number of frames of the stack
+    :param shape: (y-resolution, x-resolution) of a frame
+    :param dtype: data type of the stack
+    :param metadata: additional entries of the header of raw stacks
+    :return: numpy memmap of shape (num_frames, y-resolution, x-resolution)
+    """
+    stack_shape = (int(num_frames),) + tuple(shape)
+    if file_name.endswith('.npy'):
+        return np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=stack_shape)
+    write_header(file_name, stack_shape, dtype, **metadata)
+    return np.memmap(file_name, dtype=dtype, mode='w+', shape=stack_shape)
+
+
+def load_stack(file_name, mode='r'):
+    """
+    Open a stack written by open_stack or StreamRecorder without loading it.
+    :param file_name: path of the .npy file or of the raw stack with sidecar header
+    :param mode: memmap mode, 'r' for read only, 'r+' to modify the file
+    :return: numpy memmap of the stack
+    """
+    if file_name.endswith('.npy'):
+        return np.load(file_name, mmap_mode=mode)
+    if not os.path.isfile(file_name + HEADER_EXTENSION):
+        raise UserWarning("No header found for raw stack " + file_name)
+    header = read_header(file_name)
+    return np.memmap(file_name, dtype=np.dtype(header['dtype']), mode=mode,
+                     shape=tuple(header['shape']), order=header['order'])
@@ -0,0 +1,120 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import numpy as np
+
+
+class FrameStatistics(object):
+    """
+    FrameStatistics computes the statistics of every frame in the acquisition
+    thread, so the GUI does not scan the frames again. The frame is scanned
+    once by np.bincount into the histogram of the counts; min, max, mean and
+    the number of saturated pixels follow from the histogram. Registered
+    regions of interest (mean and max) and lines (profile) only read their
+    own pixels. With a stride > 1 only every stride-th pixel of every
+    stride-th row is counted in the histogram, the mean is estimated from
+    this subsample. min and max are then taken from the whole frame, two
+    vectorized passes that cost a fraction of the histogram, and the
+    saturated pixels are counted exactly in the whole frame if the max
+    reaches the saturation. The result of compute() is published with the
+    frame as the info of the frame ring:
+     -- 'min', 'max', 'saturated': of the whole frame
+     -- 'mean': of the whole frame, of the subsample with a stride > 1
+     -- 'histogram': number of pixels in fixed bins of bin_width counts from 0 to 2**bits
+     -- 'bin_width': width of the histogram bins in counts
+     -- 'rois': {name: (mean, max)}, None if the roi is outside of the frame
+     -- 'lines': {name: profile array}
+    """
+
+    def __init__(self, bits=14, saturation=None, bins=None, stride=1):
+        """
+        :param bits: bits of the counts, higher values are added to the last bin
+        :param saturation: count from which a pixel is saturated, by default 2**bits - 1
+        :param bins: number of histogram bins, a power of 2 up to 2**bits, by default one bin per count
+        :param stride: subsampling step of the histogram in both directions
+        """
+        self.num_bins = 2**bits
+        bins = self.num_bins if bins is None else bins
+        if bins > self.num_bins or self.num_bins % bins:
+            raise UserWarning('Number of histogram bins must be a power of 2 up to %i' % self.num_bins)
+        self.bin_width = self.num_bins//bins
+        self.stride = max(1, int(stride))
+        self.saturation = self.num_bins - 1 if saturation is None else saturation
+        self.values = np.arange(self.num_bins, dtype=np.float64)
+        self.lock = threading.Lock()
+        self.rois = {}
+        self.lines = {}
+
+    def set_roi(self, name, x_range, y_range):
+        """
+        Register a rectangular region of interest.
+        :param name: name of the roi in the results
+        :param x_range: (first, last + 1) frame column
+        :param y_range: (first, last + 1) frame row
+        :return: None
+        """
+        with self.lock:
+            self.rois[name] = (slice(max(int(y_range[0]), 0), max(int(y_range[1]), 0)),
+                               slice(max(int(x_range[0]), 0), max(int(x_range[1]), 0)))
+
+    def set_line(self, name, xs, ys):
+        """
+        Register a line given by the frame coordinates of its points.
+        :param name: name of the line in the results
+        :param xs: frame columns of the points
+        :param ys: frame rows of the points
+        :return: None
+        """
+        with self.lock:
+            self.lines[name] = (np.asarray(ys, dtype=np.intp), np.asarray(xs, dtype=np.intp))
+
+    def remove(self, name):
+        """
+        Unregister a roi or line.
+        :param name: name of the roi or line
+        :return: None
+        """
+        with self.lock:
+            self.rois.pop(name, None)
+            self.lines.pop(name, None)
+
+    def histogram(self, frame):
+        """
+        :param frame: 2d uint16 array
+        :return: int64 array with the number of pixels of every count, subsampled by the stride
+        """
+        if self.stride > 1:
+            frame = frame[::self.stride, ::self.stride]
+        hist = np.bincount(frame.ravel(), minlength=self.num_bins)
+        if len(hist) > self.num_bins:
+            hist[self.num_bins - 1] += hist[self.num_bins:].sum()
+            hist = hist[:self.num_bins]
+        return hist
+
+    def compute(self, frame):
+        """
+        :param frame: 2d uint16 array
+        :return: dictionary with the statistics of the frame
+        """
+        hist = self.histogram(frame)
+        num_pixels = hist.sum()
+        if self.stride > 1:
+            low, high = int(frame.min()), int(frame.max())
+            saturated = int(np.count_nonzero(frame >= self.saturation)) if high >= self.saturation else 0
+        else:
+            nonzero = np.flatnonzero(hist)
+            low, high = int(nonzero[0]), int(nonzero[-1])
+            saturated = int(hist[self.saturation:].sum())
+        with self.lock:
+            rois, lines = dict(self.rois), dict(self.lines)
+        stats = {'min': low, 'max': high,
+                 'mean': float(hist.dot(self.values))/num_pixels,
+                 'saturated': saturated,
+                 'histogram': hist.reshape(-1, self.bin_width).sum(axis=1) if self.bin_width > 1 else hist,
+                 'bin_width': self.bin_width, 'rois': {}, 'lines': {}}
+        for name, region in rois.items():
+            data = frame[region]
+            stats['rois'][name] = (float(data.mean()), int(data.max())) if data.size else None
+        for name, (ys, xs) in lines.items():
+            ys, xs = np.clip(ys, 0, frame.shape[0] - 1), np.clip(xs, 0, frame.shape[1] - 1)
+            stats['lines'][name] = frame[ys, xs]
+        return stats
@@ -0,0 +1,59 @@
+__author__ = 'Polychronis Patapis'
+import datetime
+import numpy as np
+
+# timestamp modes of PCO_SetTimestampMode
+TIMESTAMP_OFF = 0
+TIMESTAMP_BINARY = 1
+TIMESTAMP_BINARY_ASCII = 2
+TIMESTAMP_ASCII = 3
+TIMESTAMP_MODES = {TIMESTAMP_OFF: 'off', TIMESTAMP_BINARY: 'binary', TIMESTAMP_BINARY_ASCII: 'binary+ascii',
+                   TIMESTAMP_ASCII: 'ascii'}
+# number of pixels of the binary timestamp
+TIMESTAMP_PIXELS = 14
+
+# The binary timestamp of the camera replaces the first 14 pixels of the image. Every pixel
+# holds two BCD digits in the low byte of its 14 bit count:
+#  -- pixels 0-3: image counter, 8 digits, most significant first
+#  -- pixels 4-5: year, 4 digits
+#  -- pixels 6-10: month, day, hour, minute, second
+#  -- pixels 11-13: microseconds, 6 digits
+# The camera clock is in local time.
+
+
+def encode_timestamp(number, when):
+    """
+    Binary timestamp of the camera, as written to the first pixels of a frame.
+    :param number: image counter, up to 99999999
+    :param when: time in seconds since the epoch
+    :return: uint16 array of TIMESTAMP_PIXELS 14 bit counts
+    """
+    t = datetime.datetime.fromtimestamp(when)
+    digits = '%08i%04i%02i%02i%02i%02i%02i%06i' % (number % 10**8, t.year, t.month, t.day, t.hour,
+                                                 t.minute, t.second, t.microsecond)
+    digits = np.array([int(d) for d in digits], dtype=np.uint16).reshape(-1, 2)
+    return (digits[:, 0] << 4) | digits[:, 1]
+
+
+def decode_timestamp(frame):
+    """
+    Decode the binary timestamp of a frame.
+    :param frame: uint16 array with the 14 bit counts, the timestamp is read from its first pixels
+    :return: (image counter, time in seconds since the epoch), None if the frame has no valid timestamp
+    """
+    pixels = frame.reshape(-1)[:TIMESTAMP_PIXELS]
+    if len(pixels) < TIMESTAMP_PIXELS:
+        return None
+    pixels = pixels.astype(np.int64)
+    high, low = (pixels >> 4) & 0xf, pixels & 0xf
+    if pixels.max() > 0xff or high.max() > 9 or low.max() > 9:
+        return None
+    values = high*10 + low
+    number = int(values[0])*10**6 + int(values[1])*10**4 + int(values[2])*100 + int(values[3])
+    try:
+        t = datetime.datetime(int(values[4])*100 + int(values[5]), int(values[6]), int(values[7]),
+                              int(values[8]), int(values[9]), int(values[10]),
+                              int(values[11])*10**4 + int(values[12])*100 + int(values[13]))
+    except ValueError:
+        return None
+    return number, t.timestamp()
@@ -0,0 +1,156 @@
+__author__ = 'Polychronis Patapis'
+import argparse
+import os
+import sys
+import time
+from core.pco_definitions import PixelFly
+from core.pco_service import AcquisitionService
+from core.pco_server import FrameSubscriber
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Headless acquisition with the PCO PixelFly.')
+    parser.add_argument('--dll', default=os.path.dirname(os.path.realpath(__file__)),
+                        help='directory of SC2_Cam.dll')
+    parser.add_argument('--simulate', action='store_true', help='use the simulated camera')
+    parser.add_argument('--sim-fps', type=float, default=13.5,
+                        help='full frame rate of the simulated camera')
+    parser.add_argument('--exposure', nargs=2, metavar=('TIME', 'UNIT'),
+                        help='exposure time, UNIT us or ms')
+    parser.add_argument('--roi', nargs=4, type=int, metavar=('X0', 'Y0', 'X1', 'Y1'),
+                        help='region of interest in binned pixels, starting at 1')
+    parser.add_argument('--binning', nargs=2, type=int, metavar=('H', 'V'), help='binning, 1, 2 or 4')
+    parser.add_argument('--timestamp', type=int, choices=(0, 1, 2, 3),
+                        help='timestamp mode: 0 off, 1 binary, 2 binary and ascii, 3 ascii')
+    parser.add_argument('--calibration-dir', default=None,
+                        help='directory of the master dark and flat frames, kept only in memory by default')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='subtract the master dark and apply the flat field of the current settings')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    commands.add_parser('info', help='print the camera settings')
+    live = commands.add_parser('live', help='run the live acquisition and print the frame rate')
+    live.add_argument('--duration', type=float, default=None, help='seconds to run, until Ctrl+C by default')
+    live.add_argument('--serve', nargs='?', const='', default=None, metavar='ADDRESS',
+                      help='publish the frames to other processes, at a free address if none is given')
+    watch = commands.add_parser('watch', help='subscribe to the frames of a live acquisition with --serve')
+    watch.add_argument('address', help='address printed by live --serve')
+    watch.add_argument('--duration', type=float, default=None, help='seconds to run, until Ctrl+C by default')
+    record = commands.add_parser('record', help='record frames to a file')
+    record.add_argument('num_images', type=int, help='number of frames')
+    record.add_argument('file_name', help='.fits, .pcoc (container), .npy or raw file')
+    record.add_argument('--preframes', type=int, default=0, help='first frames that are not saved')
+    accumulate = commands.add_parser('accumulate', help='average frames without keeping them')
+    accumulate.add_argument('num_images', type=int, help='number of frames')
+    accumulate.add_argument('file_name', help='.npz file of the mean, variance and max images')
+    master = commands.add_parser('master', help='record a master dark or flat frame for the current settings')
+    master.add_argument('kind', choices=('dark', 'flat'))
+    master.add_argument('num_images', type=int, help='number of frames')
+    master.add_argument('--method', choices=('mean', 'median'), default='mean')
+    return parser.parse_args(argv)
+
+
+def print_status(service):
+    status = service.status()
+    stats, buffers = status['engine'], status['buffers']
+    rate = stats['frame rate']
+    print('%i frames, %s fps, %i dropped, %i gaps, %i missed' % (
+        stats['frames acquired'], '-' if rate is None else '%.1f' % rate, stats['frames dropped'],
+        stats['gaps'], stats['frames missed']))
+    print('%i buffers, low water %s (all acquisitions %s), high water %s' % (
+        buffers['buffers'], buffers['last low water'], buffers['low water'], buffers['high water']))
+
+
+def watch(address, duration=None):
+    """
+    Print the frame rate and the lost frames of the frames received from a frame server.
+    """
+    subscriber = FrameSubscriber(address)
+    ts = time.perf_counter()
+    last_report, last_seq, num_frames, missed = ts, None, 0, 0
+    try:
+        while duration is None or time.perf_counter() - ts < duration:
+            frame = subscriber.get(timeout=1.)
+            if frame is None:
+                if subscriber.closed:
+                    break
+                continue
+            if last_seq is not None:
+                missed += max(0, frame.seq - last_seq - 1)
+            last_seq = frame.seq
+            num_frames += 1
+            now = time.perf_counter()
+            if now - last_report >= 1.:
+                print('%i frames, %.1f fps, %i missed, max %i' % (num_frames, num_frames/(now - ts), missed,
+                                                                  frame.array.max()))
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        subscriber.close()
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'watch':
+        return watch(args.address, args.duration)
+    if args.simulate:
+        from core.pco_backend import SimulatedBackend
+        camera = PixelFly(args.dll, backend=SimulatedBackend(frame_rate=args.sim_fps))
+    else:
+        camera = PixelFly(args.dll)
+    camera.calibrations.directory = args.calibration_dir
+    service = AcquisitionService(camera)
+    if not service.connect():
+        print('Error with connection')
+        return 1
+    try:
+        exposure = None
+        if args.exposure is not None:
+            units = {'us': 1, 'ms': 2}
+            if args.exposure[1] not in units:
+                raise UserWarning("Not accepted time unit " + args.exposure[1])
+            exposure = (int(args.exposure[0]), units[args.exposure[1]])
+        service.configure(roi=args.roi, binning=args.binning, exposure=exposure,
+                          timestamp_mode=args.timestamp, verbose=True)
+        if args.calibrate:
+            print('Calibration:', service.calibrate())
+        if args.command == 'info':
+            for key, value in service.status()['settings'].items():
+                print(key, ':', value)
+        elif args.command == 'live':
+            if args.serve is not None:
+                print('Serving frames at', service.serve(args.serve or None))
+            service.start_live()
+            ts = time.perf_counter()
+            try:
+                while service.busy and (args.duration is None or time.perf_counter() - ts < args.duration):
+                    service.wait(1.)
+                    print_status(service)
+            except KeyboardInterrupt:
+                pass
+            service.stop()
+        elif args.command == 'record':
+            service.record(args.num_images, args.file_name, args.preframes)
+            print_status(service)
+        elif args.command == 'accumulate':
+            result = service.accumulate(args.num_images, args.file_name)
+            print('%i frames, mean %.2f, mean variance %.2f, max %i' % (
+                result['frames'], result['mean'].mean(), result['variance'].mean(), result['max'].max()))
+            print_status(service)
+        elif args.command == 'master':
+            service.record_master(args.kind, args.num_images, args.method)
+            print('Master %s saved as %s' % (args.kind, camera.calibrations.key(args.kind)))
+        if service.error is not None:
+            return 1
+    except UserWarning as err:
+        print(err)
+        return 1
+    finally:
+        service.disconnect()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
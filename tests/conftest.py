@@ -0,0 +1,13 @@
+__author__ = 'Polychronis Patapis'
+import importlib.util
+import os
+import sys
+
+# the modules import each other as QtGUI.core.*, load the repository as the QtGUI package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if 'QtGUI' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('QtGUI', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules['QtGUI'] = package
+    spec.loader.exec_module(package)
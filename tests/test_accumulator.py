@@ -0,0 +1,68 @@
+__author__ = 'Polychronis Patapis'
+import numpy as np
+from QtGUI.core.pco_accumulator import FrameAccumulator
+
+
+class Frame(object):
+    def __init__(self, array):
+        self.array = array
+
+
+def frames(num_frames, shape=(6, 5), seed=0):
+    return np.random.default_rng(seed).integers(0, 16384, (num_frames,) + shape).astype(np.uint16)
+
+
+def accumulate(accumulator, stack):
+    accumulator.open(stack.shape[1:])
+    for array in stack:
+        accumulator.put(Frame(array))
+    return accumulator
+
+
+def test_mean_variance_max():
+    stack = frames(25)
+    result = accumulate(FrameAccumulator(), stack).result()
+    assert result['frames'] == 25
+    assert np.allclose(result['mean'], stack.mean(axis=0, dtype=np.float64), rtol=1e-6)
+    assert np.allclose(result['variance'], stack.var(axis=0, dtype=np.float64), rtol=1e-5)
+    assert np.array_equal(result['max'], stack.max(axis=0))
+
+
+def test_fold_uint32_sum():
+    # a max count of 2**30 folds the uint32 sum into the float64 sum every 3 frames
+    accumulator = FrameAccumulator(max_count=2**30)
+    assert accumulator.fold_every == 3
+    stack = frames(10)
+    accumulate(accumulator, stack)
+    assert accumulator.folded is not None
+    assert accumulator.partial == 1
+    assert np.array_equal(accumulator._total(), stack.sum(axis=0, dtype=np.float64))
+    assert np.array_equal(accumulator.mean(), np.rint(stack.mean(axis=0)).astype(np.uint16))
+
+
+def test_no_fold_below_limit():
+    accumulator = accumulate(FrameAccumulator(), frames(4))
+    assert accumulator.fold_every == (2**32 - 1)//16383
+    assert accumulator.folded is None
+
+
+def test_memory_per_pixel():
+    accumulator = accumulate(FrameAccumulator(max_count=2**30), frames(2))
+    arrays = (accumulator.sum, accumulator.sum_sq, accumulator.max, accumulator.square)
+    assert sum(array.nbytes for array in arrays) == 18*accumulator.sum.size
+    accumulate(accumulator, frames(5))
+    assert accumulator.folded.nbytes == 8*accumulator.sum.size
+
+
+def test_updates_every_interval():
+    calls = []
+    accumulator = FrameAccumulator(interval=4, on_update=lambda acc, frame: calls.append(acc.frames))
+    accumulate(accumulator, frames(10))
+    assert calls == [4, 8]
+
+
+def test_result_before_first_frame():
+    accumulator = FrameAccumulator()
+    accumulator.open((2, 2))
+    assert accumulator.result() is None
+    assert accumulator.mean() is None
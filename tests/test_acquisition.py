@@ -0,0 +1,49 @@
+__author__ = 'Polychronis Patapis'
+import numpy as np
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly, CallbackSink
+
+ROI = (1, 1, 320, 240)
+
+
+@pytest.fixture
+def camera():
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).timestamp_mode(1).commit()
+    camera.allocate_buffer()
+    camera.start_recording()
+    yield camera
+    camera.close_camera()
+
+
+def test_callback_sink(camera):
+    frames = []
+
+    def callback(frame):
+        frames.append((frame.index, frame.seq, frame.array.copy()))
+
+    stack = camera.record_to_memory(20, verbose=False, sinks=[CallbackSink(callback)])
+    assert [index for index, seq, array in frames] == list(range(20))
+    assert np.all(np.diff([seq for index, seq, array in frames]) == 1)
+    for index, seq, array in frames:
+        assert np.array_equal(array, stack[index])
+
+
+def test_callback_sink_keeps_lease(camera):
+    kept = []
+
+    def callback(frame):
+        if not kept:
+            kept.append((frame.acquire(), frame.array.copy()))
+
+    # more frames than buffers, the other buffers are filled several times
+    camera.record_to_memory(40, verbose=False, sinks=[CallbackSink(callback)])
+    lease, array = kept[0]
+    # the buffer of the kept frame is not queued again, so not overwritten, until the lease is released
+    assert lease.refs == 1
+    assert lease.buffer not in camera.engine._added_buffers
+    assert np.array_equal(lease.array, array)
+    lease.release()
+    assert lease.refs == 0
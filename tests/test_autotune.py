@@ -0,0 +1,61 @@
+__author__ = 'Polychronis Patapis'
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+
+
+@pytest.fixture
+def camera():
+    # full frame at 13.5 fps, binning and ROI shorten the readout
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.exposure_time(5, 2, verbose=False)
+    yield camera
+    camera.close_camera()
+
+
+def test_full_frame_reaches_target(camera):
+    result = camera.autotune(10, verbose=False)
+    assert result['binning'] == [1, 1]
+    assert result['ROI'] == [1, 1, 1392, 1040]
+    assert result['frame rate'] == pytest.approx(13.5)
+
+
+def test_vertical_binning_first(camera):
+    result = camera.autotune(20, verbose=False)
+    assert result['binning'] == [1, 2]
+    assert result['ROI'] == [1, 1, 1392, 520]
+    assert result['frame rate'] >= 20
+    assert result['latency'] == pytest.approx(5e-3 + result['frame period'])
+    # the setting is kept, the camera left disarmed
+    assert not camera.armed
+    assert camera.state.get('binning') == [1, 2]
+    assert camera.state.get('ROI') == [1, 1, 1392, 520]
+
+
+def test_region_roi_binned(camera):
+    result = camera.autotune(80, region=(101, 201, 400, 500), verbose=False)
+    assert result['binning'] == [1, 1]
+    assert result['ROI'] == [101, 201, 400, 500]
+    # the binned roi covers the region
+    result = camera.autotune(120, region=(101, 201, 401, 501), verbose=False)
+    h_bin, v_bin = result['binning']
+    assert (h_bin, v_bin) != (1, 1)
+    x0, y0, x1, y1 = result['ROI']
+    assert (x0 - 1)*h_bin <= 100 and (y0 - 1)*v_bin <= 200
+    assert x1*h_bin >= 401 and y1*v_bin >= 501
+    assert result['bandwidth MB/s'] == pytest.approx(120*(x1 - x0 + 1)*(y1 - y0 + 1)*2/2**20)
+
+
+def test_unreachable_target_keeps_fastest(camera, capsys):
+    result = camera.autotune(1000, verbose=False)
+    assert 'not reached' in capsys.readouterr().out
+    assert result['binning'] == [4, 4]
+    assert result['frame rate'] < 1000
+    assert result['bandwidth MB/s'] == pytest.approx(result['frame rate']*348*260*2/2**20)
+
+
+def test_armed_camera_refused(camera):
+    camera.configure(arm=True).commit()
+    with pytest.raises(UserWarning):
+        camera.autotune(10, verbose=False)
@@ -0,0 +1,134 @@
+__author__ = 'Polychronis Patapis'
+import math
+from collections import Counter
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_buffers import BufferPool, MAX_DRIVER_BUFFERS
+from QtGUI.core.pco_definitions import PixelFly
+
+ROI = (1, 1, 320, 240)
+FULL_FRAME = 1392*1040*2
+
+
+class CountingBackend(SimulatedBackend):
+    """
+    SimulatedBackend counting the SC2_Cam calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        SimulatedBackend.__init__(self, *args, **kwargs)
+        self.calls = Counter()
+
+    def __getattribute__(self, name):
+        if name.startswith('PCO_'):
+            self.calls[name] += 1
+        return SimulatedBackend.__getattribute__(self, name)
+
+
+@pytest.fixture
+def camera():
+    camera = PixelFly(backend=CountingBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).timestamp_mode(1).commit()
+    yield camera
+    camera.close_camera()
+
+
+def test_size_from_rate_and_latency():
+    pool = BufferPool(None, latency_budget=0.2)
+    # one buffer being filled, one held by the acquisition thread
+    assert pool.size(FULL_FRAME, 10.) == 4
+    assert pool.size(FULL_FRAME, 12.) == 5
+    assert pool.size(FULL_FRAME, 10., held=4) == 8
+
+
+def test_size_caps():
+    pool = BufferPool(None, latency_budget=0.2)
+    assert pool.size(FULL_FRAME, 1000.) == MAX_DRIVER_BUFFERS
+    assert BufferPool(None, max_buffers=64).max_buffers == MAX_DRIVER_BUFFERS
+    # 3 full frames fit in the memory cap
+    pool = BufferPool(None, max_memory=3*FULL_FRAME + 1)
+    assert pool.size(FULL_FRAME, 100.) == 3
+    assert BufferPool(None, min_buffers=6).size(FULL_FRAME, 1.) == 6
+    with pytest.raises(UserWarning):
+        BufferPool(None, max_memory=FULL_FRAME).size(FULL_FRAME, 10.)
+
+
+def test_spare_and_headroom():
+    pool = BufferPool(None, latency_budget=0.2)
+    pool.frame_rate = 20.
+    # 6 buffers for the latency budget, the surplus can be held
+    assert pool.spare(10, FULL_FRAME) == 4
+    assert pool._headroom(10, FULL_FRAME) == pytest.approx(0.2)
+    # held buffers cut by the cap of 16 are taken from the headroom
+    pool.frame_rate, pool.held = 100., 4
+    assert pool.spare(16, FULL_FRAME) == 4
+    assert pool._headroom(16, FULL_FRAME) == pytest.approx(0.1)
+    # at least 2 buffers stay queued
+    pool.held = 20
+    assert pool.spare(16, FULL_FRAME) == 14
+    assert pool._headroom(16, FULL_FRAME) == 0
+    assert pool.spare(0, FULL_FRAME) == 0
+
+
+def test_allocate_sized(camera):
+    # 20 ms exposure, 50 fps: 5 buffers for 0.1 s, 2 for the acquisition and the ring leases
+    camera.configure().exposure_time(20, 2).commit()
+    camera.buffers.latency_budget = 0.1
+    rate = 1./camera.coc_runtime()
+    camera.allocate_buffer(held=camera.ring_capacity)
+    stats = camera.buffers.stats()
+    assert stats['buffers'] == math.ceil(rate*0.1) + 2 + 4 < MAX_DRIVER_BUFFERS
+    assert stats['frame bytes'] == 320*240*2
+    assert stats['memory'] == stats['buffers']*320*240*2
+    assert stats['held'] == 4
+
+
+def test_held_buffers_cut_by_cap(camera, capsys):
+    camera.configure(arm=True).exposure_time(1, 2).commit()
+    camera.buffers.latency_budget = 1.
+    camera.allocate_buffer(held=camera.ring_capacity)
+    assert 'latency headroom cut' in capsys.readouterr().out
+    stats = camera.buffers.stats()
+    assert stats['buffers'] == MAX_DRIVER_BUFFERS
+    assert stats['spare'] == camera.ring_capacity
+    assert stats['latency headroom'] == pytest.approx((MAX_DRIVER_BUFFERS - 6)*camera.coc_runtime())
+
+
+def test_explicit_number(camera):
+    assert camera.buffers.allocate(64) == MAX_DRIVER_BUFFERS
+    camera.buffers.max_memory = 320*240*2*3
+    with pytest.raises(UserWarning):
+        camera.buffers.allocate(4)
+    camera.disarm_camera()
+    with pytest.raises(UserWarning):
+        camera.buffers.allocate(2)
+
+
+def test_buffers_kept_across_acquisitions(camera):
+    backend = camera.PixFlyDLL
+    camera.allocate_buffer(8)
+    assert backend.calls['PCO_AllocateBuffer'] == 8
+    for i in range(3):
+        camera.start_recording()
+        assert camera.record_to_memory(20, verbose=False) is not None
+        camera.disarm_camera()
+        assert len(camera.buffers) == 8
+        camera.configure(arm=True).commit()
+        camera.allocate_buffer(8)
+    assert backend.calls['PCO_AllocateBuffer'] == 8
+    assert backend.calls['PCO_FreeBuffer'] == 0
+    stats = camera.buffers.stats()
+    assert stats['acquisitions'] == 3
+    assert 0 <= stats['low water'] <= stats['last low water'] <= 8
+    assert stats['high water'] >= 1
+    # fewer buffers free the surplus, a new frame size reallocates all of them
+    camera.allocate_buffer(6)
+    assert (backend.calls['PCO_FreeBuffer'], backend.calls['PCO_AllocateBuffer']) == (2, 8)
+    camera.configure().roi((1, 1, 160, 120)).commit()
+    camera.allocate_buffer(6)
+    assert (backend.calls['PCO_FreeBuffer'], backend.calls['PCO_AllocateBuffer']) == (8, 14)
+    assert camera.buffers.frame_bytes == 160*120*2
+    camera.close_camera()
+    assert len(camera.buffers) == 0
+    assert backend.calls['PCO_FreeBuffer'] == 14
@@ -0,0 +1,138 @@
+__author__ = 'Polychronis Patapis'
+import os
+import numpy as np
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_calibration import master_frame, flat_gain, Calibration, CalibrationCache
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_service import AcquisitionService
+from QtGUI.core.pco_timestamp import decode_timestamp
+
+ROI = (1, 1, 320, 240)
+
+
+@pytest.fixture
+def camera():
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).timestamp_mode(1).commit()
+    camera.allocate_buffer()
+    yield camera
+    camera.close_camera()
+
+
+def test_master_frame():
+    stack = np.random.default_rng(0).integers(0, 16384, (7, 12, 10)).astype(np.uint16)
+    assert np.allclose(master_frame(stack), stack.mean(axis=0))
+    # bands of 2 rows for the median
+    median = master_frame(stack, 'median', max_bytes=7*10*2*2)
+    assert median.dtype == np.float32
+    assert np.array_equal(median, np.median(stack, axis=0))
+    with pytest.raises(UserWarning):
+        master_frame(stack[:0])
+    with pytest.raises(UserWarning):
+        master_frame(stack, 'max')
+
+
+def test_flat_gain():
+    flat = np.array([[110., 210.], [310., 10.]], dtype=np.float32)
+    gain = flat_gain(flat, np.full((2, 2), 10, dtype=np.float32))
+    # the mean level of the signal pixels is kept, pixels without signal get a gain of 1
+    assert np.allclose(gain, [[2., 1.], [2./3, 1.]])
+    with pytest.raises(UserWarning):
+        flat_gain(np.zeros((2, 2)))
+
+
+def test_dark_clipped_at_zero():
+    dark = np.array([[100, 100], [100, 100]], dtype=np.float32)
+    frame = np.array([[50, 100], [150, 16383]], dtype=np.uint16)
+    calibration = Calibration(dark=dark)
+    assert calibration.describe() == 'dark'
+    assert calibration.apply(frame).tolist() == [[0, 0], [50, 16283]]
+    assert frame.tolist() == [[50, 100], [150, 16383]]
+
+
+def test_gain_rounded_and_clipped():
+    calibration = Calibration(dark=np.full((2, 2), 10.), gain=np.array([[1.5, 0.5], [2., 1.]]),
+                              max_count=1000)
+    assert calibration.describe() == 'dark+flat'
+    frame = np.array([[11, 13], [610, 1010]], dtype=np.uint16)
+    # (11 - 10)*1.5 rounds to 2, (13 - 10)*0.5 to 2, (610 - 10)*2 is clipped to 1000
+    assert calibration.apply(frame).tolist() == [[2, 2], [1000, 1000]]
+    assert np.allclose(calibration.apply_float(frame), [[1.5, 1.5], [1200., 1000.]])
+
+
+def test_keep_rows_in_place():
+    frame = np.full((4, 3), 500, dtype=np.uint16)
+    frame[0] = [1, 2, 3]
+    calibration = Calibration(dark=np.full((4, 3), 100.), keep_rows=1)
+    out = calibration.apply(frame)
+    assert out[0].tolist() == [1, 2, 3] and np.all(out[1:] == 400)
+    assert calibration.apply(frame, out=frame) is frame
+    assert frame[0].tolist() == [1, 2, 3] and np.all(frame[1:] == 400)
+    with pytest.raises(UserWarning):
+        calibration.apply(np.zeros((3, 3), dtype=np.uint16))
+
+
+def test_cache_follows_settings(camera):
+    cache = camera.calibrations
+    assert cache.current() is None
+    cache.store('dark', np.full((ROI[3], ROI[2]), 100.))
+    cache.store('flat', np.ones((ROI[3], ROI[2])))
+    calibration = cache.current()
+    assert calibration.describe() == 'dark+flat'
+    # the timestamp row is not calibrated
+    assert calibration.keep_rows == 1
+    assert cache.current() is calibration
+    # the dark depends on the exposure time, the flat does not
+    camera.configure().exposure_time(6, 2).commit()
+    assert cache.current().describe() == 'flat'
+    camera.configure().exposure_time(5, 2).commit()
+    assert cache.current().describe() == 'dark+flat'
+    camera.configure().timestamp_mode(0).commit()
+    assert cache.current().keep_rows == 0
+    # both depend on the roi
+    camera.configure().roi((1, 1, 64, 64)).commit()
+    assert cache.current() is None
+    assert camera.metadata()['CALIB'] == 'none'
+
+
+def test_cache_directory(camera, tmp_path):
+    cache = CalibrationCache(camera, str(tmp_path / 'masters'))
+    key = cache.store('dark', np.full((ROI[3], ROI[2]), 100., dtype=np.float32))
+    assert os.path.isfile(str(tmp_path / 'masters' / (key + '.npy')))
+    cache.clear()
+    assert cache.get('dark')[0, 0] == 100.
+    # a later session finds the master frames
+    assert CalibrationCache(camera, str(tmp_path / 'masters')).current().describe() == 'dark'
+
+
+@pytest.mark.parametrize('method', ['mean', 'median'])
+def test_record_and_apply(camera, tmp_path, method):
+    cache = CalibrationCache(camera, str(tmp_path))
+    camera.calibrations = cache
+    camera.start_recording()
+    dark = cache.record('dark', 10, method)
+    assert dark.shape == (ROI[3], ROI[2])
+    # the temporary stack of the median is removed
+    assert os.listdir(str(tmp_path)) == [cache.key('dark') + '.npy']
+    camera.calibrate = True
+    stack = camera.record_to_memory(10, verbose=False)
+    # the simulated frames are the dark frames: only the noise is left, the timestamp is kept
+    assert stack[:, 1:].mean() < 0.05*dark[1:].mean()
+    seqs = [decode_timestamp(frame)[0] for frame in stack]
+    assert np.all(np.diff(seqs) == 1)
+    assert camera.metadata()['CALIB'] == 'dark'
+
+
+def test_service_commands(camera):
+    service = AcquisitionService(camera)
+    service.connected = True
+    with pytest.raises(UserWarning):
+        service.calibrate()
+    master = service.record_master('dark', 5)
+    assert master.shape == (ROI[3], ROI[2])
+    assert service.calibrate() == 'dark'
+    assert camera.calibrate
+    assert service.calibrate(False) is None
+    assert not camera.calibrate
@@ -0,0 +1,143 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import time
+from collections import Counter
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend, PCO_ERROR_WRONGVALUE
+from QtGUI.core.pco_definitions import PixelFly
+
+ROI = (1, 1, 320, 240)
+
+
+class CountingBackend(SimulatedBackend):
+    """
+    SimulatedBackend counting the SC2_Cam calls, without the ascii timestamp.
+    """
+
+    def __init__(self, *args, **kwargs):
+        SimulatedBackend.__init__(self, *args, **kwargs)
+        self.calls = Counter()
+
+    def __getattribute__(self, name):
+        if name.startswith('PCO_'):
+            self.calls[name] += 1
+        return SimulatedBackend.__getattribute__(self, name)
+
+    def PCO_SetTimestampMode(self, hCam, wTimeStampMode):
+        if wTimeStampMode.value == 3:
+            return PCO_ERROR_WRONGVALUE
+        return SimulatedBackend.PCO_SetTimestampMode(self, hCam, wTimeStampMode)
+
+
+@pytest.fixture
+def camera():
+    camera = PixelFly(backend=CountingBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).commit()
+    camera.PixFlyDLL.calls.clear()
+    yield camera
+    camera.live = False
+    camera.close_camera()
+
+
+def set_calls(camera):
+    return dict((name, n) for name, n in camera.PixFlyDLL.calls.items()
+                if name.startswith('PCO_Set') or name == 'PCO_ArmCamera')
+
+
+def test_unchanged_settings_not_sent(camera):
+    assert camera.configure().exposure_time(5, 2).delay_time(0, 0).roi(ROI).commit() == {}
+    assert set_calls(camera) == {}
+    assert camera.armed
+
+
+def test_one_arm_for_all_changes(camera):
+    changes = camera.configure().binning(2, 2).roi((1, 1, 100, 80)).exposure_time(20, 2) \
+        .delay_time(1, 1).timestamp_mode(1).commit()
+    assert changes == {'binning': [2, 2], 'ROI': [1, 1, 100, 80], 'Exposure time': [20, 'ms'],
+                       'Delay time': [1, 'us'], 'Timestamp mode': 1}
+    assert set_calls(camera) == {'PCO_SetRecordingState': 1, 'PCO_SetBinning': 1, 'PCO_SetROI': 1,
+                                 'PCO_SetDelayExposureTime': 1, 'PCO_SetTimestampMode': 1,
+                                 'PCO_ArmCamera': 1}
+    backend = camera.PixFlyDLL
+    assert (backend.bin, backend.roi, backend.delay_exposure) == ([2, 2], [1, 1, 100, 80], [1, 20, 1, 2])
+    assert camera.armed
+    assert camera.state.get('Camera ROI dimensions') == [100, 80]
+
+
+def test_roi_clipped_to_binning(camera):
+    camera.configure().roi((1, 1, 1392, 1040)).commit()
+    assert camera.configure().binning(4, 4).changes() == {'binning': [4, 4], 'ROI': [1, 1, 348, 260]}
+    # reversed corners are sorted
+    assert camera.configure().roi((300, 200, 10, 20)).changes() == {'ROI': [10, 20, 300, 200]}
+
+
+def test_arm_argument(camera):
+    camera.configure(arm=False).exposure_time(6, 2).commit()
+    assert not camera.armed
+    camera.configure().roi((1, 1, 64, 64)).commit()
+    assert not camera.armed
+    camera.configure(arm=True).commit()
+    assert camera.armed
+
+
+def test_rejected_setting_rolls_back(camera):
+    backend = camera.PixFlyDLL
+    params = dict(camera.state.params)
+    with pytest.raises(UserWarning):
+        camera.configure().binning(2, 2).roi((1, 1, 100, 80)).exposure_time(20, 2).timestamp_mode(3).commit()
+    # binning, roi and times were applied before the timestamp mode was rejected, they are restored
+    assert (backend.bin, backend.roi, backend.delay_exposure) == ([1, 1], list(ROI), [0, 5, 0, 2])
+    assert backend.timestamp_mode == 0
+    assert camera.state.params == params
+    assert camera.armed
+
+
+def test_invalid_values_refused_before_commit(camera):
+    with pytest.raises(UserWarning):
+        camera.configure().binning(3, 1)
+    with pytest.raises(UserWarning):
+        camera.configure().exposure_time(5, 0)
+    with pytest.raises(UserWarning):
+        camera.configure().timestamp_mode(4)
+    assert set_calls(camera) == {}
+
+
+def test_context_manager(camera):
+    with camera.configure() as config:
+        config.exposure_time(7, 2)
+    assert camera.PixFlyDLL.delay_exposure[1] == 7
+    with pytest.raises(RuntimeError):
+        with camera.configure() as config:
+            config.exposure_time(8, 2)
+            raise RuntimeError
+    assert camera.PixFlyDLL.delay_exposure[1] == 7
+
+
+def test_times_only_during_acquisition(camera):
+    backend = camera.PixFlyDLL
+    # armed and not recording: the camera is armed again in place
+    camera.configure().exposure_time(10, 2).commit()
+    assert set_calls(camera) == {'PCO_SetDelayExposureTime': 1, 'PCO_ArmCamera': 1}
+    camera.allocate_buffer(held=camera.ring_capacity)
+    camera.start_recording()
+    thread = threading.Thread(target=camera.record_live)
+    thread.start()
+    try:
+        deadline = time.perf_counter() + 10
+        while not camera.engine.running and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        assert camera.engine.running
+        backend.calls.clear()
+        assert camera.configure().exposure_time(20, 2).commit() == {'Exposure time': [20, 'ms']}
+        # the recording camera takes the new time with the next frame, it is not disarmed or armed
+        assert set_calls(camera) == {'PCO_SetDelayExposureTime': 1}
+        assert backend.delay_exposure[1] == 20
+        assert camera.engine.running
+        with pytest.raises(UserWarning):
+            camera.configure().roi((1, 1, 64, 64)).commit()
+        assert backend.roi == list(ROI)
+    finally:
+        camera.live = False
+        thread.join(10)
+    assert not thread.is_alive()
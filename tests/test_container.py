@@ -0,0 +1,96 @@
+__author__ = 'Polychronis Patapis'
+import numpy as np
+import pytest
+from QtGUI.core.pco_container import encode_frame, decode_frame, FrameContainer, ContainerReader, to_fits
+
+SHAPE = (24, 40)
+
+
+def frames(num_frames, seed=0):
+    return np.random.default_rng(seed).integers(0, 16384, (num_frames,) + SHAPE).astype(np.uint16)
+
+
+def write(file_name, stack, append=False, first_seq=0):
+    container = FrameContainer(file_name, metadata={'EXPTIME': 5.}, num_workers=2, max_pending=3,
+                               append=append)
+    container.open(SHAPE)
+    for i, frame in enumerate(stack):
+        container.append(frame, first_seq + i, 1000. + first_seq + i)
+    container.close()
+    return container
+
+
+@pytest.mark.parametrize('shift', [0, 2])
+def test_encode_round_trip(shift):
+    # 14 bit data in the upper bits is shifted down
+    frame = frames(1)[0] << shift
+    payload, bit_shift = encode_frame(frame)
+    assert bit_shift == shift
+    decoded = decode_frame(payload, bit_shift, SHAPE)
+    assert decoded.dtype == np.uint16
+    assert np.array_equal(decoded, frame)
+
+
+def test_encode_compresses_smooth_frames():
+    frame = np.add.outer(np.arange(SHAPE[0]), np.arange(SHAPE[1])).astype(np.uint16) << 2
+    payload, shift = encode_frame(frame)
+    assert len(payload) < frame.nbytes//10
+    assert np.array_equal(decode_frame(payload, shift, SHAPE), frame)
+
+
+def test_container_round_trip(tmp_path):
+    file_name = str(tmp_path / 'run.pcf')
+    stack = frames(10)
+    container = write(file_name, stack)
+    assert container.compression_ratio() > 0
+    reader = ContainerReader(file_name)
+    assert reader.shape == SHAPE
+    assert reader.metadata == {'EXPTIME': 5.}
+    assert len(reader) == 10
+    assert reader.seq == list(range(10))
+    assert reader.times == [1000. + i for i in range(10)]
+    assert np.array_equal(np.array(list(reader.frames())), stack)
+    assert np.array_equal(reader[7], stack[7])
+    reader.close()
+
+
+def test_append(tmp_path):
+    file_name = str(tmp_path / 'run.pcf')
+    first, second = frames(4, seed=1), frames(3, seed=2)
+    write(file_name, first)
+    write(file_name, second, append=True, first_seq=4)
+    reader = ContainerReader(file_name)
+    assert reader.seq == list(range(7))
+    assert np.array_equal(np.array(list(reader.frames())), np.concatenate([first, second]))
+    reader.close()
+    with pytest.raises(UserWarning):
+        FrameContainer(file_name, append=True).open((2, 2))
+
+
+def test_scan_without_index(tmp_path):
+    # a crash leaves no index and a truncated last record, the complete frames are recovered
+    file_name = str(tmp_path / 'run.pcf')
+    stack = frames(5)
+    write(file_name, stack)
+    reader = ContainerReader(file_name)
+    end = reader.data_end
+    reader.close()
+    with open(file_name, 'r+b') as f:
+        f.truncate(end - 10)
+    reader = ContainerReader(file_name)
+    assert len(reader) == 4
+    assert reader.times == [None]*4
+    assert np.array_equal(np.array(list(reader.frames())), stack[:4])
+    reader.close()
+
+
+def test_to_fits(tmp_path):
+    fits = pytest.importorskip('astropy.io.fits')
+    container_name, fits_name = str(tmp_path / 'run.pcf'), str(tmp_path / 'run.fits')
+    stack = frames(6)
+    write(container_name, stack)
+    to_fits(container_name, fits_name)
+    with fits.open(fits_name) as hdus:
+        assert hdus[0].header['EXPTIME'] == 5.
+        assert np.array_equal(hdus[0].data, stack)
+        assert list(hdus['FRAMES'].data['SEQ']) == list(range(6))
@@ -0,0 +1,63 @@
+__author__ = 'Polychronis Patapis'
+import numpy as np
+from astropy.io import fits
+from QtGUI.core.pco_fits import FitsStreamWriter, BLOCK
+
+SHAPE = (24, 40)
+
+
+def write(file_name, stack, camera_times=None, metadata=None):
+    writer = FitsStreamWriter(file_name, metadata)
+    writer.open(SHAPE)
+    for i, frame in enumerate(stack):
+        writer.append(frame, 10 + i, 1000. + i, None if camera_times is None else camera_times[i])
+    writer.close()
+
+
+def test_stack_and_header(tmp_path):
+    file_name = str(tmp_path / 'run.fits')
+    stack = np.random.default_rng(0).integers(0, 2**16, (7,) + SHAPE).astype(np.uint16)
+    write(file_name, stack, metadata={'EXPTIME': 5., 'ROI': (1, 1, 40, 24)})
+    with fits.open(file_name) as hdus:
+        header = hdus[0].header
+        # NAXIS3 patched in place on close
+        assert (header['NAXIS1'], header['NAXIS2'], header['NAXIS3']) == (40, 24, 7)
+        assert (header['BITPIX'], header['BZERO']) == (16, 32768)
+        assert header['EXPTIME'] == 5.
+        assert header['ROI'] == '(1, 1, 40, 24)'
+        # full uint16 range through the signed data with BZERO
+        assert hdus[0].data.dtype == np.uint16
+        assert np.array_equal(hdus[0].data, stack)
+        frames = hdus['FRAMES'].data
+        assert list(frames['SEQ']) == list(range(10, 17))
+        assert list(frames['TIME']) == [1000. + i for i in range(7)]
+        assert 'CAMTIME' not in frames.names
+    # padded to whole blocks
+    with open(file_name, 'rb') as f:
+        assert len(f.read()) % BLOCK == 0
+
+
+def test_camera_times(tmp_path):
+    file_name = str(tmp_path / 'run.fits')
+    write(file_name, np.zeros((3,) + SHAPE, dtype=np.uint16), camera_times=[5., 6., 7.])
+    with fits.open(file_name) as hdus:
+        assert list(hdus['FRAMES'].data['CAMTIME']) == [5., 6., 7.]
+
+
+def test_empty(tmp_path):
+    file_name = str(tmp_path / 'run.fits')
+    write(file_name, [])
+    with fits.open(file_name) as hdus:
+        assert hdus[0].header['NAXIS3'] == 0
+        assert len(hdus['FRAMES'].data) == 0
+
+
+def test_close_twice(tmp_path):
+    writer = FitsStreamWriter(str(tmp_path / 'run.fits'))
+    writer.open(SHAPE)
+    writer.append(np.zeros(SHAPE, dtype=np.uint16))
+    writer.close()
+    writer.close()
+    with fits.open(str(tmp_path / 'run.fits')) as hdus:
+        assert hdus[0].data.shape == (1,) + SHAPE
+        assert list(hdus['FRAMES'].data['SEQ']) == [0]
@@ -0,0 +1,123 @@
+__author__ = 'Polychronis Patapis'
+import functools
+import time
+import numpy as np
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_pipeline import ProcessingPipeline, centroid
+
+SHAPE = (24, 40)
+
+
+class Frame(object):
+    def __init__(self, array, seq):
+        self.array = array
+        self.seq = seq
+
+
+def jitter(frame, delay=0.01):
+    # the frames take different times, the early ones the longest
+    time.sleep(delay*(3 - int(frame[0, 0]) % 4))
+    return frame
+
+
+def total(frame):
+    return int(frame.sum(dtype=np.int64))
+
+
+def half(frame):
+    return frame/2.
+
+
+def fail_on_third(frame):
+    if frame[0, 0] == 3:
+        raise ValueError('bad frame')
+    return 0
+
+
+def run(pipeline, num_frames):
+    pipeline.open(SHAPE)
+    frames = [np.full(SHAPE, i, dtype=np.uint16) for i in range(num_frames)]
+    try:
+        for i, frame in enumerate(frames):
+            pipeline.put(Frame(frame, 100 + i))
+    finally:
+        pipeline.close()
+    return frames
+
+
+def test_ordered_results():
+    pipeline = ProcessingPipeline([jitter, total], num_workers=2, depth=4)
+    frames = run(pipeline, 12)
+    assert pipeline.results == [(100 + i, total(frame)) for i, frame in enumerate(frames)]
+    stats = pipeline.stats()
+    assert stats['frames processed'] == 12
+    assert [name for name, mean, longest in stats['stages']] == ['jitter', 'total']
+    assert stats['errors'] == 0
+
+
+def test_on_result_in_order():
+    delivered = []
+    pipeline = ProcessingPipeline([functools.partial(jitter, delay=0.005)], depth=3,
+                                  on_result=lambda seq, result: delivered.append((seq, int(result[0, 0]))))
+    run(pipeline, 10)
+    assert delivered == [(100 + i, i) for i in range(10)]
+    assert pipeline.results == []
+    assert pipeline.stats()['stages'][0][0] == 'jitter'
+
+
+def test_output_ring():
+    pipeline = ProcessingPipeline([half], depth=3, out_dtype=np.float32)
+    run(pipeline, 8)
+    assert [seq for seq, result in pipeline.results] == list(range(100, 108))
+    for i, (seq, result) in enumerate(pipeline.results):
+        assert result.dtype == np.float32
+        assert np.all(result == i/2.)
+
+
+def test_drop_when_slots_taken():
+    pipeline = ProcessingPipeline([functools.partial(jitter, delay=0.05)], num_workers=1, depth=1, drop=True)
+    run(pipeline, 10)
+    stats = pipeline.stats()
+    assert stats['frames skipped'] > 0
+    assert stats['frames processed'] + stats['frames skipped'] == 10
+    seqs = [seq for seq, result in pipeline.results]
+    assert seqs == sorted(seqs)
+
+
+def test_errors_raised_on_close():
+    pipeline = ProcessingPipeline([fail_on_third])
+    with pytest.raises(UserWarning):
+        run(pipeline, 6)
+    assert pipeline.stats()['errors'] == 1
+    assert [seq for seq, result in pipeline.results] == [100, 101, 102, 104, 105]
+
+
+def test_centroid():
+    frame = np.zeros(SHAPE, dtype=np.uint16)
+    frame[10:13, 20:25] = 1000
+    x, y, counts = centroid(frame)
+    assert (x, y) == pytest.approx((22, 11))
+    assert counts > 0
+    x, y, counts = centroid(np.ones(SHAPE, dtype=np.uint16))
+    assert np.isnan(x) and np.isnan(y) and counts == 0
+
+
+def test_record_to_memory_sink():
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi((1, 1, 320, 240)).timestamp_mode(1).commit()
+    camera.allocate_buffer()
+    camera.start_recording()
+    pipeline = ProcessingPipeline([centroid])
+    try:
+        camera.record_to_memory(30, verbose=False, sinks=[pipeline])
+    finally:
+        camera.close_camera()
+    seqs = [seq for seq, result in pipeline.results]
+    assert len(seqs) == 30
+    assert np.all(np.diff(seqs) == 1)
+    # the spot of the simulated camera is in the middle of the roi
+    x, y, counts = pipeline.results[0][1]
+    assert (x, y) == pytest.approx((160, 120), abs=5)
@@ -0,0 +1,120 @@
+__author__ = 'Polychronis Patapis'
+import time
+import numpy as np
+from QtGUI.core.pco_preview import DisplayLUT, PreviewWorker, decimate
+from QtGUI.core.pco_ring import FrameRing
+
+
+def test_linear_uint16_is_identity():
+    lut = DisplayLUT(100, 1000)
+    assert lut.table is None
+    image = np.arange(20, dtype=np.uint16).reshape(4, 5)
+    assert lut.apply(image) is image
+
+
+def test_log_uint16_maps_levels_on_themselves():
+    lut = DisplayLUT(100, 10000, log=True)
+    counts = np.array([0, 100, 1000, 10000, 16383], dtype=np.uint16)
+    display = lut.apply(counts)
+    assert display.dtype == np.uint16
+    # clipped to the levels, 1000 is half way between 100 and 10000 on a log scale
+    assert list(display) == [100, 100, 5050, 10000, 10000]
+
+
+def test_uint8():
+    counts = np.array([0, 100, 550, 1000, 2000], dtype=np.uint16)
+    assert list(DisplayLUT(100, 1000, dtype=np.uint8).apply(counts)) == [0, 0, 128, 255, 255]
+    log = DisplayLUT(100, 10000, log=True, dtype=np.uint8)
+    assert list(log.apply(np.array([100, 1000, 10000], dtype=np.uint16))) == [0, 128, 255]
+
+
+def test_table_rebuilt_only_on_change():
+    lut = DisplayLUT(100, 1000, log=True)
+    table = lut.table
+    lut.set(100, 1000)
+    assert lut.table is table
+    lut.set(log=False)
+    assert lut.table is None
+    assert lut.levels == (100, 1000, False)
+
+
+def test_apply_out():
+    lut = DisplayLUT(100, 1000, dtype=np.uint8)
+    out = np.empty((2, 2), dtype=np.uint8)
+    assert lut.apply(np.full((2, 2), 1000, dtype=np.uint16), out=out) is out
+    assert np.all(out == 255)
+
+
+def test_render_applies_lut():
+    worker = PreviewWorker(camera=None, display_dtype=np.uint8)
+    worker.set_levels(0, 16383)
+    frame = np.full((40, 60), 16383, dtype=np.uint16)
+    frame[:, :30] = 0
+    worker.set_viewport((0, 60), (0, 40), (30, 20))
+    preview = worker.render(frame, 7, 1., None)
+    # decimated by 2 and transposed to (x, y)
+    assert preview.image.shape == (30, 20)
+    assert preview.image.dtype == np.uint8
+    assert np.all(preview.image[:15] == 0) and np.all(preview.image[15:] == 255)
+    assert preview.rect == (0, 0, 60, 40)
+    assert preview.seq == 7
+    assert not worker.changed
+
+
+class Camera(object):
+    def __init__(self, ring):
+        self.ring = ring
+
+
+def test_decimate_mean_max_crop():
+    image = np.arange(7*9, dtype=np.uint16).reshape(7, 9)
+    mean = decimate(image, 3)
+    # cropped to 6 x 9, block means of the uint16 image
+    assert mean.shape == (2, 3) and mean.dtype == np.uint16
+    expected = image[:6].reshape(2, 3, 3, 3).mean(axis=(1, 3))
+    assert np.array_equal(mean, np.floor(expected).astype(np.uint16))
+    assert np.array_equal(decimate(image, 3, 'max'), image[:6].reshape(2, 3, 3, 3).max(axis=(1, 3)))
+    assert decimate(image, 1) is image
+
+
+def test_decimate_mean_does_not_overflow():
+    image = np.full((8, 8), 16383, dtype=np.uint16)
+    assert np.all(decimate(image, 8) == 16383)
+
+
+def test_render_zoomed_viewport():
+    worker = PreviewWorker(camera=None)
+    frame = np.arange(40*60, dtype=np.uint16).reshape(40, 60)
+    # zoomed in: the visible region is smaller than the view box, no decimation
+    worker.set_viewport((10.5, 20.2), (5, 15), (400, 300))
+    preview = worker.render(frame, 0, 0., None)
+    assert preview.rect == (10, 5, 11, 10)
+    assert np.array_equal(preview.image, frame[5:15, 10:21].T)
+    # zoomed out beyond the frame: clipped to the frame and decimated to the view box
+    worker.set_viewport((-100, 200), (-50, 100), (15, 10))
+    preview = worker.render(frame, 0, 0., None)
+    assert preview.rect == (0, 0, 60, 40)
+    assert preview.image.shape == (15, 10)
+
+
+def test_worker_shows_latest_frame():
+    ring = FrameRing(4, (40, 60))
+    worker = PreviewWorker(Camera(ring), rate=100.)
+    worker.set_viewport((0, 60), (0, 40), (60, 40))
+    for i in range(3):
+        ring.put(np.full((40, 60), i, dtype=np.uint16))
+    worker.start()
+    try:
+        deadline = time.perf_counter() + 5
+        preview = None
+        while preview is None and time.perf_counter() < deadline:
+            time.sleep(0.01)
+            preview = worker.latest()
+    finally:
+        worker.stop()
+        worker.join(5)
+    assert preview is not None
+    assert preview.seq == 2
+    assert np.all(preview.image == 2)
+    # the older frames are skipped
+    assert ring.stats()['dropped'] == 2
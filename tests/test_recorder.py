@@ -0,0 +1,87 @@
+__author__ = 'Polychronis Patapis'
+import numpy as np
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_recorder import StreamRecorder, ALIGNMENT
+from QtGUI.core.pco_stack import load_stack, read_header
+from QtGUI.core.pco_timestamp import decode_timestamp
+
+SHAPE = (24, 40)
+ROI = (1, 1, 320, 240)
+
+
+class Frame(object):
+    def __init__(self, array, seq, time, camera_time=None):
+        self.array = array
+        self.seq = seq
+        self.time = time
+        self.camera_time = camera_time
+
+
+def frames(num_frames, seed=0):
+    return np.random.default_rng(seed).integers(0, 16384, (num_frames,) + SHAPE).astype(np.uint16)
+
+
+def record(recorder, stack, camera_times=False):
+    recorder.open(SHAPE)
+    for i, array in enumerate(stack):
+        recorder.put(Frame(array, 10 + i, 1000. + i, 2000. + i if camera_times else None))
+    recorder.close()
+    return recorder
+
+
+@pytest.mark.parametrize('direct', [False, True])
+def test_round_trip(tmp_path, direct):
+    # 1920 bytes per frame: 32 frames per aligned chunk, the last chunk is partial
+    file_name = str(tmp_path / 'stack_raw')
+    stack = frames(75)
+    recorder = record(StreamRecorder(file_name, chunk_bytes=40000, direct=direct), stack)
+    assert recorder.chunk_frames == 32
+    assert recorder.chunk_frames*recorder.frame_bytes % ALIGNMENT == 0
+    # unaligned tail of an O_DIRECT write is truncated on close
+    assert np.array_equal(load_stack(file_name), stack)
+    stats = recorder.stats()
+    assert stats['frames written'] == 75
+    assert stats['bytes written'] == stack.nbytes
+    header = read_header(file_name)
+    assert header['seq'] == list(range(10, 85))
+    assert header['times'] == [1000. + i for i in range(75)]
+    assert 'camera times' not in header
+
+
+def test_camera_times_in_header(tmp_path):
+    file_name = str(tmp_path / 'stack_raw')
+    record(StreamRecorder(file_name, direct=False), frames(5), camera_times=True)
+    assert read_header(file_name)['camera times'] == [2000. + i for i in range(5)]
+
+
+def test_bounded_chunks_in_flight(tmp_path):
+    # no memory budget still gives 2 chunks of the smallest aligned size, put waits for the writers
+    file_name = str(tmp_path / 'stack_raw')
+    stack = frames(40)
+    recorder = record(StreamRecorder(file_name, chunk_bytes=0, max_inflight_bytes=0, num_writers=1,
+                                     direct=False), stack)
+    stats = recorder.stats()
+    assert (stats['chunks'], recorder.chunk_frames) == (2, 32)
+    assert stats['max backlog'] <= 2
+    assert np.array_equal(load_stack(file_name), stack)
+
+
+def test_record_to_file(tmp_path):
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).timestamp_mode(1).commit()
+    camera.allocate_buffer()
+    camera.start_recording()
+    try:
+        stats = camera.record_to_file(50, preframes=2, file_name='run_raw', save_path=tmp_path,
+                                      chunk_bytes=2**20)
+    finally:
+        camera.close_camera()
+    assert stats['frames written'] == 48
+    stack = load_stack(str(tmp_path / 'run_raw'))
+    assert stack.shape == (48, ROI[3], ROI[2])
+    seqs = [decode_timestamp(frame)[0] for frame in stack]
+    assert seqs == read_header(str(tmp_path / 'run_raw'))['seq']
+    assert np.all(np.diff(seqs) == 1)
@@ -0,0 +1,141 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import time
+from collections import Counter
+import numpy as np
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_ring import FrameRing
+from QtGUI.core.pco_timestamp import decode_timestamp
+
+ROI = (1, 1, 320, 240)
+
+
+def wait_for(condition, timeout=10.):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        value = condition()
+        if value:
+            return value
+        time.sleep(0.005)
+    raise AssertionError('condition not met in %.1f s' % timeout)
+
+
+def test_drop_oldest():
+    ring = FrameRing(3, (2, 2), policy='drop-oldest')
+    for i in range(5):
+        ring.put(np.full((2, 2), i, dtype=np.uint16))
+    out = np.empty((2, 2), dtype=np.uint16)
+    seqs = []
+    while len(ring):
+        seq, timestamp, info = ring.get(out, timeout=0)
+        assert np.all(out == seq)
+        seqs.append(seq)
+    assert seqs == [2, 3, 4]
+    assert ring.stats()['dropped'] == 2
+
+
+def test_drop_newest():
+    ring = FrameRing(3, (2, 2), policy='drop-newest')
+    results = [ring.put(np.full((2, 2), i, dtype=np.uint16)) for i in range(5)]
+    assert results == [0, 1, 2, None, None]
+    out = np.empty((2, 2), dtype=np.uint16)
+    assert [ring.get(out, timeout=0)[0] for i in range(3)] == [0, 1, 2]
+    assert ring.get(out, timeout=0) is None
+
+
+def test_block_times_out():
+    ring = FrameRing(1, (2, 2), policy='block')
+    assert ring.put(np.zeros((2, 2), dtype=np.uint16)) == 0
+    assert ring.put(np.zeros((2, 2), dtype=np.uint16), timeout=0.01) is None
+    stats = ring.stats()
+    assert (stats['produced'], stats['dropped'], stats['queued']) == (2, 1, 1)
+
+
+def test_latest():
+    ring = FrameRing(4, (2, 2))
+    for i in range(3):
+        ring.put(np.full((2, 2), i, dtype=np.uint16), info=i)
+    out = np.empty((2, 2), dtype=np.uint16)
+    assert ring.get(out, latest=True)[2] == 2
+    assert np.all(out == 2)
+    assert ring.stats()['dropped'] == 2
+
+
+class CountingBackend(SimulatedBackend):
+    """
+    SimulatedBackend counting the PCO_AddBufferEx calls of every buffer number.
+    """
+
+    def __init__(self, *args, **kwargs):
+        SimulatedBackend.__init__(self, *args, **kwargs)
+        self.added = Counter()
+
+    def PCO_AddBufferEx(self, hCam, dw1stImage, dwLastImage, sBufNr, wXRes, wYRes, wBitPerPixel):
+        self.added[sBufNr.value] += 1
+        return SimulatedBackend.PCO_AddBufferEx(self, hCam, dw1stImage, dwLastImage, sBufNr, wXRes, wYRes,
+                                                wBitPerPixel)
+
+
+def held_buffers(camera, ring):
+    """
+    :return: numbers of the buffers of the leases held by the ring and of the buffers in the driver queue
+    """
+    backend = camera.PixFlyDLL
+    with ring.cond:
+        held = [camera.buffer_numbers[lease.buffer].value for lease in ring.leases if lease is not None]
+        with backend.lock:
+            queued = list(backend.queue)
+    return held, queued
+
+
+@pytest.mark.parametrize('policy', FrameRing.policies)
+def test_live_leases(policy):
+    # 20 ms exposure on a small roi, 50 fps: the buffers sized for the latency budget leave spare buffers
+    backend = CountingBackend(frame_rate=13.5, seed=0)
+    camera = PixelFly(backend=backend)
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(20, 2).roi(ROI).timestamp_mode(1).commit()
+    camera.ring_policy = policy
+    camera.allocate_buffer(held=camera.ring_capacity)
+    assert camera.buffers.spare() >= camera.ring_capacity
+    camera.start_recording()
+    thread = threading.Thread(target=camera.record_live)
+    thread.start()
+    try:
+        ring = wait_for(lambda: camera.ring)
+        assert ring.max_leases == ring.capacity
+        # nothing is read: the ring fills with leases, their buffers are out of the driver queue
+        wait_for(lambda: ring.stats()['leases'] == ring.capacity)
+        held, queued = held_buffers(camera, ring)
+        assert len(held) == ring.capacity
+        assert not set(held) & set(queued)
+        added = dict((number, backend.added[number]) for number in held)
+        time.sleep(0.1)
+        if policy == 'drop-oldest':
+            # the overwritten frames release their leases
+            assert ring.stats()['dropped'] > 0
+            assert ring.stats()['leases'] == ring.capacity
+        else:
+            # the same frames stay held, their buffers are not queued again
+            assert held_buffers(camera, ring)[0] == held
+            assert dict((number, backend.added[number]) for number in held) == added
+        # reading copies the frames out of the leases, which are released and their buffers requeued
+        frame = np.empty(ring.shape, dtype=np.uint16)
+        for i in range(3*ring.capacity):
+            seq, timestamp, info = ring.get(frame, timeout=5)
+            assert decode_timestamp(frame)[0] == seq
+        wait_for(lambda: all(backend.added[number] > added[number] for number in held))
+    finally:
+        camera.live = False
+        thread.join(10)
+    assert not thread.is_alive()
+    stats = ring.stats()
+    assert stats['leases'] == 0
+    assert stats['produced'] == stats['consumed'] + stats['dropped'] + stats['queued']
+    if policy == 'block':
+        assert stats['dropped'] == 0
+    assert camera.engine.stats()['gaps'] == 0
+    assert camera.engine.stats()['frames dropped'] == 0
+    camera.close_camera()
@@ -0,0 +1,119 @@
+__author__ = 'Polychronis Patapis'
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from QtGUI.core.pco_server import FrameServer, FrameSubscriber, SharedFrameRing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Frame(object):
+    def __init__(self, value, seq, shape=(4, 6)):
+        self.array = np.full(shape, value, dtype=np.uint16)
+        self.seq = seq
+        self.timestamp = float(seq)
+        self.time = 1e9 + seq
+
+
+def serve(server, frames):
+    server.open(frames[0].array.shape)
+    for frame in frames:
+        server.put(frame)
+
+
+def wait_subscribed(server, num_subscribers=1):
+    # the accept thread of the server registers the subscribers
+    for i in range(500):
+        if server.stats()['subscribers'] == num_subscribers:
+            return
+        time.sleep(0.01)
+    raise AssertionError('subscriber not accepted')
+
+
+def test_delivery_in_order():
+    server = FrameServer(capacity=8)
+    subscribers = [FrameSubscriber(server.address) for i in range(2)]
+    try:
+        wait_subscribed(server, 2)
+        serve(server, [Frame(10 + i, 100 + i) for i in range(5)])
+        for subscriber in subscribers:
+            for i in range(5):
+                frame = subscriber.get(timeout=5)
+                assert (frame.seq, frame.timestamp, frame.time) == (100 + i, 100. + i, 1e9 + 100 + i)
+                assert np.all(frame.copy() == 10 + i)
+        assert server.stats() == {'published': 5, 'subscribers': 2, 'dropped': 0}
+    finally:
+        for subscriber in subscribers:
+            subscriber.close()
+        server.shutdown()
+
+
+def test_overwritten_frame_is_not_copied():
+    server = FrameServer(capacity=2)
+    subscriber = FrameSubscriber(server.address)
+    try:
+        wait_subscribed(server)
+        serve(server, [Frame(0, 0)])
+        frame = subscriber.get(timeout=5)
+        assert frame.seq == 0 and frame.valid()
+        for i in (1, 2):
+            server.put(Frame(i, i))
+        # frame 2 went to the slot of frame 0
+        assert not frame.valid()
+        assert frame.copy() is None
+        assert [subscriber.get(timeout=5).seq for i in (1, 2)] == [1, 2]
+    finally:
+        subscriber.close()
+        server.shutdown()
+
+
+def test_new_ring_for_new_shape():
+    server = FrameServer(capacity=4)
+    subscriber = FrameSubscriber(server.address)
+    try:
+        wait_subscribed(server)
+        serve(server, [Frame(1, 0)])
+        assert subscriber.get(timeout=5).array.shape == (4, 6)
+        serve(server, [Frame(2, 1, shape=(3, 3))])
+        frame = subscriber.get(timeout=5)
+        assert frame.array.shape == (3, 3)
+        assert np.all(frame.copy() == 2)
+    finally:
+        subscriber.close()
+        server.shutdown()
+
+
+def test_attach_in_owner_process():
+    ring = SharedFrameRing(2, (4, 4))
+    try:
+        attached = SharedFrameRing(2, (4, 4), name=ring.name)
+        ring.write(1, np.full((4, 4), 7, dtype=np.uint16), 5)
+        assert attached.valid(1, 5)
+        assert np.all(attached.frames[1] == 7)
+        attached.close()
+    finally:
+        ring.close()
+
+
+def test_same_process_subscriber_keeps_owner_registration():
+    # a subscriber in the process of the server must not unregister the block of the server from the
+    # resource tracker, which then fails at exit
+    code = '\n'.join([
+        'import sys',
+        'sys.path.insert(0, %r)' % os.path.join(ROOT, 'tests'),
+        'import conftest',
+        'from test_server import Frame, serve, wait_subscribed',
+        'from QtGUI.core.pco_server import FrameServer, FrameSubscriber',
+        'server = FrameServer()',
+        'subscriber = FrameSubscriber(server.address)',
+        'wait_subscribed(server)',
+        'serve(server, [Frame(1, 0)])',
+        'assert subscriber.get(timeout=5).copy() is not None',
+        'subscriber.close()',
+        'server.shutdown()'])
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert 'Traceback' not in result.stderr
+    assert 'leaked' not in result.stderr
@@ -0,0 +1,143 @@
+__author__ = 'Polychronis Patapis'
+import time
+import numpy as np
+import pytest
+from astropy.io import fits
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_container import ContainerReader
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_service import AcquisitionService
+from QtGUI.core.pco_stack import load_stack
+
+ROI = (1, 1, 320, 240)
+
+
+@pytest.fixture
+def service():
+    service = AcquisitionService(PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0)))
+    assert service.execute('connect')
+    service.configure(roi=ROI, exposure=(5, 2), timestamp_mode=1)
+    yield service
+    service.disconnect()
+
+
+def wait_for_frames(camera, num_frames, timeout=10.):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if camera.ring is not None and camera.ring.stats()['produced'] >= num_frames:
+            return
+        time.sleep(0.01)
+    raise AssertionError('no frames in %.1f s' % timeout)
+
+
+def test_not_connected():
+    service = AcquisitionService(PixelFly(backend=SimulatedBackend(seed=0)))
+    with pytest.raises(UserWarning):
+        service.configure(exposure=(5, 2))
+    with pytest.raises(UserWarning):
+        service.start_live()
+    assert service.status()['connected'] is False
+    assert 'settings' not in service.status()
+
+
+def test_unknown_command(service):
+    with pytest.raises(UserWarning):
+        service.execute('format_disk')
+
+
+def test_configure(service):
+    assert service.execute('configure', binning=(2, 2), roi=(1, 1, 100, 80)) == {'binning': [2, 2],
+                                                                                 'ROI': [1, 1, 100, 80]}
+    assert service.configure(roi=(1, 1, 100, 80)) == {}
+    settings = service.status()['settings']
+    assert (settings['ROI'], settings['BINNING'], settings['TSMODE']) == ([1, 1, 100, 80], [2, 2], 'binary')
+
+
+def test_live(service):
+    service.start_live()
+    try:
+        assert service.busy and service.mode == 'live'
+        wait_for_frames(service.camera, 20)
+        # one acquisition at a time, only times change during an acquisition
+        with pytest.raises(UserWarning):
+            service.record(10, 'other.npy')
+        with pytest.raises(UserWarning):
+            service.configure(roi=(1, 1, 64, 64))
+        assert service.configure(exposure=(6, 2)) == {'Exposure time': [6, 'ms']}
+        status = service.status()
+        assert status['mode'] == 'live' and status['armed']
+        assert status['ring']['produced'] >= 20
+        assert status['buffers']['held'] == service.camera.ring_capacity
+    finally:
+        service.stop()
+    assert not service.busy
+    status = service.status()
+    assert (status['mode'], status['armed'], status['error']) == ('idle', False, None)
+    assert status['engine']['frames acquired'] >= 20
+    assert status['engine']['gaps'] == 0
+
+
+@pytest.mark.parametrize('file_name', ['run.npy', 'run_raw', 'run.pcoc', 'run.fits'])
+def test_record_by_extension(service, tmp_path, file_name):
+    file_name = str(tmp_path / file_name)
+    result = service.execute('record', num_images=12, file_name=file_name, preframes=2)
+    assert service.status()['mode'] == 'idle'
+    if file_name.endswith('.pcoc'):
+        assert result > 1
+        reader = ContainerReader(file_name)
+        assert len(reader) == 10
+        reader.close()
+    elif file_name.endswith('.fits'):
+        with fits.open(file_name) as hdus:
+            assert hdus[0].data.shape == (10, ROI[3], ROI[2])
+    else:
+        assert load_stack(file_name).shape == (10, ROI[3], ROI[2])
+
+
+def test_record_without_wait(service, tmp_path):
+    file_name = str(tmp_path / 'run.npy')
+    assert service.record(30, file_name, wait=False) is None
+    assert service.busy
+    assert service.wait(10)
+    assert service.result.shape == (30, ROI[3], ROI[2])
+    # the buffers are kept for the next acquisition
+    assert service.status()['buffers']['acquisitions'] == 1
+    assert service.record(5, file_name).shape == (5, ROI[3], ROI[2])
+    assert service.status()['buffers']['acquisitions'] == 2
+
+
+def test_failed_acquisition_reported(service, tmp_path):
+    # the error of the worker thread is raised in the caller
+    with pytest.raises(OSError):
+        service.record(10, str(tmp_path / 'missing' / 'run.pcoc'))
+    status = service.status()
+    assert status['error'] is not None
+    assert (status['mode'], status['armed']) == ('idle', False)
+
+
+def test_accumulate(service, tmp_path):
+    result = service.accumulate(20)
+    assert result['frames'] == 20
+    assert result['mean'].shape == (ROI[3], ROI[2])
+    file_name = str(tmp_path / 'mean.npz')
+    service.accumulate(10, file_name=file_name)
+    with np.load(file_name) as saved:
+        assert saved['mean'].shape == (ROI[3], ROI[2])
+
+
+def test_accumulate_until_stop(service):
+    service.accumulate(interval=5, wait=False)
+    try:
+        wait_for_frames(service.camera, 2)
+    finally:
+        service.stop()
+    assert service.result['frames'] >= 10
+
+
+def test_disconnect(service):
+    service.start_live()
+    wait_for_frames(service.camera, 5)
+    service.disconnect()
+    assert not service.busy
+    assert not service.connected
+    assert len(service.camera.buffers) == 0
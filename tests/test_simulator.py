@@ -0,0 +1,73 @@
+__author__ = 'Polychronis Patapis'
+import threading
+import time
+import numpy as np
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+
+NUM_IMAGES = 100
+ROI = (1, 1, 320, 240)
+
+
+@pytest.fixture
+def camera():
+    """
+    Armed and recording PixelFly on the simulated camera: 5 ms exposure on a small ROI, about 95 fps,
+    with the binary timestamp on so the sequence numbers are the image counter of the camera.
+    """
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).timestamp_mode(1).commit()
+    yield camera
+    camera.live = False
+    camera.disarm_camera()
+    camera.close_camera()
+
+
+def check_engine(camera, num_images):
+    stats = camera.engine.stats()
+    assert stats['frames acquired'] >= num_images
+    assert stats['frames dropped'] == 0
+    assert stats['gaps'] == 0
+    assert stats['frames missed'] == 0
+    assert not camera.engine.timed_out
+
+
+def test_record_to_memory(camera):
+    camera.allocate_buffer()
+    camera.start_recording()
+    stack = camera.record_to_memory(NUM_IMAGES, verbose=False)
+    assert stack.shape == (NUM_IMAGES, ROI[3], ROI[2])
+    check_engine(camera, NUM_IMAGES)
+    assert camera.engine.stats()['frames acquired'] == NUM_IMAGES
+    # sequence continuity from the image counter stamped in the frames
+    first, last = camera.engine.first_frame[0], camera.engine.last_frame[0]
+    assert last - first == NUM_IMAGES - 1
+
+
+@pytest.mark.parametrize('record', ['record_to_memory_2', 'record_live'])
+def test_live(camera, record):
+    camera.allocate_buffer(held=camera.ring_capacity)
+    camera.start_recording()
+    thread = threading.Thread(target=getattr(camera, record))
+    thread.start()
+    try:
+        deadline = time.perf_counter() + 10
+        while camera.ring is None and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        assert camera.ring is not None
+        frame = np.empty(camera.ring.shape, dtype=np.uint16)
+        seqs = []
+        while len(seqs) < NUM_IMAGES:
+            result = camera.ring.get(frame, timeout=5)
+            assert result is not None
+            seqs.append(result[0])
+    finally:
+        camera.live = False
+        thread.join(10)
+    assert not thread.is_alive()
+    assert np.all(np.diff(seqs) == 1)
+    assert camera.ring.stats()['dropped'] == 0
+    assert camera.ring.stats()['leases'] == 0
+    check_engine(camera, NUM_IMAGES)
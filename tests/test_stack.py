@@ -0,0 +1,51 @@
+__author__ = 'Polychronis Patapis'
+import numpy as np
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_stack import open_stack, load_stack, read_header
+from QtGUI.core.pco_timestamp import decode_timestamp
+
+ROI = (1, 1, 320, 240)
+
+
+@pytest.mark.parametrize('file_name', ['stack.npy', 'stack_raw'])
+def test_open_and_load(tmp_path, file_name):
+    file_name = str(tmp_path / file_name)
+    stack = open_stack(file_name, 4, (3, 5), exposure=10)
+    assert stack.shape == (4, 3, 5) and stack.dtype == np.uint16
+    stack[:] = np.arange(60, dtype=np.uint16).reshape(4, 3, 5)
+    stack.flush()
+    del stack
+    loaded = load_stack(file_name)
+    assert np.array_equal(loaded, np.arange(60).reshape(4, 3, 5))
+    with pytest.raises(ValueError):
+        loaded[0, 0, 0] = 1
+    if not file_name.endswith('.npy'):
+        assert read_header(file_name)['exposure'] == 10
+
+
+def test_load_raw_without_header(tmp_path):
+    file_name = str(tmp_path / 'stack_raw')
+    open(file_name, 'wb').close()
+    with pytest.raises(UserWarning):
+        load_stack(file_name)
+
+
+def test_record_to_memory_mapped_stack(tmp_path):
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).timestamp_mode(1).commit()
+    camera.allocate_buffer()
+    camera.start_recording()
+    file_name = str(tmp_path / 'run.npy')
+    try:
+        stack = camera.record_to_memory(30, preframes=3, verbose=False, out=file_name)
+    finally:
+        camera.close_camera()
+    assert isinstance(stack, np.memmap)
+    loaded = load_stack(file_name)
+    assert loaded.shape == (27, ROI[3], ROI[2])
+    assert np.array_equal(loaded, stack)
+    seqs = [decode_timestamp(frame)[0] for frame in loaded]
+    assert np.all(np.diff(seqs) == 1)
@@ -0,0 +1,116 @@
+__author__ = 'Polychronis Patapis'
+import ctypes
+from collections import Counter
+import pytest
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+
+ROI = (1, 1, 320, 240)
+
+
+class AdjustingBackend(SimulatedBackend):
+    """
+    SimulatedBackend counting the SC2_Cam calls, that rounds exposure times to even values.
+    """
+
+    def __init__(self, *args, **kwargs):
+        SimulatedBackend.__init__(self, *args, **kwargs)
+        self.calls = Counter()
+
+    def __getattribute__(self, name):
+        if name.startswith('PCO_'):
+            self.calls[name] += 1
+        return SimulatedBackend.__getattribute__(self, name)
+
+    def PCO_SetDelayExposureTime(self, hCam, dwDelay, dwExposure, wTimeBaseDelay, wTimeBaseExposure):
+        exposure = ctypes.c_uint32(dwExposure.value//2*2)
+        return SimulatedBackend.PCO_SetDelayExposureTime(self, hCam, dwDelay, exposure, wTimeBaseDelay,
+                                                         wTimeBaseExposure)
+
+
+@pytest.fixture
+def camera():
+    camera = PixelFly(backend=AdjustingBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(6, 2).roi(ROI).commit()
+    camera.PixFlyDLL.calls.clear()
+    yield camera
+    camera.close_camera()
+
+
+def get_calls(camera):
+    return dict((name, n) for name, n in camera.PixFlyDLL.calls.items() if name.startswith('PCO_Get'))
+
+
+def test_open_reads_settings_once():
+    backend = AdjustingBackend(frame_rate=13.5, seed=0)
+    backend.roi, backend.bin = [1, 1, 200, 100], [2, 2]
+    camera = PixelFly(backend=backend)
+    assert camera.open_camera()
+    # settings of an earlier session
+    assert camera.set_params['ROI'] == [1, 1, 200, 100]
+    assert camera.set_params['binning'] == [2, 2]
+    calls = get_calls(camera)
+    camera.get_exposure_time()
+    camera.state.get('ROI')
+    camera.state.get('Timestamp mode')
+    assert get_calls(camera) == calls
+    camera.close_camera()
+
+
+def test_get_is_cached(camera):
+    assert camera.get_exposure_time() == [6, 'ms']
+    assert camera.state.get('Camera ROI dimensions') == [320, 240]
+    assert camera.metadata()['ROI'] == list(ROI)
+    assert get_calls(camera) == {}
+
+
+def test_invalid_setting_read_once(camera):
+    camera.state.invalidate('Exposure time')
+    assert camera.get_exposure_time() == [6, 'ms']
+    assert camera.get_exposure_time() == [6, 'ms']
+    assert get_calls(camera) == {'PCO_GetDelayExposureTime': 1}
+
+
+def test_image_size_invalid_until_arm(camera):
+    camera.configure(arm=False).roi((1, 1, 64, 32)).commit()
+    assert 'Camera ROI dimensions' not in camera.state.valid
+    camera.configure(arm=True).commit()
+    assert 'Camera ROI dimensions' in camera.state.valid
+    assert camera.state.get('Camera ROI dimensions') == [64, 32]
+    assert get_calls(camera) == {'PCO_GetSizes': 1}
+
+
+def test_close_invalidates(camera):
+    camera.close_camera()
+    assert not camera.state.valid
+    assert not camera.armed
+    assert camera.open_camera()
+    assert camera.state.valid == set(camera.state.KEYS)
+
+
+def test_listeners(camera):
+    keys = []
+    camera.state.listeners.append(keys.append)
+    camera.configure().exposure_time(8, 2).commit()
+    camera.state.invalidate('ROI')
+    assert ('Exposure time',) in keys
+    assert ('ROI',) in keys
+
+
+def test_check_finds_changes_behind_the_cache(camera):
+    camera.PixFlyDLL.roi = [1, 1, 100, 100]
+    assert camera.state.check('ROI', 'binning') == {'ROI': (list(ROI), [1, 1, 100, 100])}
+    # the values of the camera are kept
+    assert camera.state.get('ROI') == [1, 1, 100, 100]
+    assert camera.state.check() == {}
+
+
+def test_verify(camera, capsys):
+    # without verify the cache keeps the requested value
+    camera.configure().exposure_time(7, 2).commit()
+    assert camera.get_exposure_time() == [7, 'ms']
+    camera.state.verify = True
+    camera.configure().exposure_time(9, 2).commit()
+    assert 'Camera adjusted Exposure time : [9, \'ms\'] -> [8, \'ms\']' in capsys.readouterr().out
+    assert camera.get_exposure_time() == [8, 'ms']
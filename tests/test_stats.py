@@ -0,0 +1,106 @@
+__author__ = 'Polychronis Patapis'
+import numpy as np
+import pytest
+from QtGUI.core.pco_acquisition import CallbackSink
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_stats import FrameStatistics
+
+
+@pytest.fixture
+def frame():
+    frame = np.random.default_rng(0).integers(100, 4000, (240, 320)).astype(np.uint16)
+    # saturated pixels off the stride-2 grid too
+    frame[1, 1:8] = 16383
+    frame[101, 3] = 16383
+    frame[7, 5] = 3
+    return frame
+
+
+def test_against_numpy(frame):
+    stats = FrameStatistics().compute(frame)
+    assert (stats['min'], stats['max']) == (frame.min(), frame.max())
+    assert stats['mean'] == pytest.approx(frame.mean())
+    assert stats['saturated'] == 8
+    assert stats['bin_width'] == 1
+    assert np.array_equal(stats['histogram'], np.bincount(frame.ravel(), minlength=2**14))
+
+
+def test_saturation_level(frame):
+    stats = FrameStatistics(saturation=3900).compute(frame)
+    assert stats['saturated'] == np.count_nonzero(frame >= 3900)
+
+
+def test_counts_above_bits_in_last_bin():
+    frame = np.array([[0, 5, 16383, 65535]], dtype=np.uint16)
+    stats = FrameStatistics().compute(frame)
+    assert len(stats['histogram']) == 2**14
+    assert stats['histogram'][-1] == 2
+    assert stats['saturated'] == 2
+
+
+def test_bins_must_divide_counts():
+    with pytest.raises(UserWarning):
+        FrameStatistics(bins=1000)
+    with pytest.raises(UserWarning):
+        FrameStatistics(bins=2**15)
+
+
+def test_rois_and_lines(frame):
+    statistics = FrameStatistics()
+    statistics.set_roi('spot', (10, 20), (30, 35))
+    statistics.set_roi('outside', (400, 500), (0, 10))
+    statistics.set_line('diagonal', [0, 5, 10, 1000], [0, 5, 10, -3])
+    stats = statistics.compute(frame)
+    region = frame[30:35, 10:20]
+    assert stats['rois']['spot'] == (pytest.approx(region.mean()), region.max())
+    assert stats['rois']['outside'] is None
+    # points outside of the frame are clipped to its border
+    assert list(stats['lines']['diagonal']) == [frame[0, 0], frame[5, 5], frame[10, 10], frame[0, 319]]
+    statistics.remove('spot')
+    statistics.remove('diagonal')
+    stats = statistics.compute(frame)
+    assert list(stats['rois']) == ['outside'] and stats['lines'] == {}
+
+
+def test_engine_computes_statistics():
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi((1, 1, 320, 240)).commit()
+    camera.allocate_buffer()
+    camera.start_recording()
+    statistics = FrameStatistics()
+    results = []
+
+    def callback(frame):
+        expected = statistics.compute(frame.array)
+        results.append(frame.stats is not None and frame.stats['max'] == expected['max'] and
+                       np.array_equal(frame.stats['histogram'], expected['histogram']))
+
+    try:
+        assert camera.engine.run([CallbackSink(callback)], 10, statistics=statistics)
+    finally:
+        camera.close_camera()
+    assert results == [True]*10
+
+
+def test_stride_histogram(frame):
+    statistics = FrameStatistics(bins=1024, stride=2)
+    stats = statistics.compute(frame)
+    expected = np.bincount(frame[::2, ::2].ravel(), minlength=2**14).reshape(1024, 16).sum(axis=1)
+    assert stats['bin_width'] == 16
+    assert np.array_equal(stats['histogram'], expected)
+    assert stats['mean'] == pytest.approx(frame[::2, ::2].mean())
+
+
+def test_stride_extrema_and_saturation_exact(frame):
+    stats = FrameStatistics(stride=2).compute(frame)
+    assert (stats['min'], stats['max']) == (3, 16383)
+    assert stats['saturated'] == 8
+
+
+def test_stride_without_saturation(frame):
+    frame = np.minimum(frame, 8000)
+    stats = FrameStatistics(stride=4).compute(frame)
+    assert stats['saturated'] == 0
+    assert stats['max'] == 8000
@@ -0,0 +1,90 @@
+__author__ = 'Polychronis Patapis'
+import datetime
+import time
+import numpy as np
+import pytest
+from QtGUI.core.pco_acquisition import CallbackSink
+from QtGUI.core.pco_backend import SimulatedBackend
+from QtGUI.core.pco_definitions import PixelFly
+from QtGUI.core.pco_timestamp import encode_timestamp, decode_timestamp, TIMESTAMP_PIXELS
+
+ROI = (1, 1, 320, 240)
+
+
+def test_round_trip():
+    when = datetime.datetime(2024, 2, 29, 23, 59, 58, 123456).timestamp()
+    stamp = encode_timestamp(12345678, when)
+    assert len(stamp) == TIMESTAMP_PIXELS and stamp.dtype == np.uint16
+    # two BCD digits per pixel
+    assert list(stamp[:4]) == [0x12, 0x34, 0x56, 0x78]
+    frame = np.full((4, 20), 1000, dtype=np.uint16)
+    frame.reshape(-1)[:TIMESTAMP_PIXELS] = stamp
+    number, decoded = decode_timestamp(frame)
+    assert number == 12345678
+    assert decoded == pytest.approx(when, abs=1e-6)
+
+
+def test_counter_wraps():
+    assert decode_timestamp(encode_timestamp(10**8 + 5, time.time()))[0] == 5
+
+
+def test_invalid():
+    stamp = encode_timestamp(1, time.time())
+    assert decode_timestamp(stamp[:TIMESTAMP_PIXELS - 1]) is None
+    for pixel, value in ((2, 0x100), (2, 0x1a), (6, 0x13)):
+        # count above a byte, digit above 9, month 13
+        invalid = stamp.copy()
+        invalid[pixel] = value
+        assert decode_timestamp(invalid) is None
+    frame = np.random.default_rng(0).integers(1000, 16384, (10, 10)).astype(np.uint16)
+    assert decode_timestamp(frame) is None
+
+
+class SlowSink(CallbackSink):
+    """
+    Sink that blocks the acquisition on one frame, the driver runs out of buffers and the camera loses frames.
+    """
+
+    def __init__(self, index, delay):
+        CallbackSink.__init__(self, self.wait)
+        self.index, self.delay = index, delay
+
+    def wait(self, frame):
+        if frame.index == self.index:
+            time.sleep(self.delay)
+
+
+def record(timestamp_mode):
+    camera = PixelFly(backend=SimulatedBackend(frame_rate=13.5, seed=0))
+    assert camera.open_camera()
+    camera.configure(arm=True).exposure_time(5, 2).roi(ROI).timestamp_mode(timestamp_mode).commit()
+    camera.allocate_buffer(2)
+    camera.start_recording()
+    try:
+        stack = camera.record_to_memory(40, verbose=False, sinks=[SlowSink(5, 0.2)])
+        return camera, camera.engine.stats(), stack
+    finally:
+        camera.close_camera()
+
+
+def test_gaps_from_camera_counter(capsys):
+    camera, stats, stack = record(1)
+    seqs = np.array([decode_timestamp(frame)[0] for frame in stack])
+    jumps = np.diff(seqs)
+    assert stats['gaps'] == np.count_nonzero(jumps > 1) >= 1
+    assert stats['frames missed'] == int((jumps - 1).sum()) >= 10
+    assert stats['frames acquired'] == 40
+    assert (camera.engine.first_frame[0], camera.engine.last_frame[0]) == (seqs[0], seqs[-1])
+    assert 'gaps in the recording' in capsys.readouterr().out
+    # the camera frame rate counts the missed frames
+    assert stats['camera frame rate'] == pytest.approx(95, rel=0.2)
+    assert stats['frame rate'] < stats['camera frame rate']
+
+
+def test_no_gaps_without_timestamp():
+    # the buffer numbers do not show the frames the camera lost
+    camera, stats, stack = record(0)
+    assert stats['gaps'] == 0 and stats['frames missed'] == 0
+    assert camera.engine.last_frame[0] - camera.engine.first_frame[0] == 39
+    assert camera.engine.last_frame[2] is None
+    assert stats['camera frame rate'] is None